@@ -34,9 +34,12 @@
 #include <zlib.h>
 #include <ctype.h>
 #include <stdlib.h>
+#include <limits.h>
+#include <math.h>
 #include <stdio.h>
 #include <unistd.h>
 #include <time.h>
+#include <sys/stat.h>
 #include "kseq.h"
 KSEQ_INIT(gzFile, gzread)
 
@@ -50,10 +53,29 @@ KSEQ_INIT(gzFile, gzread)
 * chunkname only when complete. Thus a client can poll for chunk files,
 * with a guarantee that any found are completed.
 * 
-* 
+* Alternatively (-p), the name of each chunk is written to stdout as soon as it is completed, followed by
+* the total number of chunks at the end, so that a client reading stdout does not need to poll at all. 
+* (The total number of input records is also reported, so that the client can cache it)
+*
+* With -d (and -p), a digest of the names of the records in each chunk is reported just before the chunk, so 
+* that a client splitting the two files of a pair can check that each pair of chunks holds the same reads. Names
+* are digested without any /1, /2 (etc) read number suffix. 
+*
+* With -w (and -p), the client controls how far ahead of it the split runs : after the first chunk, each new chunk
+* is only started once a byte has been read from stdin (end of file on stdin means no further waiting)
 */
 #define MAX_CHUNK_NUMBER_LENGTH 30
 
+int report_chunks = 0;
+int compress_chunks = 0;
+int report_name_digests = 0;
+int wait_for_client = 0;
+
+// FNV-1a digest of the (read number stripped) names in the current chunk
+#define FNV_OFFSET_BASIS 0xcbf29ce484222325ULL
+#define FNV_PRIME 0x100000001b3ULL
+unsigned long long chunk_name_digest = FNV_OFFSET_BASIS;
+
 
 /*
 * Next two methods : given the current chunk number, close the current in-progress chunk file (if any),
@@ -67,28 +89,42 @@ KSEQ_INIT(gzFile, gzread)
 * (with "in-progress" names SQ0352_S1_L001_R1_001.00001.fastq_, SQ0352_S1_L001_R2_001.00001.fastq_ etc )
 * etc 
 */
-void finalise_chunk( FILE *current_fp, char *chunk_name_buffer) { 
+void finalise_chunk( gzFile current_fp, char *chunk_name_buffer) { 
 	char *final_name_buffer;
 	final_name_buffer = (char *) malloc(strlen(chunk_name_buffer));
         final_name_buffer = strncpy(final_name_buffer, chunk_name_buffer, strlen(chunk_name_buffer)-1);
 	final_name_buffer[strlen(chunk_name_buffer)-1] = '\0'; 
       
-	fclose( current_fp );	
+	gzclose( current_fp );	
 	rename(chunk_name_buffer, final_name_buffer);
+	if ( report_chunks ) {
+		if ( report_name_digests ) {
+			printf("chunk_name_digest=%016llx\n", chunk_name_digest);
+			chunk_name_digest = FNV_OFFSET_BASIS;
+		}
+		printf("chunk=%s\n", final_name_buffer);
+		fflush(stdout);
+	}
 	free(final_name_buffer);
 	return;
 }
-FILE *advance_chunk( char *filename_template, int current_chunk_number, FILE *current_fp, char *chunk_name_buffer) {       
-	FILE *next_fp;
+gzFile advance_chunk( char *filename_template, int current_chunk_number, gzFile current_fp, char *chunk_name_buffer) {       
+	gzFile next_fp;
 
 	if ( current_chunk_number > 0 ) {
 		finalise_chunk(current_fp, chunk_name_buffer);
+		if ( wait_for_client ) {
+			if ( getchar() == EOF ) {
+				wait_for_client = 0;
+			}
+		}
 	}
 
 	// construct name of next in-progress chunk file - i.e. chunk file name appended with _
         sprintf((char *) chunk_name_buffer, filename_template, 1+current_chunk_number);
 	chunk_name_buffer = strcat(chunk_name_buffer,"_");
-	next_fp = fopen(chunk_name_buffer, "w");	
+	// chunks are written through zlib either way - "T" means transparent i.e. not compressed 
+	next_fp = gzopen(chunk_name_buffer, compress_chunks ? "wb1" : "wT");	
         return next_fp;
 }
 
@@ -110,40 +146,94 @@ FILE *advance_chunk( char *filename_template, int current_chunk_number, FILE *cu
 
 typedef struct kseqsplit_opts {
 	char* input_filename;	
-	int chunksize;
+	long long chunksize;
+	int chunk_by;
         char *filename_template;
 	char* stats_filename;
 	char* output_format;
 	float sampling_proportion;
+	int use_sampling_seed;
+	unsigned long long sampling_seed;
+	int target_chunks;
 } t_kseqsplit_opts;
 
 
-void kseq_split_write( kseq_t *seq, FILE *fp_chunk, t_kseqsplit_opts *kseqsplit_opts) {
+void kseq_split_write( kseq_t *seq, gzFile fp_chunk, t_kseqsplit_opts *kseqsplit_opts) {
+	// (gzwrite rather than gzprintf, as gzprintf output is limited to the size of the zlib buffer)
 	if ( (! seq->qual.l ) || strcmp(kseqsplit_opts->output_format,"fasta") == 0) {
 		// assume fasta
-		if ( seq->comment.l ) {
-			fprintf(fp_chunk, ">%s %s\n", seq->name.s, seq->comment.s);
-		}
-		else {
-			fprintf(fp_chunk, ">%s\n", seq->name.s);
-		}
-		fprintf(fp_chunk, "%s\n", seq->seq.s);
+		gzputc(fp_chunk, '>');
 	}
 	else {
 		// assume fastq		
-        	if ( seq->comment.l ) {
-			fprintf(fp_chunk, "@%s %s\n", seq->name.s, seq->comment.s);
-                }
-		else {
-			fprintf(fp_chunk, "@%s\n", seq->name.s);
-		}
-		fprintf(fp_chunk, "%s\n+\n%s\n", seq->seq.s, seq->qual.s);
+		gzputc(fp_chunk, '@');
+	}
+	gzwrite(fp_chunk, seq->name.s, seq->name.l);
+	if ( seq->comment.l ) {
+		gzputc(fp_chunk, ' ');
+		gzwrite(fp_chunk, seq->comment.s, seq->comment.l);
+	}
+	gzputc(fp_chunk, '\n');
+	gzwrite(fp_chunk, seq->seq.s, seq->seq.l);
+	gzputc(fp_chunk, '\n');
+	if ( seq->qual.l && strcmp(kseqsplit_opts->output_format,"fasta") != 0) {
+		gzputs(fp_chunk, "+\n");
+		gzwrite(fp_chunk, seq->qual.s, seq->qual.l);
+		gzputc(fp_chunk, '\n');
 	}
 
 	return;
 }
 
 
+/*
+* chunks are sized by records (the default), or (-b) by the residues or bytes written to them
+*/
+#define CHUNK_BY_RECORDS 0
+#define CHUNK_BY_RESIDUES 1
+#define CHUNK_BY_BYTES 2
+
+long long get_record_weight( kseq_t *seq, t_kseqsplit_opts *kseqsplit_opts) {
+	long long weight;
+
+	if ( kseqsplit_opts->chunk_by == CHUNK_BY_RESIDUES ) {
+		return seq->seq.l;
+	}
+	else if ( kseqsplit_opts->chunk_by == CHUNK_BY_BYTES ) {
+		// (as written by kseq_split_write) 
+		weight = 1 + seq->name.l + (seq->comment.l ? 1 + seq->comment.l : 0) + 1 + seq->seq.l + 1;
+		if ( seq->qual.l && strcmp(kseqsplit_opts->output_format,"fasta") != 0) {
+			weight += 2 + seq->qual.l + 1;
+		}
+		return weight;
+	}
+	return 1;
+}
+
+
+/*
+* add the name of a record to the digest of the names in the current chunk - a trailing read number (e.g. the /1 of
+* M02810:22:000000000-A856J:1:1101:13622:1113/1) is left out, so that the two files of a pair give the same digest
+*/
+void update_name_digest( kseq_t *seq ) {
+	size_t i, length;
+
+	length = seq->name.l;
+	i = length;
+	while ( i > 0 && isdigit((unsigned char) seq->name.s[i-1]) ) {
+		i--;
+	}
+	if ( i > 1 && i < length && seq->name.s[i-1] == '/' ) {
+		length = i - 1;
+	}
+
+	for ( i = 0 ; i < length ; i++ ) {
+		chunk_name_digest = (chunk_name_digest ^ (unsigned char) seq->name.s[i]) * FNV_PRIME;
+	}
+	chunk_name_digest = (chunk_name_digest ^ (unsigned char) '\n') * FNV_PRIME;
+}
+
+
 int get_sample_bool(float sampling_proportion) {
 	float univariate;
 
@@ -158,9 +248,65 @@ int get_sample_bool(float sampling_proportion) {
 }   
 
 
+/*
+* seeded version of the above : rather than a draw for each record, this returns the number of records to 
+* skip before the next one sampled, drawn from the geometric distribution - floor(log(u) / log(1 - p)). The draw 
+* depends only on the seed and the ordinal number of the last record sampled (0 before any are), a splitmix64 hash 
+* of these being used as the univariate u, so that two processes splitting the two files of a pair with the same 
+* seed will each select exactly the same records. (This is the generator of tutils.recordSampler in tardis, 
+* so the standard conditioner selects the same records too)
+*/
+long long get_seeded_sample_skip(float sampling_proportion, unsigned long long seed, unsigned long long ordinal) {
+	unsigned long long z;
+	double univariate;
+
+	z = seed + ordinal * 0x9E3779B97F4A7C15ULL;
+	z = (z ^ (z >> 30)) * 0xBF58476D1CE4E5B9ULL;
+	z = (z ^ (z >> 27)) * 0x94D049BB133111EBULL;
+	z = z ^ (z >> 31);
+	// (in (0, 1], so that the log is finite)
+	univariate = ((z >> 11) + 1) * (1.0 / 9007199254740992.0);
+
+	return (long long) floor(log(univariate) / log(1.0 - (double) sampling_proportion));
+}
+
+
+/*
+* when splitting toward a target number of chunks (-t), the chunksize given is only an initial estimate. 
+* This is called as each new chunk is started, to re-estimate the number of records (or residues or
+* bytes, with -b) still to come from the proportion of the (possibly compressed) input read so far, and 
+* spread these evenly over the remaining chunks. 
+*/
+long long get_adjusted_chunksize(gzFile fp, double input_size, unsigned long long input_records_read, t_kseqsplit_opts *kseqsplit_opts, int chunks_started) {
+	double fraction_read, remaining_records;
+	int remaining_chunks;
+	long long chunksize;
+
+	// the last chunk takes everything that is left
+	if ( kseqsplit_opts->target_chunks - chunks_started <= 1 ) {
+		return LLONG_MAX;
+	}
+
+	fraction_read = gzoffset(fp) / input_size;
+	if ( fraction_read <= 0.0 || fraction_read >= 1.0 ) {
+		// (e.g. all of the input is already buffered) - no information, so no change 
+		return kseqsplit_opts->chunksize;
+	}
+
+	remaining_records = input_records_read * (1.0 - fraction_read) / fraction_read;
+	if ( kseqsplit_opts->sampling_proportion > 0 ) {
+		remaining_records *= kseqsplit_opts->sampling_proportion;
+	}
+	remaining_chunks = kseqsplit_opts->target_chunks - chunks_started;
+
+	chunksize = (long long) (0.5 + remaining_records / remaining_chunks);
+	return chunksize < 1 ? 1 : chunksize;
+}
+
+
 int get_kseqsplit_opts(int argc, char **argv, t_kseqsplit_opts *kseqsplit_opts)
 {
-	char* usage="Usage: %s [-f stats_filename (optional, only useful if part of pipeline)] [ -s sampling_proportion ] [ -h ] [ -v ] -o output_format_required (fasta|fastq) <input filename (input maybe fasta or fastq optionally compressed> <chunksize (before sampling)> <output_filenames_template>\n";
+	char* usage="Usage: %s [-f stats_filename (optional, only useful if part of pipeline)] [ -s sampling_proportion ] [ -r sampling_seed (makes sampling reproducible, and the same for files of a pair) ] [ -p (report each chunk on stdout as it is completed) ] [ -d (with -p, also report a digest of the read names in each chunk) ] [ -w (with -p, wait for a byte on stdin before starting each new chunk) ] [ -z (gzip the chunks) ] [ -t target_number_of_chunks (chunksize is then an initial estimate, adjusted as the split proceeds) ] [ -b records|residues|bytes (what chunksize counts - default records) ] [ -h ] [ -v ] -o output_format_required (fasta|fastq) <input filename (input maybe fasta or fastq optionally compressed> <chunksize (before sampling)> <output_filenames_template>\n";
  	int index;
 	int c;
 	int iresult;
@@ -169,11 +315,15 @@ int get_kseqsplit_opts(int argc, char **argv, t_kseqsplit_opts *kseqsplit_opts)
 	kseqsplit_opts->stats_filename = "";
 	kseqsplit_opts->output_format = "";
 	kseqsplit_opts->sampling_proportion = -1.0 ; 
+	kseqsplit_opts->use_sampling_seed = 0;
+	kseqsplit_opts->target_chunks = 0;
+	kseqsplit_opts->sampling_seed = 0;
+	kseqsplit_opts->chunk_by = CHUNK_BY_RECORDS;
 
 
 	opterr = 0;
 
-	while ((c = getopt (argc, argv, "hvs:f:o:")) != -1) {
+	while ((c = getopt (argc, argv, "hvpdwzs:r:t:b:f:o:")) != -1) {
 		switch (c) {
 			case 'h':
 				fprintf(stderr, usage, argv[0]);
@@ -181,6 +331,18 @@ int get_kseqsplit_opts(int argc, char **argv, t_kseqsplit_opts *kseqsplit_opts)
 			case 'v':
 				validate_only = 1;
 				break;
+			case 'p':
+				report_chunks = 1;
+				break;
+			case 'z':
+				compress_chunks = 1;
+				break;
+			case 'd':
+				report_name_digests = 1;
+				break;
+			case 'w':
+				wait_for_client = 1;
+				break;
  			case 's':
 				// parse sampling proportion
 				iresult = sscanf(optarg,"%f", &(kseqsplit_opts->sampling_proportion) );
@@ -195,6 +357,39 @@ int get_kseqsplit_opts(int argc, char **argv, t_kseqsplit_opts *kseqsplit_opts)
 				// initialise random number generator
 				srand(time(NULL));   // should only be called once
 				break;
+			case 'r':
+				// parse sampling seed
+				iresult = sscanf(optarg,"%llu", &(kseqsplit_opts->sampling_seed) );
+				if(iresult != 1) {
+					fprintf (stderr, "Unable to parse sampling seed from %s \n", optarg);
+	   				return 1;
+				}
+				kseqsplit_opts->use_sampling_seed = 1;
+				break;
+			case 't':
+				// parse target number of chunks
+				iresult = sscanf(optarg,"%d", &(kseqsplit_opts->target_chunks) );
+				if(iresult != 1 || kseqsplit_opts->target_chunks < 1) {
+					fprintf (stderr, "Unable to parse target number of chunks from %s \n", optarg);
+	   				return 1;
+				}
+				break;
+			case 'b':
+				// parse what chunksize counts
+				if ( strcmp(optarg, "records") == 0 ) {
+					kseqsplit_opts->chunk_by = CHUNK_BY_RECORDS;
+				}
+				else if ( strcmp(optarg, "residues") == 0 ) {
+					kseqsplit_opts->chunk_by = CHUNK_BY_RESIDUES;
+				}
+				else if ( strcmp(optarg, "bytes") == 0 ) {
+					kseqsplit_opts->chunk_by = CHUNK_BY_BYTES;
+				}
+				else {
+					fprintf (stderr, "-b should be records, residues or bytes, not %s \n", optarg);
+	   				return 1;
+				}
+				break;
 			case 'f':
 				kseqsplit_opts->stats_filename = optarg;
 				break;
@@ -202,7 +397,7 @@ int get_kseqsplit_opts(int argc, char **argv, t_kseqsplit_opts *kseqsplit_opts)
 				kseqsplit_opts->output_format = optarg;
 				break;
 			case '?':
-				if (optopt == 's')
+				if (optopt == 's' || optopt == 'r' || optopt == 't' || optopt == 'b')
 					fprintf (stderr, "Option -%c requires an argument.\n", optopt);
 				else if (optopt == 'f')
 					fprintf (stderr, "Option -%c requires an argument.\n", optopt);
@@ -224,13 +419,13 @@ int get_kseqsplit_opts(int argc, char **argv, t_kseqsplit_opts *kseqsplit_opts)
 		return 1;
 	}
 	kseqsplit_opts->input_filename = argv[optind];    
-	iresult = sscanf(argv[optind+1],"%d", &(kseqsplit_opts->chunksize));
+	iresult = sscanf(argv[optind+1],"%lld", &(kseqsplit_opts->chunksize));
 	if( iresult != 1) {
 		fprintf(stderr, "Unable to parse chunksize from %s\n", argv[optind+1]);
 		return 1;
 	}
 	if ( kseqsplit_opts->sampling_proportion > 0 ){
-		kseqsplit_opts->chunksize = (int) 0.5 + kseqsplit_opts->sampling_proportion * kseqsplit_opts->chunksize; 
+		kseqsplit_opts->chunksize = (long long)(0.5 + kseqsplit_opts->sampling_proportion * kseqsplit_opts->chunksize); 
                 if ( kseqsplit_opts->chunksize < 1 ) {
 			kseqsplit_opts->chunksize = 1;
                 }
@@ -248,8 +443,8 @@ int get_kseqsplit_opts(int argc, char **argv, t_kseqsplit_opts *kseqsplit_opts)
 
   
 	if (validate_only) {
-		printf ("kseq_split options:\n stats_filename = %s\n sampling_proportion = %f\n input_filename=%s\n chunksize=%d\n filename_template=%s output_format=%s\n",\
-        	kseqsplit_opts->stats_filename,  kseqsplit_opts->sampling_proportion,\
+		printf ("kseq_split options:\n stats_filename = %s\n sampling_proportion = %f\n sampling_seed = %llu\n input_filename=%s\n chunksize=%lld\n filename_template=%s output_format=%s\n",\
+        	kseqsplit_opts->stats_filename,  kseqsplit_opts->sampling_proportion, kseqsplit_opts->sampling_seed,\
         	kseqsplit_opts->input_filename, kseqsplit_opts->chunksize, \
         	kseqsplit_opts->filename_template, kseqsplit_opts->output_format);
 		return 2;
@@ -264,13 +459,20 @@ int main(int argc, char *argv[])
 {
 	
 	gzFile fp;
-	FILE *fp_chunk, *fp_stats;
+	gzFile fp_chunk;
+	FILE *fp_stats;
 	kseq_t *seq;
 	int l;
         int record_count=0;
+        long long weight_in_chunk=0;
+        unsigned long long input_weight=0;
+        double input_size=0;
+        struct stat input_stat;
+        unsigned long long input_record_count=0;
         int chunk_number=0;
         int kseqsplit_opts_result = 0;
         int sample_bool = 1;
+        long long records_to_skip = 0;
 
 	t_kseqsplit_opts kseqsplit_opts;
         kseqsplit_opts_result = get_kseqsplit_opts(argc, argv, &kseqsplit_opts);
@@ -285,21 +487,66 @@ int main(int argc, char *argv[])
 	chunk_name_buffer = (char *) malloc(MAX_CHUNK_NUMBER_LENGTH + strlen(kseqsplit_opts.filename_template)); 
 
 
+	// if splitting toward a target number of chunks, we need the input size to see how far through we are
+	if ( kseqsplit_opts.target_chunks > 0 ) {
+		if ( stat(kseqsplit_opts.input_filename, &input_stat) == 0 ) {
+			input_size = (double) input_stat.st_size;
+		}
+		else {
+			kseqsplit_opts.target_chunks = 0;
+		}
+	}
+
+	// (with a seed, the records between those sampled are skipped without a draw for each)
+	if ( kseqsplit_opts.sampling_proportion > 0 && kseqsplit_opts.use_sampling_seed ) {
+		records_to_skip = get_seeded_sample_skip( kseqsplit_opts.sampling_proportion, kseqsplit_opts.sampling_seed, 0 );
+	}
+
 	// process the file 
 	fp = gzopen(kseqsplit_opts.input_filename, "r");
+	if ( fp == NULL ) {
+		fprintf(stderr, "Unable to open %s\n", kseqsplit_opts.input_filename);
+		return 1;
+	}
 	seq = kseq_init(fp);
 	while ((l = kseq_read(seq)) >= 0) {
 		if ( kseqsplit_opts.sampling_proportion > 0 ) {
-			sample_bool = get_sample_bool( kseqsplit_opts.sampling_proportion );
+			if ( kseqsplit_opts.use_sampling_seed ) {
+				if ( records_to_skip > 0 ) {
+					records_to_skip--;
+					sample_bool = 0;
+				}
+				else {
+					sample_bool = 1;
+					records_to_skip = get_seeded_sample_skip( kseqsplit_opts.sampling_proportion, kseqsplit_opts.sampling_seed, input_record_count + 1 );
+				}
+			}
+			else {
+				sample_bool = get_sample_bool( kseqsplit_opts.sampling_proportion );
+			}
 		}
+		input_record_count++;
+		input_weight += get_record_weight(seq, &kseqsplit_opts);
 
 		if(sample_bool) {		
 			record_count++;
-			if (record_count%kseqsplit_opts.chunksize == 1 || kseqsplit_opts.chunksize == 1) {
+			if (chunk_number == 0 || weight_in_chunk >= kseqsplit_opts.chunksize) {
+				if ( chunk_number > 0 && kseqsplit_opts.target_chunks > 0 ) {
+					kseqsplit_opts.chunksize = get_adjusted_chunksize(fp, input_size, input_weight, &kseqsplit_opts, chunk_number);
+				}
 				fp_chunk = advance_chunk(kseqsplit_opts.filename_template, chunk_number, fp_chunk, chunk_name_buffer);
+				if ( fp_chunk == NULL ) {
+					fprintf(stderr, "Unable to open chunk %s\n", chunk_name_buffer);
+					return 1;
+				}
 				chunk_number++;
+				weight_in_chunk = 0;
                 	}
 			kseq_split_write( seq, fp_chunk, &kseqsplit_opts);
+			if ( report_name_digests ) {
+				update_name_digest(seq);
+			}
+			weight_in_chunk += get_record_weight(seq, &kseqsplit_opts);
 		}
 	}
 
@@ -316,8 +563,19 @@ int main(int argc, char *argv[])
 	if (strlen(kseqsplit_opts.stats_filename) >  0) {
 		fp_stats = fopen(kseqsplit_opts.stats_filename, "w");
 		fprintf(fp_stats, "chunk_number=%d\n", chunk_number);
+		if ( l == -1 ) {
+			fprintf(fp_stats, "input_record_count=%llu\n", input_record_count);
+		}
 		fclose(fp_stats);
         }
+	if ( report_chunks ) {
+		if ( l == -1 ) {
+			// (only report the record count if the whole file was read)
+			printf("input_record_count=%llu\n", input_record_count);
+		}
+		printf("chunk_number=%d\n", chunk_number);
+		fflush(stdout);
+	}
 
 	if ( l == -1 ) {
 		return 0;  // end of file
@@ -1,3 +1,5 @@
+import subprocess
+
 import tardis.conditioner.text as text
 import tardis.conditioner.data as data
 
@@ -12,6 +14,8 @@ class blastxmlDataConditioner(text.textDataConditioner):
     def __init__(self,inputFileName = None, outputFileName = None, commandConditioning = True, conditioningPattern = None, conditioningWord = None, compressionConditioning = True):
         super(blastxmlDataConditioner, self).__init__(inputFileName, outputFileName, commandConditioning = commandConditioning, conditioningPattern = conditioningPattern, conditioningWord = conditioningWord)
         self.compressionConditioning = compressionConditioning
+        self.mergedHeader = None        # (file name, header) of the first file merged - the header of each other file must match it
+        self.mergeFailed = False        # set if a file could not be merged
         
 
     @classmethod
@@ -22,17 +26,101 @@ class blastxmlDataConditioner(text.textDataConditioner):
         prototype.induct(dc)
         return dc
 
+    def isOutputPipelined(self):
+        """
+        our output can be merged as the jobs finish just as text is (the header of each file is dealt with as it
+        is appended - see appendMergedOutput - and the footer written once they all have been), as long as it is not
+        products found by pattern
+        """
+        return len(self.conditionedProductPatterns) == 0 and self.outputFileName is not None
+
+    def appendMergedOutput(self, fileName):
+        """
+        append a file to the output being merged as the jobs finish - with its header rewritten as for the merge
+        at the end (see appendBlastXML)
+        """
+        if not self.mergeFailed:
+            self.mergeFailed = not self.appendBlastXML(fileName, self.mergedOutput)
+
+    def getMergedOutputTrailer(self):
+        """
+        the footer that closes the merged iterations (left off if a file could not be merged)
+        """
+        if self.mergeFailed:
+            return ""
+        return "  </BlastOutput_iterations>\n</BlastOutput>\n"
+
+    def appendBlastXML(self, fileName, out):
+        """
+        append the iterations of blast xml file fileName to out - preceded by its header if it is the first file merged
+        (the header of each other file must match that). Returns False (having set the error state) if the file can't
+        be merged - what was read of its header is written to out, for diagnosis
+
+        acknowledgement :
+        ### this method is based on galaxy code
+        ### https://bitbucket.org/peterjc/galaxy-central/src/5cefd5d5536e/tools/ncbi_blast_plus/blast.py
+        # see also lib/galaxy/datatypes/xml.py
+        """
+        with open(fileName) as h:
+            header = h.readline()
+            if not header:
+                self.error("BLAST XML file %s was empty" % fileName)
+                return False
+            if header.strip() != '<?xml version="1.0"?>':
+                out.write(header) #for diagnosis
+                self.error("%s is not an XML file!" % fileName)
+                return False
+            line = h.readline()
+            header += line
+            if line.strip() not in ['<!DOCTYPE BlastOutput PUBLIC "-//NCBI//NCBI BlastOutput/EN" "http://www.ncbi.nlm.nih.gov/dtd/NCBI_BlastOutput.dtd">',
+                                    '<!DOCTYPE BlastOutput PUBLIC "-//NCBI//NCBI BlastOutput/EN" "NCBI_BlastOutput.dtd">']:
+                out.write(header) #for diagnosis
+                self.error("%s is not a BLAST XML file!" % fileName)
+                return False
+            while True:
+                line = h.readline()
+                if not line:
+                    out.write(header) #for diagnosis
+                    self.error("BLAST XML file %s ended prematurely" % fileName)
+                    return False
+                header += line
+                if "<Iteration>" in line:
+                    break
+                if len(header) > 10000:
+                    #Something has gone wrong, don't load too much into memory!
+                    #Write what we have to the merged file for diagnostics
+                    out.write(header)
+                    self.error("BLAST XML file %s has too long a header!" % fileName)
+                    return False
+
+            if "<BlastOutput>" not in header:
+                self.error("%s is not a BLAST XML file:\n%s\n..." % (fileName, header))
+                return False
+
+            if self.mergedHeader is None:
+                out.write(header)
+                self.mergedHeader = (fileName, header)
+            elif self.mergedHeader[1][:300] != header[:300]:
+                #Enough to check <BlastOutput_program> and <BlastOutput_version> match
+                self.error("BLAST XML headers don't match for %s and %s - have:\n%s\n...\n\nAnd:\n%s\n...\n" \
+                           % (self.mergedHeader[0], fileName, self.mergedHeader[1][:300], header[:300]))
+                return False
+            else:
+                out.write("    <Iteration>\n")
+            for line in h:
+                if "</BlastOutput_iterations>" in line:
+                    break
+                #TODO - Increment <Iteration_iter-num> and if required automatic query names
+                #like <Iteration_query-ID>Query_3</Iteration_query-ID> to be increasing?
+                out.write(line)
+        return True
+
     def unconditionOutput(self):
         """
         this class method coordinates unconditioning - i.e. "joining back together"
         blast xml output . There are some applications ( such as MEGAN ), which require a
         single merged XML output , that is valid XML (i.e. simple text concatenation is 
         not enough) 
-    
-        acknowledgement : 
-        ### this method is based on galaxy code
-        ### https://bitbucket.org/peterjc/galaxy-central/src/5cefd5d5536e/tools/ncbi_blast_plus/blast.py
-        # see also lib/galaxy/datatypes/xml.py
         """
         
         #filesToProcess = [filename for filename in self.conditionedOutputFileNames if filename != None]
@@ -47,115 +135,31 @@ class blastxmlDataConditioner(text.textDataConditioner):
         to
         %s"""%(str(filesToProcess), self.outputFileName))
 
+        if self.mergedOutput is not None:
+            # the output has been merged as the jobs finished - finish off with any files that were not
+            self.closeMergedOutput()
+            return
 
-        split_files = filesToProcess
-        output_file = self.outputFileName
         self.logWriter.info("starting galaxy based blast xml merge courtesy of https://bitbucket.org/peterjc/galaxy-central/src/5cefd5d5536e/tools/ncbi_blast_plus/blast.py")
-        
-        ##################################  begin Galaxy code snippet #######################################
-	"""Merging multiple XML files is non-trivial and must be done in subclasses."""
-        #print "DEBUG1"
-	#if len(split_files) == 1:
-	    #For one file only, use base class method (move/copy)
-	    #return Text.merge(split_files, output_file)
-	out = open(output_file, "w")
-	h = None
-	for f in split_files:
+        out = open(self.outputFileName, "w")
+        for f in filesToProcess:
             print "processing %s"%f
-	    h = open(f)
-	    body = False
-	    header = h.readline()
-	    if not header:
-		out.close()
-		h.close()
-		#raise ValueError("BLAST XML file %s was empty" % f)
-		self.error("BLAST XML file %s was empty" % f)
-		continue
-	    if header.strip() != '<?xml version="1.0"?>':
-		out.write(header) #for diagnosis
-		out.close()
-		h.close()
-		#raise ValueError("%s is not an XML file!" % f)
-		self.error("BLAST XML file %s was empty" % f)
-		continue
-	    line = h.readline()
-	    header += line
-	    if line.strip() not in ['<!DOCTYPE BlastOutput PUBLIC "-//NCBI//NCBI BlastOutput/EN" "http://www.ncbi.nlm.nih.gov/dtd/NCBI_BlastOutput.dtd">',
-				    '<!DOCTYPE BlastOutput PUBLIC "-//NCBI//NCBI BlastOutput/EN" "NCBI_BlastOutput.dtd">']:
-		out.write(header) #for diagnosis
-		out.close()
-		h.close()
-		#raise ValueError("%s is not a BLAST XML file!" % f)
-		self.error("%s is not a BLAST XML file!" % f)
-		continue
-	    while True:
-		line = h.readline()
-		if not line:
-		    out.write(header) #for diagnosis
-		    out.close()
-		    h.close()
-		    #raise ValueError("BLAST XML file %s ended prematurely" % f)
-                    self.error("BLAST XML file %s ended prematurely" % f)
-                    break
-		    
-		header += line
-		if "<Iteration>" in line:
-		    break
-		if len(header) > 10000:
-		    #Something has gone wrong, don't load too much into memory!
-		    #Write what we have to the merged file for diagnostics
-		    out.write(header)
-		    out.close()
-		    h.close()
-		    #raise ValueError("BLAST XML file %s has too long a header!" % f)
-                    self.error("BLAST XML file %s has too long a header!" % f)
-                    break
-		
-	    if "<BlastOutput>" not in header:
-		out.close()
-		h.close()
-		#raise ValueError("%s is not a BLAST XML file:\n%s\n..." % (f, header))
-                self.error("%s is not a BLAST XML file:\n%s\n..." % (f, header))
-                break
-		
-	    if f == split_files[0]:
-		out.write(header)
-		old_header = header
-	    elif old_header[:300] != header[:300]:
-		#Enough to check <BlastOutput_program> and <BlastOutput_version> match
-		out.close()
-		h.close()
-		#raise ValueError("BLAST XML headers don't match for %s and %s - have:\n%s\n...\n\nAnd:\n%s\n...\n" \
-		#		 % (split_files[0], f, old_header[:300], header[:300]))
-                self.error("BLAST XML headers don't match for %s and %s - have:\n%s\n...\n\nAnd:\n%s\n...\n" \
-				 % (split_files[0], f, old_header[:300], header[:300]))
+            if not self.appendBlastXML(f, out):
+                self.mergeFailed = True
                 break
-	    else:
-		out.write("    <Iteration>\n")
-	    for line in h:
-		if "</BlastOutput_iterations>" in line:
-		    break
-		#TODO - Increment <Iteration_iter-num> and if required automatic query names
-		#like <Iteration_query-ID>Query_3</Iteration_query-ID> to be increasing?
-		out.write(line)
-	    h.close()
-	out.write("  </BlastOutput_iterations>\n")
-	out.write("</BlastOutput>\n")
-	out.close()
-        ##################################  end Galaxy code snippet #######################################
-	self.logWriter.info("finished galaxy based blast xml merge courtesy of https://bitbucket.org/peterjc/galaxy-central/src/5cefd5d5536e/tools/ncbi_blast_plus/blast.py")
-
-
-        compressionCommand = self.getFileCompressionCommand(self.outputFileName)
-        self.logWriter.info("executing %s"%str(compressionCommand))
-        proc = subprocess.Popen(compressionCommand,stdout=subprocess.PIPE,stderr=subprocess.PIPE)
-        (stdout, stderr) = proc.communicate()
-        self.logWriter.info("blastxmlDataConditioner : file compression returned  ( return code %s ) - here is its output "%proc.returncode)
-        self.logWriter.info("stdout : \n%s"%stdout)
-        self.logWriter.info("stderr : \n%s"%stderr)
-
-        if proc.returncode != 0:
-            self.error("compression of concatenated files appears to have failed - setting error state")
+        out.write(self.getMergedOutputTrailer())
+        out.close()
+        self.logWriter.info("finished galaxy based blast xml merge courtesy of https://bitbucket.org/peterjc/galaxy-central/src/5cefd5d5536e/tools/ncbi_blast_plus/blast.py")
 
 
+        if self.compressionConditioning:
+            compressionCommand = self.getFileCompressionCommand(self.outputFileName)
+            self.logWriter.info("executing %s"%str(compressionCommand))
+            proc = subprocess.Popen(compressionCommand,stdout=subprocess.PIPE,stderr=subprocess.PIPE)
+            (stdout, stderr) = proc.communicate()
+            self.logWriter.info("blastxmlDataConditioner : file compression returned  ( return code %s ) - here is its output "%proc.returncode)
+            self.logWriter.info("stdout : \n%s"%stdout)
+            self.logWriter.info("stderr : \n%s"%stderr)
 
+            if proc.returncode != 0:
+                self.error("compression of concatenated files appears to have failed - setting error state")
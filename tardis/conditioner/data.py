@@ -1,4 +1,4 @@
-import string, os, re, itertools
+import string, os, re, itertools, ast
 
 import tardis.tutils.tutils as tutils
 
@@ -18,6 +18,9 @@ class dataConditioner(object):
     POLL_INTERVAL = 0.5 # seconds
     POLL_DURATION = 1 * 24 * 60 * 60 # one day
 
+    CONDITIONED_INPUT_MANIFEST = "conditioned_input.manifest"  # records the chunks conditioned in a session, so it can be resumed
+    CONDITIONED_INPUT_MANIFEST_COMPLETE = "# complete"
+
     OK = 0
     ERROR = 1
     state = OK
@@ -61,8 +64,11 @@ class dataConditioner(object):
         self.conditionedInputFileNames = []
         self.conditionedOutputFileNames =[]
         self.conditionedProductPatterns=[]
+        self.conditionedProductRegexp = None    # (compiled) product pattern
         self.conditionedOutputManifests = []    # this is not actually used by the unconditioning process
-        self.conditionedProductManifests = []   # this *is* used by the unconditioning process
+        self.conditionedProductManifests = set()   # this *is* used by the unconditioning process
+        self.examinedProductFileNames = set()   # working folder files already looked at for products
+        self.lastProductListing = None
         self.outputCollector = self.conditionedOutputCollector() # this is a co-routine that is sent output by the hpcConditioner
         self.productCollector = self.conditionedProductCollector() # this is a co-routine that is sent product by the hpcConditioner
         self.outputCollector.send(None) # initialise the co-routine generators
@@ -196,7 +202,28 @@ class dataConditioner(object):
                 distinctConditioners.append(c)
 
         return distinctConditioners
-    
+
+    def getOutputUnconditionerCollectors(self):
+        """
+        return a pair of (initialised) co-routines , which pass on whatever they are sent to the output and
+        product collectors (respectively) of all of the output unconditioners - so that the jobs only need to be
+        polled once , however many output unconditioners there are
+        """
+        collectors = (self.broadcastCollector([dc.outputCollector for dc in self.outputUnconditioners]), \
+                      self.broadcastCollector([dc.productCollector for dc in self.outputUnconditioners]))
+        for collector in collectors:
+            collector.send(None)
+        return collectors
+
+    def broadcastCollector(self, collectors):
+        """
+        this is a coroutine which sends each thing it is sent, on to each of collectors
+        """
+        while True:
+            output = (yield)
+            for collector in collectors:
+                collector.send(output)
+
     def getConditionedInputGenerators(self):
         """
         This method returns a generator of conditioned input, based on the input conditioners that have
@@ -214,6 +241,17 @@ class dataConditioner(object):
         does not include any input conditioning, this will be the case)
         """    
 
+        # if resuming a previous session, re-use the conditioned input it wrote, rather than conditioning the input again
+        manifestName = os.path.join(self.workingRoot, dataConditioner.CONDITIONED_INPUT_MANIFEST)
+        if self.options.get("resume", None) is not None:
+            if os.path.isfile(manifestName):
+                # (as when conditioning the input - the jobs are run where their conditioned input is)
+                self.logWriter.info("dataConditioner : resuming with the conditioned input of the previous session - setting input_conditioning")
+                self.jobcontroller.options["input_conditioning"] = True
+                return self.getResumedConditionedInputGenerator(manifestName)
+            elif len(self.getDistinctInputConditioners()) > 0:
+                raise tutils.tardisException("error can't resume session - there is no %s in %s"%(dataConditioner.CONDITIONED_INPUT_MANIFEST, self.workingRoot))
+
         inputGenerators = [dc.getConditionedInputGenerator() for dc in self.getDistinctInputConditioners()]
         inputGenerators = [ig for ig in inputGenerators if ig != None]
 
@@ -226,18 +264,54 @@ class dataConditioner(object):
         else:
             return [((None,None),[None,None])]
         
-        return input_iter
+        return self.getRecordedConditionedInputGenerator(input_iter, manifestName)
+
+    def getRecordedConditionedInputGenerator(self, input_iter, manifestName):
+        """
+        passes on the conditioned input from input_iter, recording each chunk (and the size of its files) in
+        a manifest in the working folder, so that the session can later be resumed (--resume) without conditioning
+        the input again. The manifest is only marked complete once all of the input has been conditioned
+        """
+        with open(manifestName, "w") as manifest:
+            for conditionedInputs in input_iter:
+                sizes = [tuple((os.path.getsize(fragment) if fragment is not None and os.path.isfile(fragment) else None for fragment in conditionedInput[1])) \
+                         for conditionedInput in conditionedInputs]
+                print >> manifest, repr((conditionedInputs, sizes))
+                manifest.flush()
+                yield conditionedInputs
+            print >> manifest, dataConditioner.CONDITIONED_INPUT_MANIFEST_COMPLETE
+
+    def getResumedConditionedInputGenerator(self, manifestName):
+        """
+        yields the conditioned input recorded in the manifest of a previous session. Chunks whose files have
+        changed size since they were written are an error - but chunks may be missing, as the conditioned input of
+        jobs that finished OK can be removed (this is checked when the jobs are resumed)
+        """
+        with open(manifestName, "r") as manifest:
+            records = [record.strip() for record in manifest]
+        if len(records) == 0 or records[-1] != dataConditioner.CONDITIONED_INPUT_MANIFEST_COMPLETE:
+            raise tutils.tardisException("error can't resume session - the input was not completely conditioned (%s is incomplete)"%manifestName)
+        self.logWriter.info("dataConditioner : resuming session, re-using the %d chunks of conditioned input listed in %s"%(len(records)-1, manifestName))
+
+        for record in records[:-1]:
+            (conditionedInputs, sizes) = ast.literal_eval(record)
+            for (conditionedInput, fragmentSizes) in zip(conditionedInputs, sizes):
+                for (fragment, size) in zip(conditionedInput[1], fragmentSizes):
+                    if size is not None and os.path.isfile(fragment) and os.path.getsize(fragment) != size:
+                        raise tutils.tardisException("error can't resume session - %s has changed size since it was written (was %d, now %d)"%(fragment, size, os.path.getsize(fragment)))
+            yield conditionedInputs
 
     def parseExpectedUnconditionedOutputFiles(self, file_list):
         # we will look for files that match the patterns. There is probably (and currently) actually
         # only one pattern - sniff the first eleemnt to get this
         expectedFilesToUncondition = []
         if len(file_list) > 0 and len( self.conditionedProductPatterns ) > 0:
-            self.logWriter.info("parseExpectedUnconditionedOutputFiles: received file list %s"%str(file_list))
+            self.logWriter.info("parseExpectedUnconditionedOutputFiles: received %d file names"%len(file_list))
             #manifest  = set(reduce(lambda x,y:x+y, file_list))
-            pattern = self.conditionedProductPatterns[0][1]
-            self.logWriter.info("parseExpectedUnconditionedOutputFiles looking for products using regexp=%s"%pattern)
-            expectedFilesToUncondition = [os.path.join(self.workingRoot, filename) for filename in file_list if re.search(pattern, filename ) is not None]
+            if self.conditionedProductRegexp is None:
+                self.conditionedProductRegexp = re.compile(self.conditionedProductPatterns[0][1])
+            self.logWriter.info("parseExpectedUnconditionedOutputFiles looking for products using regexp=%s"%self.conditionedProductPatterns[0][1])
+            expectedFilesToUncondition = [os.path.join(self.workingRoot, filename) for filename in file_list if self.conditionedProductRegexp.search(filename) is not None]
             self.logWriter.info("parseExpectedUnconditionedOutputFiles found %d files to uncondition"%len(expectedFilesToUncondition))
         return expectedFilesToUncondition
 
@@ -484,6 +558,9 @@ symlink
         for dc in self.inputConditioners + [pair[0] for pair in self.pairedInputConditioners] + [pair[1] for pair in self.pairedInputConditioners]:
             if len(dc.conditionedInputFileNames) == 0 and dc.inputFileName != None:
                 dc.conditionedInputFileNames = [os.path.join(dc.workingRoot, os.path.basename(dc.inputFileName))]
+                if self.options.get("resume", None) is not None and os.path.islink(dc.conditionedInputFileNames[0]):
+                    self.logWriter.info("dataConditioner : re-using %s from the previous session"%dc.conditionedInputFileNames[0])
+                    continue
                 self.logWriter.info("dataConditioner : symlinking %s ---> %s "%(dc.conditionedInputFileNames[0] , dc.inputFileName))
                 self.symlink(dc.inputFileName, dc.conditionedInputFileNames[0])
                 # check it is there
@@ -550,11 +627,21 @@ symlink
         return inputWord
 
 
-    def removeConditionedInput(self):
+    def releaseConditionedInput(self, fileName):
         """
-        remove the conditioned input
+        release anything still waiting to serve the conditioned input file to a job that has finished (the base
+        class has nothing to release)
         """
-        for fileName in self.conditionedInputFileNames:
+        return
+
+    def removeConditionedInput(self, fileNames = None):
+        """
+        remove the conditioned input - or just the conditioned input files in fileNames (e.g. those of
+        a job that has finished)
+        """
+        if fileNames is None:
+            fileNames = self.conditionedInputFileNames
+        for fileName in fileNames:
             # these filenames should already include the full path to the working root - however
             # to be extra sure we do not run amok and remove files outside there, strip the 
             # path and add it back on....
@@ -567,6 +654,22 @@ symlink
             else:
                 self.logWriter.info("dataConditioner : skipping %s , not there (already removed?) "%safeFileName )
 
+    def isConditionedInputAvailable(self, fileName):
+        """
+        return True if the conditioned input file is (still) there
+        """
+        return os.path.exists(fileName)
+
+    def getConditionedInputKey(self, fileName):
+        """
+        return a key identifying the content of the conditioned input file, without reading it (e.g. so that the results
+        of a job run on it can be cached - see hpcConditioner.getJobResultKey) - or None if it can't be identified. The
+        base class conditioned input is the input file itself, so this is just the identity of the file
+        """
+        if fileName is None or not os.path.isfile(fileName):
+            return None
+        return tutils.getFileIdentityKey([fileName], ())
+
     def removeConditionedOutput(self):
         """
         remove all conditioned output. Should  normally only do this all the
@@ -587,6 +690,13 @@ symlink
             else:
                 self.logWriter.info("removeConditionedOutput : skipping %s , not there "%safeFileName )
 
+    def isOutputPipelined(self):
+        """
+        whether each of our conditioned output files can be merged as soon as the job that writes it is done (see
+        textDataConditioner.mergeAvailableOutput), rather than once all of the jobs are done. By default, no
+        """
+        return False
+
 
     def nextConditionedOutputWord(self):
         """
@@ -813,8 +923,13 @@ symlink
         while True:
             output = (yield)
             #self.logWriter.info("conditionedProductCollector yielded : %s"%str(output))
-            if output != None:
-                self.conditionedProductManifests = list(set(self.conditionedProductManifests).union(set(self.parseExpectedUnconditionedOutputFiles(output))))
+            if output != None and output is not self.lastProductListing:
+                # (the jobs polled in a cycle all send the same listing of the working folder - so only look at each
+                # listing once, and then only at the files we have not already looked at)
+                self.lastProductListing = output
+                newFileNames = [fileName for fileName in output if fileName not in self.examinedProductFileNames]
+                self.examinedProductFileNames.update(newFileNames)
+                self.conditionedProductManifests.update(self.parseExpectedUnconditionedOutputFiles(newFileNames))
                 self.logWriter.info("getconditionedProduct : have received %d of %d job product packages"%\
                                     ( len(self.conditionedProductManifests), len(self.jobcontroller.jobList) ))
           
@@ -1,4 +1,5 @@
-import logging,os, itertools, re, string, stat , subprocess, time
+import logging,os, itertools, re, string, stat , subprocess, time, ast, shutil, hashlib, threading
+from distutils.spawn import find_executable
 import tardis.tutils.tutils as tutils
 import tardis.conditioner.fastq as fastq
 import tardis.conditioner.fasta as fasta
@@ -18,6 +19,9 @@ import tardis.job.hpc as hpc
 global SLURM_MAXARRAYSIZE
 SLURM_MAXARRAYSIZE=500  # for testing - make 1000 for real
 
+global CONDITIONED_INPUT_POLL_INTERVAL
+CONDITIONED_INPUT_POLL_INTERVAL=1 # seconds between checks for finished jobs, while splitting is paused
+
 
 class hpcConditioner(object):
     """
@@ -38,6 +42,10 @@ class hpcConditioner(object):
         self.hpcClass = None
         self.hpcJobNumber = 1
         self.options = options   
+        self.previousJobFileNames = None  # when resuming a session, the files left by each job last time, by job number
+        self.workingFolderSnapshot = None  # listing of the working folder shared by all jobs - refreshed each poll cycle
+        self.lock = threading.RLock()  # held by whichever thread is using the jobs and conditioners (see engine = "threaded")
+        self.jobsPolled = threading.Condition(self.lock)  # notified each time the threaded engine's poller has polled the jobs
 
 
         if options["hpctype"] == "condor":
@@ -112,14 +120,22 @@ srun --cpu_bind=v,threads ${SLURM_ARRAY_TASK_ID}
             raise tutils.tardisException("hpcConditioner: Error job template is null after templating")
         job_template = string.Template(job_template)        
         
-        n_launched = 0
-        while n_launched < len(self.jobList):
-            n_launch = min(SLURM_MAXARRAYSIZE, len(self.jobList) - n_launched)
-        
+        # (when resuming a session, jobs that finished OK last time are not launched again - so each run of
+        # consecutive jobs to be launched goes in its own array job(s))
+        launchRanges = []
+        for job in self.jobList:
+            if job.returncode == 0:
+                continue
+            if len(launchRanges) > 0 and launchRanges[-1][1] == job.jobNumber - 1 and launchRanges[-1][1] - launchRanges[-1][0] + 1 < SLURM_MAXARRAYSIZE:
+                launchRanges[-1][1] = job.jobNumber
+            else:
+                launchRanges.append([job.jobNumber, job.jobNumber])
+
+        for (array_start, array_stop) in launchRanges:
             arraycode  = job_template.safe_substitute(tardis_job_moniker=self.toolargv[0], tardis_account_moniker=os.environ['LOGNAME'],\
-                                                                 array_start=str(n_launched+1),array_stop=str(n_launched+n_launch),\
+                                                                 array_start=str(array_start),array_stop=str(array_stop),\
                                                                  hpcdir=self.workingRoot)
-            array_jobfile_name = os.path.join(self.workingRoot, "array_%d-%d.slurm"%(n_launched+1,n_launched+n_launch))
+            array_jobfile_name = os.path.join(self.workingRoot, "array_%d-%d.slurm"%(array_start,array_stop))
             f=open(array_jobfile_name,"w")
             self.logWriter.info("hpcConditioner : writing array job %s"%array_jobfile_name)
             f.writelines(arraycode)
@@ -146,8 +162,31 @@ srun --cpu_bind=v,threads ${SLURM_ARRAY_TASK_ID}
                     self.logWriter.info("slurmhpcJob : giving up, the array job spec may have bugs ?")
                     raise tutils.tardisException("hpcConditioner : %s"%stderr)
 
-            n_launched += n_launch
 
+    def getWorkingFolderSnapshot(self):
+        """
+        return the current snapshot (listing) of the working folder, shared by all jobs - a new one is only
+        taken if there isn't one
+        """
+        if self.workingFolderSnapshot is None:
+            self.workingFolderSnapshot = hpc.workingFolderSnapshot(self.workingRoot)
+        return self.workingFolderSnapshot
+
+    def expireWorkingFolderSnapshot(self):
+        """
+        called at the start of each poll cycle (and again once the job logs have been read, if some of the jobs
+        have finished), so the next job that needs a snapshot takes a new one
+        """
+        self.workingFolderSnapshot = None
+
+    def waitOnJobs(self):
+        """
+        called once each poll cycle - update the status of any jobs which are children of this process (i.e. local
+        jobs), so that when they are polled the jobs only need to look at what was recorded. (The worker list is
+        shared by all jobs, so any one of them will do)
+        """
+        if len(self.jobList) > 0:
+            self.jobList[-1].waitOnChildren()
 
     def getJobResultState(self):
         return  reduce(lambda x,y:hpc.hpcJob.stateAND(x,y), [job.state for job in self.jobList], hpc.hpcJob.OK)
@@ -587,6 +626,8 @@ srun --cpu_bind=v,threads ${SLURM_ARRAY_TASK_ID}
                                 (len(self.getUnsubmittedJobs()), retryPause, maxRetries))
             time.sleep(retryPause)
             self.logWriter.info("done pausing, processing retries")
+            if retryPause > 0:
+                self.waitOnJobs()    # (without a pause, the caller has just done this , this poll cycle)
             for retryJob in self.getUnsubmittedJobs():
                 self.logWriter.info("retrying job")
                 retryJob.runCommand()
@@ -595,8 +636,204 @@ srun --cpu_bind=v,threads ${SLURM_ARRAY_TASK_ID}
 
 
         self.logWriter.info("retryCount = %d"%retryCount)
-                                
-        return 
+
+        return
+
+    def resumeJob(self, job, dcPrototype):
+        """
+        when resuming a previous session (--resume), return True if the job finished OK last time, so does
+        not need to be run again. Otherwise the job is set up to be run again - which needs the conditioned
+        input it was given last time
+        """
+        if self.previousJobFileNames is None:
+            self.previousJobFileNames = hpc.workingFolderSnapshot(self.workingRoot)
+
+        if job.resumeJob(self.previousJobFileNames.getJobFileNames(job.jobNumber)):
+            return True
+
+        for dc in dcPrototype.getDistinctInputConditioners():
+            if len(dc.conditionedInputFileNames) > 0 and not dc.isConditionedInputAvailable(dc.conditionedInputFileNames[-1]):
+                raise tutils.tardisException("error can't resume job %d - its conditioned input %s is no longer there"%(job.jobNumber, dc.conditionedInputFileNames[-1]))
+        return False
+
+    def getJobResultKey(self, job, dcPrototype):
+        """
+        return the key under which the results of job are cached - a digest of the command (with the working folder
+        factored out), the identity of the tool it runs, the identity of its chunks of input (see getConditionedInputKey -
+        the chunks are not read), and the options that set up its environment. Returns None if the job's results can't
+        be cached - i.e. if it writes products, or output files with a basename we are given, as we don't know which files
+        these are - or its input can't be identified (e.g. it is an unseeded random sample)
+        """
+        for dc in dcPrototype.outputUnconditioners:
+            if len(dc.conditionedProductPatterns) > 0:
+                return None
+        if len(dcPrototype.getDistinctOutputBaseConditioners()) > 0:
+            return None
+
+        key = hashlib.md5()
+        key.update(repr([word.replace(self.workingRoot, "$hpcdir") for word in job.command]))
+        tool = find_executable(job.command[0]) if len(job.command) > 0 else None
+        key.update(tutils.getFileIdentityKey([tool], ()) if tool is not None else repr(job.command[0:1]))
+        key.update(repr([self.options.get(option, None) for option in ("startdir", "shell_template_name", "shelltemplatefile", \
+                                                                     "runtime_config_name", "runtimeconfigsourcefile", "input_conditioning")]))
+        for dc in dcPrototype.getDistinctInputConditioners():
+            if len(dc.conditionedInputFileNames) > 0:
+                inputKey = dc.getConditionedInputKey(dc.conditionedInputFileNames[-1])
+                if inputKey is None:
+                    return None
+                key.update(inputKey)
+        return key.hexdigest()
+
+    def restoreJobResults(self, job, dcPrototype):
+        """
+        if result caching is enabled (result_cache_size), and the results of this job are in the cache, link them
+        into the working folder, mark the job as finished OK and return True - the job does not need to be run.
+        Otherwise the job is set up so that its results are cached (see cacheJobResults) once it finishes OK
+        """
+        if not tutils.isCacheEnabled(self.options, tutils.RESULT_CACHE) or self.options["dry_run"]:
+            return False
+
+        job.resultCacheKey = self.getJobResultKey(job, dcPrototype)
+        if job.resultCacheKey is None:
+            return False
+        job.conditionedOutputs = [dc.conditionedOutputFileNames[-1] for dc in dcPrototype.outputUnconditioners if len(dc.conditionedOutputFileNames) > 0]
+
+        entrydir = tutils.getCacheEntry(self.options, tutils.RESULT_CACHE, job.resultCacheKey)
+        if entrydir is None:
+            return False
+
+        restored = []
+        try:
+            with open(os.path.join(entrydir, tutils.CACHE_MANIFEST), "r") as manifest:
+                cachedOutputs = ast.literal_eval(manifest.read().strip())
+            if len(cachedOutputs) != len(job.conditionedOutputs):
+                raise ValueError("cached job had %d outputs, not %d"%(len(cachedOutputs), len(job.conditionedOutputs)))
+
+            job.setJobFileNames()
+            (job.stdoutfilename, job.stderrfilename) = job.getRestoredStreamFileNames()
+            for (cachedName, fileName) in zip(cachedOutputs + ["stdout", "stderr"], job.conditionedOutputs + [job.stdoutfilename, job.stderrfilename]):
+                if cachedName is not None:
+                    tutils.linkOrCopy(os.path.join(entrydir, cachedName), fileName)
+                    restored.append(fileName)
+            job.setExitFootprint(0)
+            restored.append(job.logname)
+        except (IOError, OSError, ValueError, SyntaxError), e:
+            # (e.g. evicted by another session as we were reading it) - just run the job
+            self.logWriter.info("unable to restore the results of job %d from %s (%s) - running it"%(job.jobNumber, entrydir, str(e)))
+            for fileName in restored:
+                if os.path.exists(fileName):
+                    os.remove(fileName)
+            (job.stdoutfilename, job.stderrfilename, job.logname) = (None, None, None)
+            return False
+
+        self.logWriter.info("restored the results of job %d from %s - not running it"%(job.jobNumber, entrydir))
+        job.submitCount = 1
+        job.returncode = 0
+        job.resultCacheKey = None
+        return True
+
+    def cacheJobResults(self, job):
+        """
+        add the results (conditioned output files, stdout and stderr) of a job that finished OK to the result cache
+        """
+        if job.resultCacheKey is None or job.returncode != 0:
+            return
+        (key, job.resultCacheKey) = (job.resultCacheKey, None)
+
+        stagingdir = tutils.getCacheStagingDir(self.options, tutils.RESULT_CACHE, key)
+        if stagingdir is None:
+            return
+        try:
+            cachedOutputs = []
+            for (i, fileName) in enumerate(job.conditionedOutputs):
+                if os.path.isfile(fileName):
+                    cachedOutputs.append("output.%d"%i)
+                    tutils.linkOrCopy(fileName, os.path.join(stagingdir, cachedOutputs[-1]))
+                else:
+                    cachedOutputs.append(None)
+
+            for (streamName, fileName) in (("stdout", job.stdoutfilename), ("stderr", job.stderrfilename)):
+                if fileName is not None and os.path.isfile(fileName):
+                    shutil.copyfile(fileName, os.path.join(stagingdir, streamName))
+                else:
+                    open(os.path.join(stagingdir, streamName), "w").close()
+
+            with open(os.path.join(stagingdir, tutils.CACHE_MANIFEST), "w") as manifest:
+                print >> manifest, repr(cachedOutputs)
+        except (IOError, OSError), e:
+            self.logWriter.info("unable to cache the results of job %d (%s)"%(job.jobNumber, str(e)))
+            shutil.rmtree(stagingdir, ignore_errors = True)
+            return
+
+        tutils.addCacheEntry(self.options, tutils.RESULT_CACHE, key, stagingdir)
+        self.logWriter.info("cached the results of job %d (key %s)"%(job.jobNumber, key))
+
+    def waitForConditionedInputSpace(self, dcPrototype, poller = None):
+        """
+        if the conditioned input on disk is limited (max_conditioned_chunks, max_conditioned_bytes), wait until
+        enough of the jobs we have launched have finished, and their conditioned input been removed, that
+        splitting can go on. (The input of jobs which fail is kept, to help with debugging - if only failed jobs
+        are left, we stop waiting, rather than hang)
+        With the threaded engine, the poller is left to find out which jobs have finished - we wait to be told it
+        has polled them (releasing the lock meanwhile, so that it can), rather than polling them ourselves
+        """
+        if not tutils.isConditionedInputThrottled(self.options):
+            return
+
+        max_chunks = self.options.get("max_conditioned_chunks", None)
+        max_bytes = self.options.get("max_conditioned_bytes", None)
+        wait_count = 0
+        while True:
+            # see which jobs have finished, and clean up the input of those that finished OK
+            if poller is None:
+                self.expireWorkingFolderSnapshot()
+                self.waitOnJobs()
+            outstandingJobs = []
+            for job in self.jobList:
+                if len(job.conditionedInputs) == 0:
+                    continue
+                if poller is None and not job.jobHeld and job.submitCount > 0:
+                    job.pollExitFootprint()
+                if job.returncode == 0:
+                    for (dc, fileName) in job.conditionedInputs:
+                        dc.removeConditionedInput([fileName])
+                    job.conditionedInputs = []
+                else:
+                    outstandingJobs.append(job)
+
+            chunk_count = reduce(lambda x,y:x+len(y.conditionedInputs), outstandingJobs, 0)
+            byte_count = 0
+            for job in outstandingJobs:
+                byte_count += reduce(lambda x,y:x+(os.path.getsize(y[1]) if os.path.isfile(y[1]) else 0), job.conditionedInputs, 0)
+
+            if (max_chunks is None or chunk_count < max_chunks) and (max_bytes is None or byte_count < max_bytes):
+                break
+
+            if len([job for job in outstandingJobs if job.returncode is None]) == 0:
+                self.logWriter.info("waitForConditionedInputSpace : %d chunks (%d bytes) of conditioned input on disk, but all of the jobs using them have failed - not waiting"%(chunk_count, byte_count))
+                break
+
+            if wait_count == 0:
+                self.logWriter.info("waitForConditionedInputSpace : %d chunks (%d bytes) of conditioned input on disk - waiting for jobs to finish before splitting any more"%(chunk_count, byte_count))
+            wait_count += 1
+
+            if poller is None:
+                # start any held jobs, as otherwise we may be waiting on jobs that have not started
+                for retryJob in self.getUnsubmittedJobs():
+                    retryJob.runCommand()
+                time.sleep(CONDITIONED_INPUT_POLL_INTERVAL)
+            elif poller.isAlive():
+                # (the jobs may well have finished while the chunk was being split - so the first time, ask for them
+                # to be polled now)
+                if wait_count == 1:
+                    poller.requestPoll()
+                self.jobsPolled.wait(CONDITIONED_INPUT_POLL_INTERVAL)
+            else:
+                break   # (the poller has stopped - whatever stopped it is raised when it is finished)
+
+        if wait_count > 0:
+            self.logWriter.info("waitForConditionedInputSpace : resuming splitting after %d polls"%wait_count)
+        return
 
 
     @staticmethod
@@ -613,3 +850,5 @@ srun --cpu_bind=v,threads ${SLURM_ARRAY_TASK_ID}
         return (l,d)
 
     
+
+
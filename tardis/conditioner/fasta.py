@@ -49,7 +49,7 @@ class fastaDataConditioner(text.textDataConditioner):
 
         record_count = 0
         for filename in filenames: 
-            if cls.getFileCompressionType(filename) == cls.GZIP:
+            if cls.getFileCompressionType(filename) in (cls.GZIP, cls.BGZF):
                 f = gzip.open(filename, 'rb') 
                 record_count += reduce(lambda x,y:1+x, itertools.ifilter(lambda record: re.search("^\s*>",record) is not None,f), 0)
                 f.close()
@@ -73,7 +73,8 @@ class fastaDataConditioner(text.textDataConditioner):
             with open(arg_filename, "r") as file_list:
                 filenames = [record.strip()  for record in file_list]
 
-        record_count = 0
+        # (use the counts from earlier splits of the same files if we have them)
+        (record_count, filenames) = self.getCachedLogicalRecordCount(filenames)
         for filename in filenames:
             try:
                 count_command = ["kseq_count", "-a" , filename]
@@ -106,7 +106,8 @@ class fastqDataConditioner(text.textDataConditioner):
             with open(arg_filename, "r") as file_list:
                 filenames = [record.strip()  for record in file_list]
 
-        record_count = 0
+        # (use the counts from earlier splits of the same files if we have them)
+        (record_count, filenames) = self.getCachedLogicalRecordCount(filenames)
         for filename in filenames:
             try:
                 count_command = ["kseq_count", "-a" , filename]
@@ -1,7 +1,20 @@
-import re, os , time, subprocess, sys, itertools, gzip
+import re, os , time, subprocess, sys, itertools, gzip, stat, functools, random, struct, zlib, argparse, ast, shutil, signal
 
 global MAX_DIMENSION
 MAX_DIMENSION = 999999 # the maximum number of chunks we will allow  - prevent incoherent chunking options generating huge numbers of fragments
+MERGE_BUFFER_SIZE = 1024 * 1024 # how much of a conditioned output file is appended to the merged output at a time
+
+VIRTUAL_CHUNK_READER_SUFFIX = ".reader"  # a virtual chunk R1.00001.fastq is served by the script R1.00001.fastq.reader
+VIRTUAL_CHUNK_READER_TEMPLATE = """#!/bin/sh
+# tardis virtual chunk reader : serves records %(first_record)d - %(last_record)d (bytes %(start)d - %(end)d) of
+# %(source)s
+# through the named pipe %(chunk)s , and prints the name of the pipe. (If the job finishes without reading the
+# pipe, tardis opens and closes it, so that the writer does not wait for it forever)
+rm -f '%(chunk)s'
+mkfifo '%(chunk)s' || exit 1
+( tail -c +%(tail_start)d '%(source)s' | head -c %(length)d > '%(chunk)s' ) > /dev/null 2>&1 &
+echo '%(chunk)s'
+"""
 
 
 import tardis.conditioner.data as data
@@ -20,6 +33,7 @@ class textDataConditioner(data.dataConditioner):
      
     inFormat="text"
     outFormat="text"
+    targetChunkCount = None # if set, the (estimated) chunksize may be corrected during the split, to yield this many chunks 
     pairBond = lambda cls, x, y : True  # a function which is passed records from paired-up files that should match in some way - return
                                 # True if they match in that way. The default (for matching generic text files) is that
                                 # records should always match - i.e. no checking is done. Subclasses such as
@@ -31,6 +45,7 @@ class textDataConditioner(data.dataConditioner):
     GZIP=0
     ZIP=1
     NO_COMPRESSION = 2
+    BGZF = 3   # blocked gzip (e.g. from bgzip) - a GZIP file made of independent small blocks
 
 
     def __init__(self,inputFileName = None, outputFileName = None, commandConditioning = True, isPaired = False, \
@@ -38,12 +53,19 @@ class textDataConditioner(data.dataConditioner):
         super(textDataConditioner, self).__init__(inputFileName = inputFileName, outputFileName = outputFileName, commandConditioning = commandConditioning , \
                                                   isPaired = isPaired, conditioningPattern = conditioningPattern, conditioningWord = conditioningWord)        
         self.compressionConditioning = compressionConditioning
+        self.mergedOutputCount = 0              # how many of our conditioned output files have been merged (see mergeAvailableOutput)
+        self.finishedOutputFileNames = set()    # conditioned output files that are done, held back until the ones before them are
+        self.mergedOutput = None                # where the output is being merged to
+        self.mergedOutputCompressor = None      # (and the process compressing it, if any)
+        self.conditionedInputSetKey = None      # identifies the input files and how they are split (see getConditionedInputKey)
 
 
     @classmethod
     def getFileCompressionType(cls, filename):
         match = re.search("(.*)\.gz$", filename)
         if match != None:
+            if _is_bgzf(filename):
+                return cls.BGZF
             return cls.GZIP
 
         match = re.search("(.*)\.zip$", filename)
@@ -58,7 +80,10 @@ class textDataConditioner(data.dataConditioner):
         work out the compression, and return a tuple consisting of
         a file over uncompressed data, and the uncompressed filename
         """
-        if cls.getFileCompressionType(filename) == cls.GZIP:
+        if cls.getFileCompressionType(filename) in (cls.GZIP, cls.BGZF):
+            decompression_command = _get_decompression_command(filename)
+            if decompression_command is not None:
+                return ( decompressedFilestream(decompression_command, filename), cls.getUncompressedBaseName(filename))
             return ( gzip.open(filename, 'rb') , cls.getUncompressedBaseName(filename))
         elif cls.getFileCompressionType(filename) == cls.ZIP:
             return ( zipfile.ZipFile(filename, "r"), cls.getUncompressedBaseName(filename))
@@ -77,8 +102,8 @@ class textDataConditioner(data.dataConditioner):
 
         record_count = 0
         for filename in filenames: 
-            if cls.getFileCompressionType(filename) == cls.GZIP:
-                f = gzip.open(filename, 'rb')
+            if cls.getFileCompressionType(filename) in (cls.GZIP, cls.BGZF):
+                (f, uncompressedName) = cls.getUncompressedFilestream(filename)
                 record_count += reduce(lambda x,y:1+x, f, 0)
                 f.close()
             elif cls.getFileCompressionType(filename) == cls.ZIP:
@@ -92,14 +117,86 @@ class textDataConditioner(data.dataConditioner):
         return record_count
         
 
+    def getCachedLogicalRecordCount(self, filenames):
+        """
+        return (the total of the sequence record counts of filenames cached by earlier splits of the same files,
+        the filenames that have no cached count - and so still need to be counted)
+        """
+        record_count = 0
+        uncounted = []
+        for filename in filenames:
+            cached_count = tutils.getCachedRecordCount(self.options, filename, "kseq")
+            if cached_count is None:
+                uncounted.append(filename)
+            else:
+                self.logWriter.info("using cached count of %d records in %s"%(cached_count, filename))
+                record_count += cached_count
+        return (record_count, uncounted)
+
+    def estimateLogicalRecordCount(self, arg_filename):
+        """
+        estimate the logical record count for a file without reading all of it - from the records per byte in 
+        the first few MB of the (uncompressed) stream, and the (uncompressed) size of the file. For gzipped files
+        the uncompressed size is taken from the gzip ISIZE trailer (which is the size modulo 2^32 - the
+        multiple of 2^32 is chosen to agree with the compression ratio seen in the first few MB), or from the
+        compression ratio alone for multi-member files such as BGZF. Falls back to getLogicalRecordCount
+        for anything else (e.g. zip). 
+        """
+        filenames = [arg_filename]
+        if self.isListFile(arg_filename):
+            with open(arg_filename, "r") as file_list:
+                filenames = [record.strip()  for record in file_list]
+
+        record_count = 0
+        if self.inFormat in ("fastq", "fasta"):
+            (record_count, filenames) = self.getCachedLogicalRecordCount(filenames)
+        for filename in filenames:
+            estimate = _estimate_record_count(filename, self.inFormat)
+            if estimate is None:
+                estimate = self.getLogicalRecordCount(filename)
+            record_count += estimate
+
+        self.logWriter.info("estimateLogicalRecordCount estimates there are %d records in %s"%(record_count, arg_filename))
+        return record_count
+
+    def estimateInputSize(self, arg_filename, chunk_by):
+        """
+        estimate the total residues or bytes (chunk_by) of the (uncompressed) input, from those per byte in the first
+        few MB, and the (uncompressed) size of the file - see estimateLogicalRecordCount. Returns None if any of the
+        files can't be estimated (e.g. zip)
+        """
+        filenames = [arg_filename]
+        if self.isListFile(arg_filename):
+            with open(arg_filename, "r") as file_list:
+                filenames = [record.strip()  for record in file_list]
+
+        input_size = 0
+        for filename in filenames:
+            estimate = _estimate_input_size(filename, self.inFormat, chunk_by)
+            if estimate is None:
+                self.logWriter.info("estimateInputSize is unable to estimate the %s in %s"%(chunk_by, filename))
+                return None
+            input_size += estimate
+
+        self.logWriter.info("estimateInputSize estimates there are %d %s in %s"%(input_size, chunk_by, arg_filename))
+        return input_size
+
     @classmethod
     def getFileCompressionCommand(cls, filename):
         return ["gzip", filename]
 
+    @classmethod
+    def getStreamCompressionCommand(cls, filename):
+        """
+        return the command which compresses its standard input , and the name of the file its standard output should
+        go to - so that the result is the same as getFileCompressionCommand
+        """
+        return (["gzip", "-c"], "%s.gz"%filename)
+
 
     @classmethod
     def getUncompressedBaseName(cls, filename):
-        if cls.getFileCompressionType(filename) == cls.GZIP:
+        if cls.getFileCompressionType(filename) in (cls.GZIP, cls.BGZF):
             return os.path.basename(re.search("(.*)\.gz$", filename).groups()[0])
         elif cls.getFileCompressionType(filename) == cls.ZIP:
             return os.path.basename(re.search("(.*)\.zip$", filename).groups()[0])
@@ -147,7 +244,7 @@ class textDataConditioner(data.dataConditioner):
         singly, or else joining them together
         """
 
-        igList = []
+        igStarters = []   # (each of these returns a conditioned input generator when called)
 
         listProcessing = False
 
@@ -171,11 +268,29 @@ class textDataConditioner(data.dataConditioner):
         if (self.options["from_record"] is not None or self.options["to_record"] is not None ) and listProcessing:
             self.logWriter.info("warning - input slicing request ignored as we are processing a listfile")
 
-        # if chunksize is -1, estimate it from the record count of the file
+        # if chunksize is -1, estimate it from the record count of the file. (With adaptive_chunksize, the
+        # record count is only estimated, and - if we can - the splitter corrects the chunksize as it goes) 
         if self.options["chunksize"] < 0:
             self.logWriter.info("calculating chunk size to yield %d tasks from %s"%(self.options["max_tasks"], self.inputFileName))
-            record_count = self.getLogicalRecordCount(self.inputFileName)
+            if self.options.get("adaptive_chunksize", False):
+                record_count = self.estimateLogicalRecordCount(self.inputFileName)
+                if not listProcessing and not self.isPaired:
+                    self.targetChunkCount = self.options["max_tasks"]
+            else:
+                record_count = self.getLogicalRecordCount(self.inputFileName)
             self.options["chunksize"] = max(1, int( .5 + record_count / float( self.options["max_tasks"] )))
+            chunk_by = _get_chunk_by(self, self.inFormat)
+            if chunk_by != "records":
+                # chunks are sized by residues or bytes - (of both files, if paired) 
+                input_size = self.estimateInputSize(self.inputFileName, chunk_by)
+                if input_size is not None and self.isPaired:
+                    partner_size = self.estimateInputSize(self.pairPartner.inputFileName, chunk_by)
+                    input_size = None if partner_size is None else input_size + partner_size
+                if input_size is not None:
+                    self.options["chunksize"] = max(1, int( .5 + input_size / float( self.options["max_tasks"] )))
+                else:
+                    self.logWriter.info("unable to estimate the %s in the input - chunking by records instead"%chunk_by)
+                    self.options["chunk_by"] = "records"
             if self.options["samplerate"] is not None:
 
                 # adjust sample rate upwards if it looks like will obtain less than min_sample_size records
@@ -195,13 +310,13 @@ class textDataConditioner(data.dataConditioner):
                 #print "DEBUG : paired"
                 if self.pairMaster:
                     #print "DEBUG : master"
-                    igList.append( getConditionedFilenames(self,self.inputFileName, self.options["chunksize"], self.workingRoot, informat = self.inFormat, outformat = self.outFormat, \
+                    igStarters.append(functools.partial(getConditionedFilenames, self, self.inputFileName, self.options["chunksize"], self.workingRoot, informat = self.inFormat, outformat = self.outFormat, \
                                                     samplerate = self.options["samplerate"] ,filename2 = self.pairPartner.inputFileName,\
                                                            pairBond = self.pairBond, length_bounds = lengthBounds ,\
                                                            record_filter_func=self.options.get("record_filter_func",None),\
                                                            from_record=self.options["from_record"], to_record=self.options["to_record"]))
             else:        
-                igList.append( getConditionedFilenames(self,self.inputFileName, self.options["chunksize"], self.workingRoot, informat = self.inFormat, outformat = self.outFormat, \
+                igStarters.append(functools.partial(getConditionedFilenames, self, self.inputFileName, self.options["chunksize"], self.workingRoot, informat = self.inFormat, outformat = self.outFormat, \
                                                 samplerate = self.options["samplerate"], length_bounds = lengthBounds, record_filter_func=self.options.get("record_filter_func",None),\
                                                        from_record=self.options["from_record"], to_record=self.options["to_record"]))
         else:
@@ -210,28 +325,103 @@ class textDataConditioner(data.dataConditioner):
                     for (listedpath1,listedpath2) in itertools.izip((self.getListedFilePath(record, self.inputFileName) for record in open(self.inputFileName,"r")) , \
                                                                     (self.getListedFilePath(record, self.pairPartner.inputFileName) for record in open(self.pairPartner.inputFileName,"r"))):
                         #print "DEBUG : %s %s"%(listedpath1,listedpath2)
-                        igList.append(getConditionedFilenames(self,listedpath1, self.options["chunksize"], self.workingRoot, informat = self.inFormat, outformat = self.outFormat, \
+                        igStarters.append(functools.partial(getConditionedFilenames, self, listedpath1, self.options["chunksize"], self.workingRoot, informat = self.inFormat, outformat = self.outFormat, \
                                                     samplerate = self.options["samplerate"] ,filename2 = listedpath2,  pairBond = self.pairBond,\
                                                               listfilename1 = self.inputFileName, listfilename2 = self.pairPartner.inputFileName, length_bounds = lengthBounds,\
                                                               record_filter_func=self.options.get("record_filter_func",None)))
             else:
                 for listedpath in (self.getListedFilePath(record, self.inputFileName) for record in open(self.inputFileName,"r")):
-                    igList.append (getConditionedFilenames(self,listedpath, self.options["chunksize"], self.workingRoot, informat = self.inFormat, outformat = self.outFormat, \
+                    igStarters.append(functools.partial(getConditionedFilenames, self, listedpath, self.options["chunksize"], self.workingRoot, informat = self.inFormat, outformat = self.outFormat, \
                                                 samplerate = self.options["samplerate"], listfilename1 = self.inputFileName, length_bounds = lengthBounds,\
                                                            record_filter_func=self.options.get("record_filter_func",None)))
 
-        # if we have more than one generator, chain them together
-        if len(igList) == 0:
+        # if we have more than one generator, chain them together (splitting several at once if allowed)
+        if len(igStarters) == 0:
             ig = None
-        elif len(igList) == 1:
-            ig = igList[0]
+        elif len(igStarters) == 1:
+            ig = igStarters[0]()
+        elif (self.options.get("max_split_processes", None) or 1) > 1 and not tutils.isConditionedInputThrottled(self.options):
+            self.logWriter.info("chaining together %d conditioned input generators (splitting up to %d files at a time)"%(len(igStarters), self.options["max_split_processes"]))
+            ig = _parallel_chain(self, igStarters, self.options["max_split_processes"])
         else:
-            self.logWriter.info("chaining together %d conditioned input generators"%len(igList))
-            ig = itertools.chain(*igList)
+            self.logWriter.info("chaining together %d conditioned input generators"%len(igStarters))
+            ig = itertools.chain(*[start() for start in igStarters])
+
+        # unless the chunks depend on a random sample or a record filter, identify them by the identity of the input
+        # files and how they are split - so that they (and the results of jobs run on them) can be re-used by later sessions
+        if ig is not None and self.options.get("record_filter_func", None) is None and \
+                    (self.options["samplerate"] is None or self.options.get("sample_seed", None) is not None):
+            inputFileNames = [self.inputFileName] + ([self.pairPartner.inputFileName] if self.isPaired else [])
+            if listProcessing:
+                inputFileNames += [self.getListedFilePath(record, inputFileName) for inputFileName in inputFileNames for record in open(inputFileName,"r")]
+            # (BGZF input split in parallel has a partial chunk at the end of each range)
+            bgzfRanges = self.options.get("max_split_processes", None) if self.getFileCompressionType(self.inputFileName) == self.BGZF else None
+            parameters = (type(self).__name__, self.inFormat, self.outFormat, self.options["chunksize"], _get_chunk_by(self, self.inFormat), \
+                          self.options["samplerate"], self.options.get("sample_seed", None), self.options["from_record"], self.options["to_record"], \
+                          lengthBounds, bool(self.options.get("compress_chunks", False)), self.targetChunkCount, \
+                          bool(self.options["fast_sequence_input_conditioning"]), bgzfRanges)
+            self.conditionedInputSetKey = tutils.getFileIdentityKey(inputFileNames, parameters)
+            if self.isPaired:
+                self.pairPartner.conditionedInputSetKey = self.conditionedInputSetKey
 
+        # if the same input has been conditioned in the same way by an earlier session, re-use its chunks
+        if ig is not None and self.isChunkCacheable():
+            ig = self.getCachedConditionedInputGenerator(ig, self.conditionedInputSetKey)
         
         return ig
 
+    def isChunkCacheable(self):
+        """
+        return True if chunks are cached (chunk_cache_size), and can be for this run - i.e. not if the
+        chunks are virtual, can't be identified (see getConditionedInputGenerator), or are removed as the run goes
+        """
+        return tutils.isCacheEnabled(self.options, tutils.CHUNK_CACHE) and not self.options.get("virtual_chunks", False) and \
+               self.conditionedInputSetKey is not None and not tutils.isConditionedInputThrottled(self.options)
+
+    def getConditionedInputKey(self, fileName):
+        """
+        a chunk is identified by the identity of the input and how it was split, and the name of the chunk (its
+        place in the split) - so neither the chunk nor the input need to be read
+        """
+        if self.conditionedInputSetKey is None or fileName is None:
+            return None
+        return "%s:%s"%(self.conditionedInputSetKey, os.path.basename(fileName))
+
+    def getCachedConditionedInputGenerator(self, ig, cachekey):
+        """
+        if the chunks for cachekey are in the chunk cache under rootdir, link them into the working folder and
+        return a generator of them (ig is not used). Otherwise return a generator which passes on the chunks
+        from ig, and - if they are all conditioned OK - adds them to the cache
+        """
+        entrydir = tutils.getCacheEntry(self.options, tutils.CHUNK_CACHE, cachekey)
+        if entrydir is not None:
+            cachedInputs = []
+            try:
+                with open(os.path.join(entrydir, tutils.CACHE_MANIFEST), "r") as manifest:
+                    for record in manifest:
+                        (inputNames, chunkNames) = ast.literal_eval(record.strip())
+                        chunks = [None if chunkName is None else os.path.join(self.workingRoot, chunkName) for chunkName in chunkNames]
+                        cachedInputs.append((inputNames, chunks))
+                        for (chunkName, chunk) in zip(chunkNames, chunks):
+                            if chunkName is not None:
+                                tutils.linkOrCopy(os.path.join(entrydir, chunkName), chunk)
+            except (IOError, OSError, ValueError, SyntaxError), e:
+                # (e.g. evicted by another session as we were reading it) - just condition the input as usual
+                self.logWriter.info("unable to re-use cached chunks in %s (%s) - conditioning input as usual"%(entrydir, str(e)))
+                for (inputNames, chunks) in cachedInputs:
+                    for chunk in chunks:
+                        if chunk is not None and os.path.lexists(chunk):
+                            os.remove(chunk)
+            else:
+                self.logWriter.info("re-using %d cached chunks from %s"%(len(cachedInputs), entrydir))
+                return iter(cachedInputs)
+
+        stagingdir = tutils.getCacheStagingDir(self.options, tutils.CHUNK_CACHE, cachekey)
+        if stagingdir is None:
+            return ig
+        self.logWriter.info("chunks will be added to the chunk cache (key %s)"%cachekey)
+        return _cache_conditioned_filenames(self, ig, cachekey, stagingdir)
+
                     
 
     def nextConditionedInputWord(self):
@@ -247,11 +437,127 @@ class textDataConditioner(data.dataConditioner):
                 word = super(textDataConditioner, self).nextConditionedInputWord(self.conditioningWord)                        
             else:
                 self.logWriter.info("DEBUG : %s is splicing %s into %s using pattern %s"%(self, self.conditionedInputFileNames[-1], self.conditioningWord, self.conditioningPattern))                    
-                word = re.sub(self.conditioningPattern, self.conditionedInputFileNames[-1], self.conditioningWord) 
+                word = re.sub(self.conditioningPattern, self.getConditionedInputReference(self.conditionedInputFileNames[-1]), self.conditioningWord) 
 
         return word
+
+
+    def isConditionedInputAvailable(self, fileName):
+        """
+        a virtual chunk is never there between jobs - only its reader script
+        """
+        return os.path.exists(fileName) or os.path.isfile(fileName + VIRTUAL_CHUNK_READER_SUFFIX)
+
+    def getConditionedInputReference(self, conditionedInputFileName):
+        """
+        return what should be spliced into the command to refer to a conditioned input. This is normally
+        just the chunk filename - however a virtual chunk (see _virtual_get_conditioned_filenames) does
+        not exist until its reader script is run by the job, so for these we splice in a command
+        substitution which runs the reader and yields the (named pipe) chunk filename
+        """
+        readerName = conditionedInputFileName + VIRTUAL_CHUNK_READER_SUFFIX
+        if self.options.get("virtual_chunks", False) and os.path.isfile(readerName):
+            return "$(%s)"%readerName
+        return conditionedInputFileName
+
+
+    def releaseConditionedInput(self, fileName):
+        """
+        the writer started by a virtual chunk's reader script waits to open the named pipe until the job opens it to
+        read - so if the job finished (e.g. failed) without reading its chunk, the writer would be left waiting. This
+        opens and closes the pipe, so that the writer goes on to write to it and exits (on SIGPIPE), then removes the pipe
+        (if the job is run again, its reader makes a new one)
+        """
+        if fileName is None:
+            return
+        safeFileName = os.path.join(self.workingRoot, os.path.basename(fileName))
+        try:
+            if stat.S_ISFIFO(os.lstat(safeFileName).st_mode):
+                os.close(os.open(safeFileName, os.O_RDONLY | os.O_NONBLOCK))
+                os.remove(safeFileName)
+        except OSError:
+            pass
+
+    def removeConditionedInput(self, fileNames = None):
+        """
+        remove the conditioned input (or just the files in fileNames) - and for virtual chunks, the reader scripts
+        """
+        if fileNames is None:
+            fileNames = self.conditionedInputFileNames
+        for fileName in fileNames:
+            self.releaseConditionedInput(fileName)
+        super(textDataConditioner, self).removeConditionedInput(fileNames)
+        for fileName in fileNames:
+            safeReaderName = os.path.join(self.workingRoot, os.path.basename(fileName) + VIRTUAL_CHUNK_READER_SUFFIX)
+            if os.path.isfile(safeReaderName):
+                self.logWriter.info("textDataConditioner : removing %s"%safeReaderName)
+                os.remove(safeReaderName)
         
 
+    def isOutputPipelined(self):
+        """
+        our output can be merged as the jobs finish if it is a simple concatenation , in order , of conditioned output
+        files that are known in advance - i.e. not products found by pattern , and not merged some other way by a subclass
+        """
+        return type(self).unconditionOutput.__func__ is textDataConditioner.unconditionOutput.__func__ and \
+               len(self.conditionedProductPatterns) == 0 and self.outputFileName is not None
+
+    def mergeAvailableOutput(self, fileName):
+        """
+        fileName (one of our conditioned output files) is done - append it, and any files after it which were done
+        first and so held back , to the output (compressing it as we go if required). This overlaps merging the output
+        with the jobs that are still running - unconditionOutput then only has to finish off
+        """
+        self.finishedOutputFileNames.add(fileName)
+        while self.mergedOutputCount < len(self.conditionedOutputFileNames):
+            file_to_process = self.conditionedOutputFileNames[self.mergedOutputCount]
+            if file_to_process is not None:
+                # (a missing file is left for unconditionOutput to report)
+                if file_to_process not in self.finishedOutputFileNames or not os.path.isfile(file_to_process):
+                    break
+                if self.mergedOutput is None:
+                    self.logWriter.info("textDataConditioner : merging conditioned output to %s as the jobs finish"%self.outputFileName)
+                    if self.compressionConditioning:
+                        (compressionCommand, compressedFileName) = self.getStreamCompressionCommand(self.outputFileName)
+                        self.logWriter.info("executing %s > %s"%(str(compressionCommand), compressedFileName))
+                        with open(compressedFileName, "w") as compressed_stream:
+                            self.mergedOutputCompressor = subprocess.Popen(compressionCommand, stdin=subprocess.PIPE, stdout=compressed_stream)
+                        self.mergedOutput = self.mergedOutputCompressor.stdin
+                    else:
+                        # (unbuffered, so that processes forked while the output is open do not inherit unwritten output)
+                        self.mergedOutput = open(self.outputFileName, "w", 0)
+                self.appendMergedOutput(file_to_process)
+                self.finishedOutputFileNames.discard(file_to_process)
+            self.mergedOutputCount += 1
+
+    def appendMergedOutput(self, fileName):
+        """
+        append conditioned output file fileName to the output being merged as the jobs finish
+        """
+        with open(fileName,"r") as in_stream:
+            shutil.copyfileobj(in_stream, self.mergedOutput, MERGE_BUFFER_SIZE)
+
+    def getMergedOutputTrailer(self):
+        """
+        return what goes at the end of the merged output, after all of the files - nothing, for text
+        """
+        return ""
+
+    def closeMergedOutput(self):
+        """
+        finish off the output merged as the jobs finished - append any files that were not, and close it
+        """
+        self.logWriter.info("textDataConditioner : %d conditioned files were merged as the jobs finished"%self.mergedOutputCount)
+        for file_to_process in [filename for filename in self.conditionedOutputFileNames[self.mergedOutputCount:] if filename != None]:
+            self.appendMergedOutput(file_to_process)
+        self.mergedOutput.write(self.getMergedOutputTrailer())
+        self.mergedOutput.close()
+        if self.mergedOutputCompressor is not None:
+            self.mergedOutputCompressor.wait()
+            self.logWriter.info("textDataConditioner : file compression returned  ( return code %s )"%self.mergedOutputCompressor.returncode)
+            if self.mergedOutputCompressor.returncode != 0:
+                self.error("compression of concatenated files appears to have failed - setting error state")
+
     def unconditionOutput(self):
         """
         this class method coordinates unconditioning - i.e. "joining back together"
@@ -269,6 +575,11 @@ class textDataConditioner(data.dataConditioner):
         to
         %s"""%(str(filesToProcess), self.outputFileName))
 
+        if self.mergedOutput is not None:
+            # the output has been merged as the jobs finished - finish off with any files that were not
+            self.closeMergedOutput()
+            return
+
         fileout = open( self.outputFileName, "w" )
         for file_to_process in filesToProcess:
             with open(file_to_process,"r") as in_stream:
@@ -295,21 +606,304 @@ class textDataConditioner(data.dataConditioner):
 
 
 
+ESTIMATE_SAMPLE_BYTES = 4 * 1024 * 1024   # how much of the (uncompressed) input to read when estimating record counts
+
+def _sample_input(filename):
+    """
+    return (the first few MB of the uncompressed input - up to the end of the last complete line, and the
+    estimated uncompressed size of the input) - or None if the file can't be sampled (see
+    textDataConditioner.estimateLogicalRecordCount)
+    """
+    compression = textDataConditioner.getFileCompressionType(filename)
+    file_size = os.path.getsize(filename)
+    if compression == textDataConditioner.NO_COMPRESSION:
+        with open(filename, "rb") as f:
+            prefix = f.read(ESTIMATE_SAMPLE_BYTES)
+        uncompressed_size = file_size
+    elif compression in (textDataConditioner.GZIP, textDataConditioner.BGZF):
+        with open(filename, "rb") as f:
+            compressed_prefix = f.read(ESTIMATE_SAMPLE_BYTES / 4)
+            f.seek(-4, 2)
+            isize = struct.unpack("<I", f.read(4))[0]
+        decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+        prefix = decompressor.decompress(compressed_prefix, ESTIMATE_SAMPLE_BYTES)
+        compressed_used = len(compressed_prefix) - len(decompressor.unconsumed_tail) - len(decompressor.unused_data)
+        if len(prefix) == 0 or compressed_used == 0:
+            return None
+        ratio_size = file_size * len(prefix) / float(compressed_used)
+        uncompressed_size = isize + 2**32 * max(0, int(.5 + (ratio_size - isize) / 2**32))
+        if len(decompressor.unused_data) > 0 or not (.75 < uncompressed_size / ratio_size < 1.33):
+            # multi-member file (e.g. BGZF) - the trailer only gives the size of the last member. (If the first member
+            # is bigger than our sample, we can only tell this from the trailer disagreeing with the compression ratio)
+            uncompressed_size = ratio_size
+    else:
+        return None
+
+    # only use complete lines
+    return (prefix[0:prefix.rfind("\n") + 1], uncompressed_size)
+
+
+def _estimate_record_count(filename, informat):
+    """
+    see textDataConditioner.estimateLogicalRecordCount - returns None if the file can't be estimated
+    """
+    sample = _sample_input(filename)
+    if sample is None:
+        return None
+    (prefix, uncompressed_size) = sample
+    sample_size = len(prefix)
+    if sample_size == 0:
+        return 1
+    if informat == "fastq":
+        sample_records = prefix.count("\n", 0, sample_size) / 4.0
+    elif informat == "fasta":
+        sample_records = prefix.count("\n>", 0, sample_size) + (1 if prefix.startswith(">") else 0)
+    else:
+        sample_records = prefix.count("\n", 0, sample_size)
+
+    return max(1, int(.5 + max(1, sample_records) * uncompressed_size / float(sample_size)))
+
+
+def _estimate_input_size(filename, informat, chunk_by):
+    """
+    see textDataConditioner.estimateInputSize - returns None if the file can't be estimated
+    """
+    sample = _sample_input(filename)
+    if sample is None:
+        return None
+    (prefix, uncompressed_size) = sample
+    if chunk_by == "bytes" or len(prefix) == 0:
+        return max(1, int(uncompressed_size))
+
+    # residues per byte of the sample
+    lines = prefix.split("\n")
+    if informat == "fastq":
+        residues = sum(len(line.rstrip("\r")) for line in lines[1::4])
+    else:
+        residues = sum(len(line.rstrip("\r")) for line in lines if not line.startswith(">"))
+    return max(1, int(.5 + residues * uncompressed_size / float(len(prefix))))
+
+
+def _get_sample_seed(caller):
+    """
+    return the seed to use for sampling - from the sample_seed option (so that the sample is reproducible), or 
+    else drawn at random (and logged, so that the sample can be reproduced)
+    """
+    sample_seed = caller.options.get("sample_seed", None)
+    if sample_seed is None:
+        sample_seed = random.SystemRandom().randint(1, 2**31 - 1)
+    caller.logWriter.info("sampling using seed %d"%sample_seed)
+    return sample_seed
+
+
+def _get_chunk_by(caller, informat):
+    """
+    return how chunks of informat are sized - records, residues or bytes (the latter two only apply to
+    fasta and fastq)
+    """
+    if informat in ("fasta", "fastq"):
+        return caller.options.get("chunk_by", None) or "records"
+    return "records"
+
+
+def _cache_conditioned_filenames(caller, ig, cachekey, stagingdir):
+    """
+    A generator - passes on the chunks yielded by ig, hard-linking each one into stagingdir as it goes. If all
+    of the input is conditioned without error, the staged chunks become the chunk cache entry for cachekey
+    """
+    caching = True
+    cached = False
+    manifest = []
+    try:
+        for (inputNames, chunks) in ig:
+            if caching:
+                try:
+                    for chunk in chunks:
+                        if chunk is not None:
+                            os.link(chunk, os.path.join(stagingdir, os.path.basename(chunk)))
+                    manifest.append(repr((inputNames, [None if chunk is None else os.path.basename(chunk) for chunk in chunks])))
+                except OSError, e:
+                    caller.logWriter.info("unable to cache chunk (%s) - not caching the chunks of this input"%str(e))
+                    caching = False
+            yield (inputNames, chunks)
+
+        if caching and caller.state == data.dataConditioner.OK:
+            with open(os.path.join(stagingdir, tutils.CACHE_MANIFEST), "w") as m:
+                for record in manifest:
+                    print >> m, record
+            tutils.addCacheEntry(caller.options, tutils.CHUNK_CACHE, cachekey, stagingdir)
+            caller.logWriter.info("added %d chunks to the chunk cache (key %s)"%(len(manifest), cachekey))
+            cached = True
+    finally:
+        if not cached:
+            shutil.rmtree(stagingdir, ignore_errors = True)
+
+def _parallel_chain(caller, starters, max_processes):
+    """
+    A generator.
+    Equivalent to itertools.chain(*[start() for start in starters]) , but while the chunks of one file are being yielded,
+    the splits of up to (max_processes - 1) of the following files are started ahead of it. These run in their own
+    processes (kseq_split, or split workers - see _split_worker), each reporting its chunks on a pipe as it completes them,
+    so that there are chunks waiting when we get to it. (A split that runs in this process - e.g.
+    _slow_get_conditioned_filenames - can't run ahead, so just runs in its turn.) Chunks are always yielded in the same
+    order as itertools.chain would yield them.
+    """
+    splits = {}  # index in starters -> started conditioned filename generator
+    try:
+        for index in range(0, len(starters)):
+            # keep up to max_processes files being split
+            for ahead in range(index, min(index + max_processes, len(starters))):
+                if ahead not in splits:
+                    splits[ahead] = starters[ahead](started = True)
+
+            for chunkInfo in splits.pop(index):
+                yield chunkInfo
+    finally:
+        # if we were abandoned early, stop the splits we started ahead 
+        for ig in splits.values():
+            ig.close()
+
+
+def _start_split(ig, started):
+    """
+    ig is the generator of a split run by separate processes (kseq_split, or split workers - see _split_worker), which
+    yields None once it has started them, before any chunks. If started, advance ig to there now - so that the split
+    goes on in the background while the caller does other things (see _parallel_chain) - and return it. Otherwise
+    return a generator of its chunks, which starts the split when it is first asked for one
+    """
+    if started:
+        next(ig, None)   # (the split may also have finished - e.g. if it could not be started)
+        return ig
+    return itertools.islice(ig, 1, None)
+
+
+def _start_split_process(caller, split_command, split_logfile, flow_control = False):
+    """
+    start a split process (kseq_split -p, or a split worker - see _split_worker), which reports each chunk
+    on its stdout as it is completed. With flow_control, the split waits for a byte on its stdin before starting
+    each chunk after the first (see _resume_split_processes)
+    """
+    try:
+        with open(split_logfile,"a") as l:
+            caller.logWriter.info("starting split process : %s"%" ".join(split_command))
+            # (close_fds, so that a split does not hold open the pipes of other splits running alongside it)
+            proc = subprocess.Popen(split_command, stdout=subprocess.PIPE, stderr=l, stdin=subprocess.PIPE if flow_control else None, \
+                                    close_fds=True, env=_get_split_environment())
+            print >> l, "started split subprocess %d : %s"%(proc.pid, " ".join(split_command))
+    except OSError,e:
+        caller.logWriter.info("error - start of %s failed with OSError : %s"%(" ".join(split_command), e))
+        raise tutils.tardisException("error - start of %s failed with OSError : %s"%(" ".join(split_command), e))
+    return proc
+
+
+def _next_split_chunk(caller, proc, split_command, filename):
+    """
+    read the events reported by a split process up to its next completed chunk, returning (the name of the chunk,
+    the digest of its read names if reported) - or (None, None) when the split has finished
+    """
+    digest = None
+    # (readline rather than iterating the pipe, as file iteration reads ahead)
+    for record in iter(proc.stdout.readline, ""):
+        (key, value) = record.strip().split("=",1)
+        if key == "chunk":
+            return (value, digest)
+        elif key == "chunk_name_digest":
+            digest = value
+        elif key == "chunk_number":
+            caller.logWriter.info("%s chunks in total were written by %s"%(value, " ".join(split_command)))
+        elif key == "input_record_count":
+            # the split has counted the whole file - cache this, so that a later session
+            # can skip getLogicalRecordCount
+            tutils.setCachedRecordCount(caller.options, filename, "kseq", int(value))
+        elif key == "error":
+            caller.error("error splitting %s : %s"%(filename, value))
+    return (None, None)
+
+
+def _resume_split_processes(split_procs):
+    """
+    let split processes started with flow_control go on to their next chunk
+    """
+    for proc in split_procs:
+        try:
+            proc.stdin.write("\n")
+            proc.stdin.flush()
+        except IOError:
+            pass    # (it has finished)
+
+
+def _reap_split_processes(caller, split_procs, split_commands, split_logfile):
+    """
+    reap split processes - stopping any still running (e.g. if the split is abandoned early) - logging how each
+    ended, and setting the error state if any failed (including being killed by a signal - other than as a result of
+    being stopped)
+    """
+    with open(split_logfile,"a") as l:
+        for (proc, split_command) in zip(split_procs, split_commands):
+            if proc.stdin is not None:
+                proc.stdin.close()
+            stopped = False
+            if proc.poll() is None:
+                proc.stdout.close()
+                proc.terminate()
+                stopped = True
+            proc.wait()
+            proc.stdout.close()
+            print >> l, "split subprocess %d terminated with return value %d"%(proc.pid, proc.returncode)
+            # (one that is stopped ends on SIGTERM - or SIGPIPE, if it writes to its stdout first)
+            if proc.returncode > 0 or (proc.returncode < 0 and not (stopped and -proc.returncode in (signal.SIGTERM, signal.SIGPIPE))):
+                caller.error("error - %s terminated with return value %d (see %s)"%(" ".join(split_command), proc.returncode, split_logfile))
+
+
 def getConditionedFilenames(caller, filename1, argchunksize, outdir, informat = "text", outformat = "text", samplerate = None ,filename2=None,  pairBond = None,\
-                            listfilename1 = None, listfilename2 = None, length_bounds = (None,None), record_filter_func=None, from_record = None, to_record = None):
+                            listfilename1 = None, listfilename2 = None, length_bounds = (None,None), record_filter_func=None, from_record = None, to_record = None, \
+                            started = False):
     """
-    return a generator of filenames. 
+    return a generator of filenames. If started, a split that runs in separate processes is started now, rather
+    than when the generator is first asked for a chunk (see _start_split)
     """
+
+    chunk_by = _get_chunk_by(caller, informat)
+
+    if caller.options.get("virtual_chunks", False):
+        if informat == outformat and not caller.options.get("compress_chunks", False) and chunk_by == "records" and samplerate is None and record_filter_func is None and length_bounds == (None,None) and \
+                    textDataConditioner.getFileCompressionType(filename1) == textDataConditioner.NO_COMPRESSION and \
+                    (filename2 is None or textDataConditioner.getFileCompressionType(filename2) == textDataConditioner.NO_COMPRESSION):
+            caller.logWriter.info("*** getConditionedFilenames: using virtual chunks ***")
+            return _virtual_get_conditioned_filenames(caller, filename1, argchunksize, outdir, informat, filename2, pairBond,\
+                            listfilename1, listfilename2, from_record, to_record)
+        else:
+            caller.logWriter.info("""
+*** getConditionedFilenames: virtual chunks requested but input is compressed, or needs format conversion, sampling, record_filter_func, length_bounds, compressed chunks or chunk_by, so writing chunk files ***
+""")
     
+    if (caller.options.get("max_split_processes", None) or 1) > 1 and not tutils.isConditionedInputThrottled(caller.options) and \
+                filename2 is None and chunk_by == "records" and informat == outformat and informat in ("text", "fastq", "fasta") and \
+                samplerate is None and record_filter_func is None and from_record is None and to_record is None and length_bounds == (None,None) and \
+                textDataConditioner.getFileCompressionType(filename1) == textDataConditioner.BGZF:
+        caller.logWriter.info("*** getConditionedFilenames: input is BGZF - splitting block ranges in parallel ***")
+        return _start_split(_bgzf_get_conditioned_filenames(caller, filename1, argchunksize, outdir, informat, listfilename1, caller.options["max_split_processes"]), started)
+
+    if informat == "text" and outformat == "text" and filename2 is None and samplerate is None and record_filter_func is None and \
+                from_record is None and to_record is None and length_bounds == (None,None):
+        caller.logWriter.info("*** getConditionedFilenames: using block text conditioning ***")
+        return _start_split(_block_get_conditioned_filenames(caller, filename1, argchunksize, outdir, listfilename1), started)
+
     if caller.options["fast_sequence_input_conditioning"] and informat in ("fastq", "fasta"):
-        if record_filter_func is None and from_record is None and to_record is None and length_bounds == (None,None) and \
-                    not(filename2 is not None and samplerate is not None)  :
-            caller.logWriter.info("*** getConditionedFilenames: using fast input conditioning. Note: pairBond ignored***")
-            return _fast_get_conditioned_filenames(caller, filename1, argchunksize, outdir, informat, outformat, samplerate,filename2,\
-                            listfilename1, listfilename2, length_bounds, from_record, to_record)
+        if filename2 is not None and chunk_by != "records":
+            # (the files of a pair are split independently by the fast conditioner, so would be cut at different records) 
+            caller.logWriter.info("""
+*** getConditionedFilenames: fast input conditioning requested but paired input is chunked by %s, so using standard conditioning ***
+"""%chunk_by)
+        elif record_filter_func is None and from_record is None and to_record is None and length_bounds == (None,None):
+            caller.logWriter.info("*** getConditionedFilenames: using fast input conditioning ***")
+            if filename2 is not None and pairBond is not None:
+                caller.logWriter.info("(pairBond ignored - pairs are checked by chunk read name digests)")
+            return _start_split(_fast_get_conditioned_filenames(caller, filename1, argchunksize, outdir, informat, outformat, samplerate,filename2,\
+                            listfilename1, listfilename2, length_bounds, from_record, to_record), started)
         else:
             caller.logWriter.info("""
-*** getConditionedFilenames: fast input conditioning requested but either record_filter_func, from_record, to_record or length_bounds specified, or paired sampling requested, so using standard conditioning ***
+*** getConditionedFilenames: fast input conditioning requested but either record_filter_func, from_record, to_record or length_bounds specified, so using standard conditioning ***
 """)
             return _slow_get_conditioned_filenames(caller, filename1, argchunksize, outdir, informat, outformat, samplerate,filename2,  pairBond,\
                             listfilename1, listfilename2, length_bounds, record_filter_func, from_record, to_record)
@@ -317,8 +911,762 @@ def getConditionedFilenames(caller, filename1, argchunksize, outdir, informat =
 
     return _slow_get_conditioned_filenames(caller, filename1, argchunksize, outdir, informat, outformat, samplerate,filename2,  pairBond,\
                             listfilename1, listfilename2, length_bounds, record_filter_func, from_record, to_record)
-                 
-        
+
+
+DECOMPRESSORS = (["pigz", "-dc"], ["gzip", "-dc"])   # in order of preference
+DECOMPRESSION_BUFFER_SIZE = 1024 * 1024
+
+def _get_decompression_command(filename):
+    """
+    return a command to decompress filename to stdout using the first of DECOMPRESSORS that is
+    installed - or None if none of them are
+    """
+    for decompressor in DECOMPRESSORS:
+        for path in os.environ.get("PATH", "").split(os.pathsep):
+            if os.access(os.path.join(path, decompressor[0]), os.X_OK):
+                return decompressor + [filename]
+    return None
+
+
+class decompressedFilestream(object):
+    """
+    A read-only file-like object over the output of an external decompressor. This means that decompression
+    runs in a separate process, concurrently with whatever is parsing the data, (up to a pipe buffer ahead of
+    it), rather than in the same thread. 
+
+    Closing the stream reaps the decompressor - if the whole stream was read, and the decompressor
+    failed (e.g. the input was truncated or corrupt), close raises IOError, as reading a gzip.open stream
+    would have. 
+    """
+    def __init__(self, command, filename):
+        super(decompressedFilestream, self).__init__()
+        self.command = command
+        self.name = filename
+        self.proc = subprocess.Popen(command, stdout=subprocess.PIPE, stderr=subprocess.PIPE, bufsize=DECOMPRESSION_BUFFER_SIZE)
+
+    def __getattr__(self, name):
+        # read, readline etc. are those of the pipe 
+        return getattr(self.proc.stdout, name)
+
+    def __iter__(self):
+        return iter(self.proc.stdout)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def close(self):
+        if self.proc.stdout.closed:
+            return
+        finished = self.proc.stdout.read(1) == ""
+        self.proc.stdout.close()
+        if not finished:
+            # abandoned early - (this is not an error)
+            self.proc.kill()
+        stderr = self.proc.stderr.read()
+        self.proc.stderr.close()
+        self.proc.wait()
+        if finished and self.proc.returncode != 0:
+            raise IOError("%s failed with return value %d : %s"%(" ".join(self.command), self.proc.returncode, stderr.strip()))
+
+
+BGZF_HEADER_SIZE = 18      # a BGZF block header (a gzip header with a single 6 byte "BC" extra subfield)
+
+def _is_bgzf(filename):
+    """
+    return True if filename is a BGZF file - i.e. its first gzip member has an extra field holding a
+    "BC" subfield (which gives the size of the block). Returns False if the file can't be read (e.g. it is
+    an output name that does not exist yet)
+    """
+    try:
+        with open(filename, "rb") as f:
+            header = f.read(BGZF_HEADER_SIZE)
+    except IOError:
+        return False
+    return len(header) == BGZF_HEADER_SIZE and header[0:4] == "\x1f\x8b\x08\x04" and header[12:16] == "BC\x02\x00"
+
+
+def _read_bgzf_block_size(f, offset, filename):
+    """
+    return the size of the BGZF block at offset of open file f, from its header - or None at the end of the
+    file. Raises ValueError if there is not a valid BGZF block header there
+    """
+    f.seek(offset)
+    header = f.read(12)
+    if len(header) == 0:
+        return None
+    if len(header) < 12 or header[0:4] != "\x1f\x8b\x08\x04":
+        raise ValueError("%s : invalid BGZF block header at offset %d"%(filename, offset))
+    (xlen,) = struct.unpack("<H", header[10:12])
+    extra = f.read(xlen)
+    i = 0
+    while i + 4 <= len(extra):
+        (slen,) = struct.unpack("<H", extra[i+2:i+4])
+        if extra[i:i+2] == "BC" and slen == 2:
+            (bsize,) = struct.unpack("<H", extra[i+4:i+6])
+            return bsize + 1
+        i += 4 + slen
+    raise ValueError("%s : no BGZF block size at offset %d"%(filename, offset))
+
+
+def _get_bgzf_blocks(filename):
+    """
+    return a list of (offset, size) of each block of a BGZF file. This only reads the block headers (seeking
+    past the compressed data), so is quick. Raises ValueError if a block header is not a valid BGZF header
+    """
+    blocks = []
+    with open(filename, "rb") as f:
+        offset = 0
+        block_size = _read_bgzf_block_size(f, offset, filename)
+        while block_size is not None:
+            blocks.append((offset, block_size))
+            offset += block_size
+            block_size = _read_bgzf_block_size(f, offset, filename)
+    return blocks
+
+
+def _inflate_bgzf_block(f, block):
+    """
+    return the decompressed data of a BGZF block (given as (offset, size)) of open file f 
+    """
+    f.seek(block[0])
+    return zlib.decompress(f.read(block[1]), 16 + zlib.MAX_WBITS)
+
+
+def _find_bgzf_record_start(f, blocks, block_index, informat):
+    """
+    return (block index, offset) of the first record start at or after the start of block block_index,
+    looking no further than the block after it - or None if none is found. Only the blocks around the
+    start are decompressed.
+
+    fastq records are assumed to be 4 lines (a header line starting with @ is only taken to be one
+    if the next but one line starts with + and the sequence and quality lines are the same length)
+    """
+    previous = _inflate_bgzf_block(f, blocks[block_index-1]) if block_index > 0 else ""
+    data = _inflate_bgzf_block(f, blocks[block_index])
+    following = _inflate_bgzf_block(f, blocks[block_index+1]) if block_index + 1 < len(blocks) else ""
+    at_line_start = previous == "" or previous.endswith("\n")
+    buf = data + following
+
+    start = None
+    if informat == "fasta":
+        # (the "\n" prefix shifts the index of each "\n>" to that of the record start)
+        start = (("\n" if at_line_start else "x") + buf).find("\n>")
+        if start < 0:
+            start = None
+    else:
+        line_start = 0 if at_line_start else buf.find("\n") + 1
+        while line_start > 0 or (line_start == 0 and at_line_start):
+            if informat != "fastq":
+                start = line_start
+                break
+            lines = buf[line_start:].split("\n", 4)
+            if len(lines) < 5:
+                break
+            if lines[0].startswith("@") and lines[2].startswith("+") and len(lines[1].rstrip("\r")) == len(lines[3].rstrip("\r")):
+                start = line_start
+                break
+            line_start = buf.find("\n", line_start) + 1
+            at_line_start = False
+
+    if start is None or start >= len(buf):
+        return None
+    elif start < len(data):
+        return (block_index, start)
+    else:
+        return (block_index + 1, start - len(data))
+
+
+def _read_bgzf_range(filename, start, end):
+    """
+    A generator.
+    yield the decompressed data of a BGZF file, block by block, from start up to (not including) end - these are
+    (file offset of a block, offset in the decompressed block) - end None means the end of the file. Raises ValueError
+    if a block header is not a valid BGZF header
+    """
+    with open(filename, "rb") as f:
+        offset = start[0]
+        while end is None or offset < end[0] or (offset == end[0] and end[1] > 0):
+            block_size = _read_bgzf_block_size(f, offset, filename)
+            if block_size is None:
+                break
+            f.seek(offset)
+            data = zlib.decompress(f.read(block_size), 16 + zlib.MAX_WBITS)
+            low = start[1] if offset == start[0] else 0
+            high = end[1] if end is not None and offset == end[0] else len(data)
+            if high > low:
+                yield data[low:high]
+            offset += block_size
+
+
+def _split_data_blocks(data_blocks, chunksize, informat, chunktemplate, open_chunk):
+    """
+    A generator.
+    split data (an iterable of blocks of uncompressed data, starting with a record) into chunks of chunksize records,
+    yielding the name of each chunk as it is completed. Record boundaries are found by bulk counting of newlines
+    (text, fastq - assumed 4 lines per record) or of "\\n>" (fasta) in each block, and the records of a block that
+    belong to the same chunk are written with a single write - so only the block in which a chunk ends is searched
+    record by record. Raises tardisException if a chunk already exists
+    """
+    chunk = 0
+    chunkname = None
+    outfile = None
+    count = 0            # newlines (text, fastq) or record starts (fasta) written to the current chunk
+    previous = "\n"      # (the data starts with a record)
+    limit = chunksize * (4 if informat == "fastq" else 1)
+    for data in data_blocks:
+        scan = previous + data      # (for fasta, scan[i:i+2] == "\n>" <=> a record starts at data[i])
+        pos = 0
+        while pos < len(data):
+            if outfile is None:
+                chunk += 1
+                chunkname = chunktemplate%chunk
+                if os.path.exists(chunkname):
+                    raise tutils.tardisException("error - %s already exists"%chunkname)
+                outfile = open_chunk(chunkname)
+                count = 0
+
+            split = None
+            if informat == "fasta":
+                starts = scan.count("\n>", pos)
+                if count + starts > chunksize:
+                    split = pos - 1
+                    for i in xrange(chunksize - count + 1):
+                        split = scan.index("\n>", split + 1)
+                count += starts
+            else:
+                newlines = data.count("\n", pos)
+                if count + newlines >= limit:
+                    split = pos - 1
+                    for i in xrange(limit - count):
+                        split = data.index("\n", split + 1)
+                    split += 1
+                count += newlines
+
+            if split is None:
+                outfile.write(data[pos:])
+                pos = len(data)
+            else:
+                outfile.write(data[pos:split])
+                outfile.close()
+                outfile = None
+                yield chunkname
+                pos = split
+        previous = data[-1]
+
+    if outfile is not None:
+        outfile.close()
+        yield chunkname
+
+
+TEXT_BLOCK_SIZE = 1024 * 1024    # how much of a text input the block splitter reads at a time
+
+# a split worker is a new python process (rather than a fork of this one), which imports tardis from where we did (see _get_split_environment)
+SPLIT_WORKER_COMMAND = [sys.executable, "-c", "import sys, tardis.conditioner.text as text ; sys.exit(text._split_worker(sys.argv[1:]))"]
+
+def _get_split_environment():
+    """
+    return the environment to run a split process in - ours, with the folder tardis was imported from at the
+    front of the PYTHONPATH
+    """
+    env = dict(os.environ)
+    tardis_root = os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+    env["PYTHONPATH"] = os.pathsep.join([tardis_root] + ([env["PYTHONPATH"]] if env.get("PYTHONPATH", "") != "" else []))
+    return env
+
+
+def _split_worker(argv):
+    """
+    the main of a split worker (see SPLIT_WORKER_COMMAND). This splits a text, fastq or fasta file (or a range of the
+    blocks of a BGZF file) into chunks (see _split_data_blocks), reporting each chunk on stdout as it is completed
+    (chunk=name), as kseq_split -p does - so that the split runs in parallel with the conditioner. If the split fails,
+    it reports error=message and returns 1
+    """
+    parser = argparse.ArgumentParser(prog="tardis split worker")
+    parser.add_argument("-z", dest="compress", action="store_true", default=False, help="gzip the chunks")
+    parser.add_argument("-w", dest="wait", action="store_true", default=False, help="wait for a byte on stdin before starting each chunk after the first")
+    parser.add_argument("-R", dest="bgzf_range", type=int, nargs=4, metavar=("START_BLOCK", "START", "END_BLOCK", "END"), default=None, \
+                        help="only split the range of a BGZF file from offset START in the block at file offset START_BLOCK, up to offset END in the block at END_BLOCK (END_BLOCK -1 is the end of the file)")
+    parser.add_argument("informat", choices=("text", "fastq", "fasta"))
+    parser.add_argument("filename")
+    parser.add_argument("chunksize", type=int)
+    parser.add_argument("chunktemplate", help="chunk name template (e.g. R1.%%05d.fastq)")
+    args = parser.parse_args(argv)
+
+    chunks_started = [0]
+    def open_chunk(chunkname):
+        if args.wait and chunks_started[0] > 0:
+            os.read(sys.stdin.fileno(), 1)
+        chunks_started[0] += 1
+        if args.compress:
+            return gzip.open(chunkname, "wb", 1)
+        return open(chunkname, "w")
+
+    try:
+        infile = None
+        if args.bgzf_range is None:
+            (infile, uncompressedName) = textDataConditioner.getUncompressedFilestream(args.filename)
+            data_blocks = iter(lambda: infile.read(TEXT_BLOCK_SIZE), "")
+        else:
+            (start_block, start, end_block, end) = args.bgzf_range
+            data_blocks = _read_bgzf_range(args.filename, (start_block, start), None if end_block < 0 else (end_block, end))
+        for chunkname in _split_data_blocks(data_blocks, args.chunksize, args.informat, args.chunktemplate, open_chunk):
+            print "chunk=%s"%chunkname
+            sys.stdout.flush()
+        if infile is not None:
+            infile.close()   # (raises IOError if decompression failed - e.g. the input was truncated)
+    except (IOError, OSError, ValueError, zlib.error, tutils.tardisException), e:
+        print "error=%s"%str(e).replace("\n", " ")
+        return 1
+    return 0
+
+
+FASTA_LINE_LENGTH = 60   # (as written by SeqIO)
+
+class rawSequenceRecord(object):
+    """
+    A light-weight stand-in for a biopython SeqRecord, used by the standard conditioner when splitting
+    fasta and fastq. It just holds the raw text lines of the record - the sequence is only assembled if
+    something asks for it (e.g. a length filter), and if a record is written back out in the format it was
+    read in, and is already laid out as SeqIO would write it, the original text is written as-is rather than
+    being re-formatted.
+
+    It supports the parts of the SeqRecord interface used by the conditioner and the pairBond functions - i.e.
+    .name, len() and .format(outformat). (offset is the byte offset of the record in the stream it was read from)
+    """
+    __slots__ = ("informat", "header", "seqlines", "quallines", "offset")
+
+    def __init__(self, informat, header, seqlines, quallines = None, offset = None):
+        self.informat = informat
+        self.header = header
+        self.seqlines = seqlines
+        self.quallines = quallines
+        self.offset = offset
+
+    @property
+    def name(self):
+        return self.header[1:].split(None,1)[0]
+
+    @property
+    def description(self):
+        return self.header[1:].strip()
+
+    @property
+    def seq(self):
+        if len(self.seqlines) == 1:
+            return self.seqlines[0].rstrip("\r\n")
+        return "".join(line.rstrip("\r\n") for line in self.seqlines)
+
+    @property
+    def qual(self):
+        if self.quallines is None:
+            return None
+        return "".join(line.rstrip("\r\n") for line in self.quallines)
+
+    def __len__(self):
+        return len(self.seq)
+
+    def __str__(self):
+        return self.description
+
+    def isSeqIOLayout(self):
+        """
+        return True if the record is already laid out as SeqIO would write it - i.e. a fastq record on 4 lines, or
+        a fasta sequence wrapped at FASTA_LINE_LENGTH - with unix line ends and no trailing space on the header
+        """
+        if not self.header.endswith("\n") or self.header[-2].isspace():
+            return False
+        if self.informat == "fastq":
+            return len(self.seqlines) == 1 and len(self.quallines) == 1 and self.seqlines[0][-2:-1] not in ("\r", "") and \
+                   self.seqlines[0].endswith("\n") and self.quallines[0].endswith("\n") and self.quallines[0][-2:-1] != "\r"
+        for line in self.seqlines[0:-1]:
+            if len(line) != FASTA_LINE_LENGTH + 1 or line[-2] == "\r":
+                return False
+        return len(self.seqlines) == 0 or (1 < len(self.seqlines[-1]) <= FASTA_LINE_LENGTH + 1 and \
+                                           self.seqlines[-1].endswith("\n") and self.seqlines[-1][-2] != "\r")
+
+    def format(self, outformat):
+        # (the output is the same as SeqIO would write - records already laid out that way are written as-is)
+        if outformat == self.informat and self.isSeqIOLayout():
+            return self.header + "".join(self.seqlines) + ("" if self.quallines is None else "+\n" + self.quallines[0])
+        elif outformat == "fastq" and self.informat == "fastq":
+            return "@%s\n%s\n+\n%s\n"%(self.header[1:].rstrip(), self.seq, self.qual)
+        elif outformat == "fasta":
+            seq = self.seq
+            return ">%s\n%s"%(self.header[1:].rstrip(), "".join(seq[i:i + FASTA_LINE_LENGTH] + "\n" for i in xrange(0, len(seq), FASTA_LINE_LENGTH)))
+        else:
+            raise ValueError("unable to write %s record %s as %s"%(self.informat, self.name, outformat))
+
+
+def getRawSequenceRecords(infile, informat):
+    """
+    A generator.
+    Tokenise a fasta or fastq stream into rawSequenceRecord objects. This is used instead of Bio.SeqIO.parse
+    by the standard conditioner, unless a record_filter_func has been specified (which needs real SeqRecords).
+    Malformed records raise ValueError, as SeqIO does.
+    """
+    readline = infile.readline
+    pos = 0       # byte offset of the start of the current line
+
+    if informat == "fastq":
+        line = readline()
+        while line:
+            if len(line.strip()) == 0:
+                pos += len(line)
+                line = readline()
+                continue
+            if line[0] != "@":
+                raise ValueError("fastq record header should start with @ : %s"%line.strip())
+            header = line
+            offset = pos
+            pos += len(line)
+            seqlines = []
+            line = readline()
+            while line and line[0] != "+":
+                seqlines.append(line)
+                pos += len(line)
+                line = readline()
+            if not line:
+                raise ValueError("end of file before quality line(s) for fastq record %s"%header.strip())
+
+            # (multi-line fastq is allowed - keep reading quality lines until we have enough of them)
+            pos += len(line)
+            seqlength = sum(len(seqline.rstrip("\r\n")) for seqline in seqlines)
+            quallines = []
+            quallength = 0
+            while quallength < seqlength:
+                line = readline()
+                if not line:
+                    break
+                quallines.append(line)
+                pos += len(line)
+                quallength += len(line.rstrip("\r\n"))
+            if quallength != seqlength:
+                raise ValueError("lengths of sequence and quality values differ for fastq record %s"%header.strip())
+            yield rawSequenceRecord("fastq", header, seqlines, quallines, offset)
+            line = readline()
+
+    elif informat == "fasta":
+        line = readline()
+        while line and line[0] != ">":         # (skip anything before the first record - SeqIO does the same)
+            pos += len(line)
+            line = readline()
+        while line:
+            header = line
+            offset = pos
+            pos += len(line)
+            seqlines = []
+            line = readline()
+            while line and line[0] != ">":
+                if len(line.strip()) > 0:
+                    seqlines.append(line)
+                pos += len(line)
+                line = readline()
+            yield rawSequenceRecord("fasta", header, seqlines, offset = offset)
+    else:
+        raise ValueError("getRawSequenceRecords : unsupported format %s"%informat)
+
+
+def getRecordOffsets(infile, informat):
+    """
+    A generator.
+    yield (byte offset, record) for each logical record of an uncompressed stream - records
+    are rawSequenceRecords for fasta and fastq, or lines for text
+    """
+    if informat in ("fastq", "fasta"):
+        for record in getRawSequenceRecords(infile, informat):
+            yield (record.offset, record)
+    else:
+        pos = 0
+        for line in infile:
+            yield (pos, line)
+            pos += len(line)
+
+
+def _virtual_get_conditioned_filenames(caller, filename1, argchunksize, outdir, informat, filename2=None, pairBond=None,\
+                            listfilename1 = None, listfilename2 = None, from_record = None, to_record = None):
+    """
+    A generator.
+
+    Rather than writing copies of each chunk of the input to the working folder, this just scans
+    the (uncompressed) input(s) for record-aligned chunk boundaries, records these in a sidecar
+    index (NAME.chunk_index), and writes a small reader script for each chunk. When a job runs, its
+    reader serves the byte range of the original file through a named pipe with the usual chunk name
+    (so for example product naming based on the chunk name is unaffected). 
+
+    This roughly halves the I/O of the split phase, and needs almost no scratch space - however the
+    command must read its input once, sequentially (as it is a pipe, it cannot seek or re-read it)
+
+    Slicing (from_record, to_record) and the pairBond check are supported, sampling and filtering are not.
+    Yields the same tuples as _slow_get_conditioned_filenames
+    """
+    # if chunksize zero yield empty chunknames and stop
+    if argchunksize == 0:
+        yield ((filename1, filename2), (None, None))
+        raise StopIteration
+
+    caller.logWriter.info("_virtual_get_conditioned_filenames : indexing %s to %s chunksize %d informat %s from %s to %s file2 %s"%(filename1, outdir, \
+                                                                                            argchunksize , informat, from_record, to_record , filename2))
+
+    filenames = [filename for filename in (filename1, filename2) if filename is not None]
+    chunktemplates = []
+    indexfiles = []
+    for filename in filenames:
+        name_parts = os.path.splitext(os.path.basename(filename))
+        chunktemplates.append(os.path.join(outdir, name_parts[0] + ".%05d" + name_parts[1]))
+        indexfile = open(os.path.join(outdir, "%s.chunk_index"%os.path.basename(filename)), "w")
+        print >> indexfile, "#chunk\tstart\tlength\trecords\tfirst_record"
+        indexfiles.append(indexfile)
+
+    # this embedded method writes the index entry and reader script for a chunk, and returns the chunk names
+    def finalise_chunk(chunk, starts, ends, first_record, record_count):
+        chunkInfo = [None, None]
+        for i in range(0, len(filenames)):
+            chunkname = chunktemplates[i]%chunk
+            if os.path.exists(chunkname):
+                raise tutils.tardisException("_virtual_get_conditioned_filenames : error - %s already exists"%chunkname)
+            print >> indexfiles[i], "%d\t%d\t%d\t%d\t%d"%(chunk, starts[i], ends[i] - starts[i], record_count, first_record)
+            readername = chunkname + VIRTUAL_CHUNK_READER_SUFFIX
+            with open(readername, "w") as reader:
+                reader.write(VIRTUAL_CHUNK_READER_TEMPLATE%{"first_record" : first_record, "last_record" : first_record + record_count - 1,\
+                                                           "start" : starts[i], "end" : ends[i], "source" : os.path.abspath(filenames[i]),\
+                                                           "chunk" : chunkname, "tail_start" : 1 + starts[i], "length" : ends[i] - starts[i]})
+            os.chmod(readername, stat.S_IRWXU | stat.S_IRGRP |  stat.S_IXGRP | stat.S_IROTH | stat.S_IXOTH )
+            chunkInfo[i] = chunkname
+        return chunkInfo
+
+    # this embedded method returns the tuple to yield for a chunk
+    def chunk_tuple(chunkInfo):
+        if listfilename1 is not None and listfilename2 is not None:
+            return ((listfilename1, listfilename2),chunkInfo)
+        elif listfilename1 is not None:
+            return ((listfilename1, filename2),chunkInfo)
+        elif listfilename2 is not None:
+            return ((filename1, listfilename2),chunkInfo)
+        else:
+            return ((filename1, filename2),chunkInfo)
+
+    infiles = [open(filename, "r") for filename in filenames]
+    piter = itertools.izip(*[getRecordOffsets(infile, informat) for infile in infiles])
+
+    chunk = 1
+    input_count = 0
+    output_count = 0
+    starts = None      # byte offsets of the first record of the current chunk
+    first_record = None
+    record_count = 0
+    ends = None
+    items = None
+    try:
+        for items in piter:
+            input_count += 1
+
+            # will slice the file(s) if required
+            if from_record is not None:
+                if input_count < from_record:
+                    continue
+            if to_record is not None:
+                if input_count > to_record:
+                    ends = [offset for (offset, record) in items]
+                    break
+
+            if len(items) == 2 and pairBond is not None:
+                if not pairBond(items[0][1], items[1][1]):
+                    caller.error("pair bonding error - %s does not bond with %s"%(str(items[0][1]), str(items[1][1])))
+                    raise StopIteration
+
+            # if the current chunk is full, it ends where this record starts
+            if record_count > 0 and record_count == argchunksize:
+                chunkInfo = finalise_chunk(chunk, starts, [offset for (offset, record) in items], first_record, record_count)
+                yield chunk_tuple(chunkInfo)
+                chunk += 1
+                record_count = 0
+                if chunk > MAX_DIMENSION:
+                    caller.error("error - too many chunks - please adjust chunksize to yield no more than %d chunks"%MAX_DIMENSION)
+                    raise tutils.tardisException("error - too many chunks - please adjust chunksize to yield no more than %d chunks"%MAX_DIMENSION)
+
+            if record_count == 0:
+                starts = [offset for (offset, record) in items]
+                first_record = input_count
+
+            record_count += 1
+            output_count += 1
+            
+    # handle exceptions that relate to problems with the data so we can report
+    # where we are, then bail out.
+    except ValueError, e:
+        caller.error(e)
+        caller.logWriter.info("the last records encountered before the error were : %s"%str(items))
+        raise StopIteration
+
+    # last chunk ends at the end of the file (unless we are slicing)
+    if record_count > 0:
+        if ends is None:
+            ends = [os.path.getsize(filename) for filename in filenames]
+        chunkInfo = finalise_chunk(chunk, starts, ends, first_record, record_count)
+        yield chunk_tuple(chunkInfo)
+
+    for f in infiles + indexfiles:
+        f.close()
+
+    caller.logWriter.info("*** _virtual_get_conditioned_filenames : indexed %s of %s records into %d virtual chunks ***\n"%(output_count, input_count, \
+                                                                                          chunk if record_count > 0 else chunk - 1))
+    raise StopIteration
+
+
+def _bgzf_get_conditioned_filenames(caller, filename1, argchunksize, outdir, informat, listfilename1 = None, max_processes = 2):
+    """
+    A generator.
+
+    Split a BGZF file (e.g. from bgzip) in parallel. A BGZF file is made of small independently compressed
+    blocks, so it can be divided into ranges of blocks, each of which is decompressed and split by a separate
+    split worker process (see _split_worker). The start of each range is moved to the first record start in or
+    after its first block (only the blocks around it need to be decompressed to find this), so that each range
+    holds whole records.
+
+    Each worker splits its range into chunks of chunksize records (so the last chunk of each range is usually
+    a partial one), reporting each chunk over a pipe as it is completed. The chunks are renamed into the usual
+    sequence and yielded in file order - those of the first range as they are written, while the other
+    ranges are split ahead in parallel.
+
+    Only used for a single (unpaired) file with no sampling, slicing, filtering or format conversion -
+    fastq records must be 4 lines. Yields None once the split has started (see _start_split), then the same
+    tuples as _slow_get_conditioned_filenames 
+    """
+    # if chunksize zero yield empty chunknames and stop
+    if argchunksize == 0:
+        yield None
+        yield ((filename1, None), (None, None))
+        raise StopIteration
+
+    try:
+        blocks = _get_bgzf_blocks(filename1)
+    except ValueError, e:
+        caller.error(e)
+        raise StopIteration
+
+    # divide the blocks into ranges, and find the first record start of each range
+    with open(filename1, "rb") as f:
+        starts = [(0,0)]
+        for i in range(1, min(max_processes, len(blocks))):
+            start = _find_bgzf_record_start(f, blocks, i * len(blocks) / max_processes, informat)
+            if start is not None and start > starts[-1]:
+                starts.append(start)
+    # (the workers are given file offsets, rather than block numbers)
+    ranges = [((blocks[start[0]][0], start[1]), None if end is None else (blocks[end[0]][0], end[1])) for (start, end) in zip(starts, starts[1:] + [None])]
+
+    caller.logWriter.info("_bgzf_get_conditioned_filenames : conditioning %s to %s chunksize %d informat %s as %d ranges of %d blocks using up to %d processes"%(filename1, outdir, \
+                                                                                            argchunksize , informat, len(ranges), len(blocks), max_processes))
+
+    chunksuffix = ""
+    if caller.options.get("compress_chunks", False):
+        chunksuffix = ".gz"
+    name_parts = os.path.splitext(os.path.basename(textDataConditioner.getUncompressedBaseName(filename1)))
+    chunktemplate = os.path.join(outdir, name_parts[0] + ".%05d" + name_parts[1] + chunksuffix)
+    split_logfile = os.path.join(outdir, "split_processing.log")
+
+    # this embedded method starts a worker to split a range, returning (the worker process, its command)
+    def start_worker(range_number, (start, end)):
+        rangetemplate = os.path.join(outdir, "%s.range%03d.%%05d%s%s_"%(name_parts[0], range_number, name_parts[1], chunksuffix))
+        split_command = SPLIT_WORKER_COMMAND + (["-z"] if chunksuffix == ".gz" else []) + ["-R"] + [str(n) for n in start + (end or (-1, -1))] + \
+                        [informat, filename1, str(argchunksize), rangetemplate]
+        return (_start_split_process(caller, split_command, split_logfile), split_command)
+
+    workers = {}   # range number -> (worker process, its command)
+    chunk = 0
+    try:
+        for range_number in range(0, len(ranges)):
+            # keep up to max_processes ranges being split
+            for ahead in range(range_number, min(range_number + max_processes, len(ranges))):
+                if ahead not in workers:
+                    workers[ahead] = start_worker(ahead, ranges[ahead])
+            if range_number == 0:
+                yield None   # (the split has started)
+
+            (proc, split_command) = workers[range_number]
+            while True:
+                (rangechunkname, digest) = _next_split_chunk(caller, proc, split_command, filename1)
+                if rangechunkname is None:
+                    break
+                chunk += 1
+                if chunk > MAX_DIMENSION:
+                    caller.error("error - too many chunks - please adjust chunksize to yield no more than %d chunks"%MAX_DIMENSION)
+                    raise tutils.tardisException("error - too many chunks - please adjust chunksize to yield no more than %d chunks"%MAX_DIMENSION)
+                chunkname = chunktemplate%chunk
+                if os.path.exists(chunkname):
+                    raise tutils.tardisException("_bgzf_get_conditioned_filenames : error - %s already exists"%chunkname)
+                os.rename(rangechunkname, chunkname)
+                yield ((listfilename1 or filename1, None), [chunkname, None])
+            del workers[range_number]
+            _reap_split_processes(caller, [proc], [split_command], split_logfile)
+            if proc.returncode != 0:
+                break
+
+        caller.logWriter.info("*** _bgzf_get_conditioned_filenames : split %s into %d chunks ***\n"%(filename1, chunk))
+    finally:
+        # stop and reap any workers still running if we are abandoned early
+        _reap_split_processes(caller, [proc for (proc, split_command) in workers.values()], [split_command for (proc, split_command) in workers.values()], split_logfile)
+
+
+def _block_get_conditioned_filenames(caller, filename1, argchunksize, outdir, listfilename1 = None):
+    """
+    A generator.
+
+    Split a single text file into chunks of chunksize lines. Rather than reading and writing
+    the file a line at a time (as _slow_get_conditioned_filenames does), this reads it in large blocks,
+    and finds chunk boundaries by counting the newlines in each block in bulk (see _split_data_blocks).
+    The split is done by a split worker process (see _split_worker), which reports each chunk as it
+    is completed.
+
+    Only used when there is no sampling, slicing or length filtering (these need per-line handling, so
+    use the standard conditioner). Yields None once the split has started (see _start_split), then the
+    same tuples as _slow_get_conditioned_filenames 
+    """
+    # if chunksize zero yield empty chunknames and stop
+    if argchunksize == 0:
+        yield None
+        yield ((filename1, None), (None, None))
+        raise StopIteration
+
+    caller.logWriter.info("_block_get_conditioned_filenames : conditioning %s to %s chunksize %d"%(filename1, outdir, argchunksize))
+
+    chunksuffix = ""
+    if caller.options.get("compress_chunks", False):
+        chunksuffix = ".gz"
+    name_parts = os.path.splitext(os.path.basename(textDataConditioner.getUncompressedBaseName(filename1)))
+    chunktemplate = os.path.join(outdir, name_parts[0] + ".%05d" + name_parts[1] + chunksuffix)
+    split_logfile = os.path.join(outdir, "split_processing.log")
+
+    # if the conditioned input on disk is limited, the split is only allowed to run one chunk ahead of us
+    flow_control = tutils.isConditionedInputThrottled(caller.options)
+    split_command = SPLIT_WORKER_COMMAND + (["-z"] if chunksuffix == ".gz" else []) + (["-w"] if flow_control else []) + \
+                    ["text", filename1, str(argchunksize), chunktemplate]
+    split_proc = _start_split_process(caller, split_command, split_logfile, flow_control)
+
+    chunk = 0
+    try:
+        yield None   # (the split has started)
+        while True:
+            if flow_control and chunk > 0:
+                _resume_split_processes([split_proc])
+            (chunkname, digest) = _next_split_chunk(caller, split_proc, split_command, filename1)
+            if chunkname is None:
+                break
+
+            yield ((listfilename1 or filename1, None), [chunkname, None])
+
+            chunk += 1
+            if chunk > MAX_DIMENSION:
+                caller.error("error - too many chunks - please adjust chunksize to yield no more than %d chunks"%MAX_DIMENSION)
+                raise tutils.tardisException("error - too many chunks - please adjust chunksize to yield no more than %d chunks"%MAX_DIMENSION)
+    finally:
+        _reap_split_processes(caller, [split_proc], [split_command], split_logfile)
+
+    caller.logWriter.info("*** _block_get_conditioned_filenames : split %s into %d chunks ***\n"%(filename1, chunk))
+
+
 def _fast_get_conditioned_filenames(caller, filename1, argchunksize, outdir, informat, outformat, samplerate,filename2,\
                             listfilename1 = None, listfilename2 = None, length_bounds = (None, None) , from_record = None, to_record = None):
     """
@@ -327,13 +1675,27 @@ def _fast_get_conditioned_filenames(caller, filename1, argchunksize, outdir, inf
     See also below, _slow_get_conditioned_filenames. This was the original version. Cloned and hacked to
     make this version. 
 
-    This method forks and calls one or subprocesses to do the actual split - the parent
-    polls for the split files.
+    This method starts one or two kseq_split subprocesses to do the actual split, and reads the name of 
+    each chunk from their stdout as soon as it is completed (so there is no polling for the split files).
     
     This means that e.g. record_filter_func is not supported as this method does not have access to sequence
     objects.
     
-    Other record oriented filters (e.g. by length , from - to, samplerate) are planned to be supported but are not yet
+    Other record oriented filters (e.g. by length , from - to) are planned to be supported but are not yet.
+
+    Sampling is supported - kseq_split is given a seed, and decides whether to sample each record from the
+    seed and the record's ordinal number alone, so the splits of the two files of a pair (which run
+    independently) select exactly the same records. The seed is taken from the sample_seed option if set
+    (making the sample reproducible), otherwise one is drawn at random and logged. 
+
+    If the chunk_by option is residues or bytes, kseq_split is asked to close each chunk once it holds
+    chunksize residues or bytes (this is only used for a single file, as the two files of a pair would be
+    cut at different records)
+
+    Rather than applying pairBond to each pair of records, the two files of a pair are checked chunk by chunk -
+    kseq_split reports a digest of the read names (less any /1, /2 suffix) of each chunk, and these must agree. 
+
+    Yields None once the split has started (see _start_split), then the chunk tuples
     """    
     
     #named indexes
@@ -342,6 +1704,7 @@ def _fast_get_conditioned_filenames(caller, filename1, argchunksize, outdir, inf
 
     # if chunksize zero yield empty chunknames and stop
     if argchunksize == 0:
+        yield None
         yield ((filename1, filename2), (None, None))
         raise StopIteration
 
@@ -354,12 +1717,19 @@ def _fast_get_conditioned_filenames(caller, filename1, argchunksize, outdir, inf
     # (we don't adjust chunksize if we are sampling as kseq does it)
     chunksize = argchunksize
 
-    # set various filenames that will be needed
+    sample_seed = None
+    if samplerate is not None:
+        sample_seed = _get_sample_seed(caller)
+
+    # set various filenames that will be needed (chunks are optionally gzipped) 
+    chunksuffix = ""
+    if caller.options.get("compress_chunks", False):
+        chunksuffix = ".gz"
     uncompressedName1 = textDataConditioner.getUncompressedBaseName(filename1)
     batonfile1 = os.path.join(outdir, "%s.chunk_stats$"%os.path.basename(uncompressedName1))
     chunkbase1 = os.path.basename(uncompressedName1)
     name_parts = os.path.splitext(chunkbase1)
-    chunktemplate1 =  os.path.join(outdir, name_parts[0] + ".%05d" + name_parts[1])
+    chunktemplate1 =  os.path.join(outdir, name_parts[0] + ".%05d" + name_parts[1] + chunksuffix)
 
     uncompressedName2 = None
     batonfile2 = None
@@ -370,188 +1740,80 @@ def _fast_get_conditioned_filenames(caller, filename1, argchunksize, outdir, inf
         batonfile2 = os.path.join(outdir, "%s.chunk_stats$"%os.path.basename(uncompressedName2))
         chunkbase2 = os.path.basename(uncompressedName2)
         name_parts = os.path.splitext(chunkbase2)
-        chunktemplate2 =  os.path.join(outdir, name_parts[0] + ".%05d" + name_parts[1])
+        chunktemplate2 =  os.path.join(outdir, name_parts[0] + ".%05d" + name_parts[1] + chunksuffix)
 
     split_logfile = os.path.join(outdir, "split_processing.log")
 
-    # fork a process to kick off split of file 1
-    try:
-        split_command = ["kseq_split", "-f" ,  batonfile1, "-o", outformat, filename1, str(chunksize), chunktemplate1]
-        if samplerate is not None:
-            split_command = ["kseq_split", "-f" ,  batonfile1, "-o", outformat, "-s" , str(samplerate), filename1, str(chunksize), chunktemplate1]
-            
-            
-        caller.logWriter.info("fast input conditioner forking split process : %s"%" ".join(split_command))
-        me = os.fork()
-        if me == 0:   # child
-            mypid = os.getpid()
-
-            # kick off the splitting process and wait for it to finish
-            proc = subprocess.Popen(split_command, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-            (stdout, stderr) = proc.communicate()
-
-            with open(split_logfile,"a") as l:
-                print >> l, "child process %d started split subprocess %d"%(mypid, proc.pid) 
-                print >> l, "split subprocess stdout : \n%s"%stdout
-                print >> l, "split subprocess stderr : \n%s"%stderr
-                print >> l, "split subprocess %d terminated with return value %d"%(proc.pid, proc.returncode)
-                print >> l, "child process %d exiting with status %s"%(mypid, proc.returncode)
-            sys.exit(proc.returncode)
-    except OSError,e:
-        caller.logWriter.info("fast input conditioner : error - fork of %s failed with OSError : %s"%(" ".join(split_command), e))
-        raise tutils.tardisException("fast input conditioner : error - fork of %s failed with OSError : %s"%(" ".join(split_command), e))
-
-    # parent
+    # start a kseq_split subprocess for each file. These report each chunk on stdout as soon as it is
+    # completed, and the total number of chunks when they finish (they still write the baton file as well)
+    split_commands = [["kseq_split", "-p", "-f" ,  batonfile1, "-o", outformat, filename1, str(chunksize), chunktemplate1]]
     if filename2 != None:
-        try:
-            split_command = ["kseq_split", "-f" , batonfile2, "-o", outformat, filename2, str(chunksize), chunktemplate2 ]
-            if samplerate is not None:
-                raise tutils.tardisException("this input conditioner does not support paired random sampling ! - should not be executing this code block !?")
-            
-            caller.logWriter.info("fast input conditioner forking split process : %s"%" ".join(split_command))
-            me = os.fork()
-            if me == 0:   # child
-                mypid = os.getpid()
-
-                # kick off the splitting process and wait for it to finish
-                proc = subprocess.Popen(split_command, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-                (stdout, stderr) = proc.communicate()
-
-                with open(split_logfile,"a") as l:
-                    print >> l, "child process %d started split subprocess %d"%(mypid, proc.pid) 
-                    print >> l, "split subprocess stdout : \n%s"%stdout
-                    print >> l, "split subprocess stderr : \n%s"%stderr
-                    print >> l, "split subprocess %d terminated with return value %d"%(proc.pid, proc.returncode)
-                    print >> l, "child process %d exiting with status %s"%(mypid, proc.returncode)
-                sys.exit(proc.returncode)
-        except OSError,e:
-            caller.logWriter.info("fast input conditioner : error - fork of %s failed with OSError : %s"%(" ".join(split_command), e))
-            raise tutils.tardisException("fast input conditioner : error - fork of %s failed with OSError : %s"%(" ".join(split_command), e))
-
-    # parent
-
-    # we have kicked off subprocesses to (asynchronously) split the input files.
-    # now poll for the chunk files they generate. We use the following embedded method
-
-    
-    # this method polls for each chunk being generated by the child processes
-    def advance_chunk(caller, chunk, total_chunks_in, batonfile1, batonfile2,chunkbase1, chunkbase2, outdir, chunk_info):
-        # if total_chunks has been set, and we are being asked
-        # for a chunk number greater than this, raise StopIteration
-        total_chunks = total_chunks_in
-        if total_chunks is not None:
-            if chunk > total_chunks:
-                raise StopIteration
-        
-        
-        # in a wait loop, poll
-        wait_duration=0
-        exception_count = 0
-        while True:
-            # if we find either baton file , try reading the total number of chunks from it if we haven't already obtained this
-            if total_chunks is None:
-                if os.path.isfile(batonfile1):
-                    try:
-                        with open(batonfile1,"r") as bf:
-                            for record in bf:
-                                total_chunks = int(re.split("=", record.strip())[1])
-                                caller.logWriter.info("%d chunks in total were written (according to %s)"%(total_chunks, batonfile1))
-                                break
-                    except Exception, e :
-                        # this could happen if we try to read the baton file at the same time as
-                        # the chunk-writer writes it. No action needed - will get it
-                        # next pass. But if we fail more than 50 times give up.
-                        caller.logWriter.info("warning - exception (%s) reading batonfile %s"%(str(e), batonfile1))
-                        caller.logWriter.info("error - too many failed attempts to parse batonfile %s - giving up"%batonfile1)
-                        exception_count += 1
-                        if exception_count >= 50:
-                            raise tutils.tardisException("error - too many failed attempts to parse batonfile %s - giving up"%batonfile1)
-                        
-                        
-
-            if total_chunks is None and batonfile2 is not None:
-                if os.path.isfile(batonfile2):
-                    try:
-                        with open(batonfile2,"r") as bf:
-                            for record in bf:
-                                total_chunks = int(re.split("=", record.strip())[1])
-                                caller.logWriter.info("%d chunks in total were written (according to %s)"%(total_chunks, batonfile2))
-                                break
-                    except Exception, e :
-                        # this could happen if we try to read the baton file at the same time as
-                        # the chunk-writer writes it. No action needed - will get it
-                        # next pass. But if we fail more than 50 times give up.
-                        caller.logWriter.info("warning - exception (%s) reading batonfile %s"%(str(e), batonfile1))
-                        caller.logWriter.info("error - too many failed attempts to parse batonfile %s - giving up"%batonfile1)
-                        exception_count += 1
-                        if exception_count >= 50:
-                            raise tutils.tardisException("error - too many failed attempts to parse batonfile %s - giving up"%batonfile1)
-
-            # if we just obtained number of chunks, and we are being asked for a chunk more than this, raise StopIteration
-            if total_chunks is not None:
-                if chunk > total_chunks:
-                    raise StopIteration
-                                              
+        split_commands.append(["kseq_split", "-p", "-f" , batonfile2, "-o", outformat, filename2, str(chunksize), chunktemplate2 ])
+    if samplerate is not None:
+        for split_command in split_commands:
+            split_command[2:2] = ["-s" , str(samplerate), "-r", str(sample_seed)]
+    if chunksuffix == ".gz":
+        for split_command in split_commands:
+            split_command[2:2] = ["-z"]
+    chunk_by = _get_chunk_by(caller, informat)
+    if chunk_by != "records":
+        for split_command in split_commands:
+            split_command[2:2] = ["-b", chunk_by]
+    if filename2 is not None:
+        for split_command in split_commands:
+            split_command[2:2] = ["-d"]
+    # if the conditioned input on disk is limited, the split is only allowed to run one chunk ahead of us
+    flow_control = tutils.isConditionedInputThrottled(caller.options)
+    if flow_control:
+        for split_command in split_commands:
+            split_command[2:2] = ["-w"]
+    if caller.targetChunkCount is not None and filename2 is None and listfilename1 is None:
+        # the chunksize is an estimate - let kseq_split correct it as the split proceeds
+        split_commands[0][2:2] = ["-t", str(caller.targetChunkCount)]
+
+    split_procs = [_start_split_process(caller, split_command, split_logfile, flow_control) for split_command in split_commands]
 
-            # test existence of chunkfilename1 (and chunkfilename2 if applicable), corresponding to chunk
-            # note that it is possible we are testing for a chunkfile past the last one , if we haven't yet
-            # picked up total_chunks - however this will be picked up in a subsequent pass
-            if chunk_info[0] is None:
-                name_parts = os.path.splitext(chunkbase1)
-                chunkfilename1 =  os.path.join(outdir, "%s.%05d%s"%(name_parts[0], chunk, name_parts[1]))
-                if os.path.isfile(chunkfilename1):
-                    chunk_info[0] = chunkfilename1
-                    
-            if filename2 is not None and chunk_info[1] is None:
-                name_parts = os.path.splitext(chunkbase2)
-                chunkfilename2 =  os.path.join(outdir, "%s.%05d%s"%(name_parts[0], chunk, name_parts[1]))
-                if os.path.isfile(chunkfilename2):
-                    chunk_info[1] = chunkfilename2
-                
-            # if we are done (i.e. have the chunk filenames we need), break
-            if filename2 is None and chunk_info[0] is not None:
-                return total_chunks
-            elif chunk_info[0] is not None and chunk_info[1] is not None:
-                return total_chunks
-
-            # brief sleep
-            time.sleep(caller.POLL_INTERVAL)
-            wait_duration += caller.POLL_INTERVAL
-            if wait_duration > 60 * 60:   # one hour
-                caller.logWriter.info("warning - polling for chunk %d is taking a long time ! "%chunk)
-            elif wait_duration > caller.POLL_DURATION:
-                caller.logWriter.info("error - polling for chunk %d has exceeded POLL_DURATION (24 hours) ! (not exiting but this doesn't look good)"%chunk)
-                
-    # end of advance_chunk method
-    
     # loop getting chunks
-    chunk = 1
     chunksYieldedCount = 0
-    chunk_info = [None, None]
-    total_chunks = None
-    while True:
+    try:
+        yield None   # (the split has started)
+        while True:
+            chunk_info = [None, None]
+            digests = [None, None]
+            if flow_control and chunksYieldedCount > 0:
+                # each split waits after writing a chunk, until we ask for the next one - so it never runs ahead of the jobs
+                _resume_split_processes(split_procs)
+            for (i, (proc, split_command)) in enumerate(zip(split_procs, split_commands)):
+                (chunk_info[i], digests[i]) = _next_split_chunk(caller, proc, split_command, (filename1, filename2)[i])
+
+            if filename2 is not None and (chunk_info[0] is None) != (chunk_info[1] is None):
+                caller.error("fast input conditioner : error - %s and %s were split into different numbers of chunks"%(filename1, filename2))
+                break
+            if chunk_info[0] is None:
+                break
+            if filename2 is not None and digests[0] != digests[1]:
+                caller.error("pair bonding error - the read names in %s do not match those in %s"%(chunk_info[0], chunk_info[1]))
+                break
+
+            if listfilename1 is not None and listfilename2 is not None:
+                yield ((listfilename1, listfilename2),chunk_info)
+            elif listfilename1 is not None:
+                yield ((listfilename1, filename2),chunk_info)
+            elif listfilename2 is not None:
+                yield ((filename1, listfilename2),chunk_info)
+            else:
+                yield ((filename1, filename2),chunk_info)
 
-        total_chunks = advance_chunk(caller, chunk, total_chunks, batonfile1, batonfile2,chunkbase1, chunkbase2, outdir, chunk_info)
-        chunk += 1
-        
-        if listfilename1 is not None and listfilename2 is not None:
-            yield ((listfilename1, listfilename2),chunk_info)
-        elif listfilename1 is not None:
-            yield ((listfilename1, filename2),chunk_info)
-        elif listfilename2 is not None:
-            yield ((filename1, listfilename2),chunk_info)
-        else:
-            yield ((filename1, filename2),chunk_info)
+            chunksYieldedCount += 1
 
-        chunksYieldedCount += 1
-            
-        if chunksYieldedCount > MAX_DIMENSION:
-            #raise tardisException("error - too many chunks - please adjust chunksize to yield no more than %d chunks"%MAX_DIMENSION)
-            caller.error("error - too many chunks - please adjust chunksize to yield no more than %d chunks"%MAX_DIMENSION)
-            raise tutils.tardisException("error - too many chunks - please adjust chunksize to yield no more than %d chunks"%MAX_DIMENSION)
+            if chunksYieldedCount > MAX_DIMENSION:
+                #raise tardisException("error - too many chunks - please adjust chunksize to yield no more than %d chunks"%MAX_DIMENSION)
+                caller.error("error - too many chunks - please adjust chunksize to yield no more than %d chunks"%MAX_DIMENSION)
+                raise tutils.tardisException("error - too many chunks - please adjust chunksize to yield no more than %d chunks"%MAX_DIMENSION)
+    finally:
+        # reap the split processes (stopping any we are abandoning early)
+        _reap_split_processes(caller, split_procs, split_commands, split_logfile)
 
-        chunk_info = [None, None]
-                    
 
 def _slow_get_conditioned_filenames(caller, filename1, argchunksize, outdir, informat = "text", outformat = "text", samplerate = None ,filename2=None,  pairBond = None,\
                             listfilename1 = None, listfilename2 = None, length_bounds = (None,None), record_filter_func=None, from_record = None, to_record = None):
@@ -565,6 +1827,8 @@ def _slow_get_conditioned_filenames(caller, filename1, argchunksize, outdir, inf
     Returns a tuple : ((inputfilename1, inputfilename2), (fragmentname1, fragmentname2))
     (The input names are returned as well, so that consumers of this generator know which
     original name each fragment relates to)
+    With the chunk_by option set to residues or bytes, fasta and fastq chunks are closed once they hold
+    at least chunksize residues or bytes (of both files together, if paired) rather than chunksize records
     The first element of the sub-tuples contains original / fragment-filenames obtained by (optionally uncompressing and)
     splitting up the first file.
     The second element of the sub-tuple contains either None, if there was only one file to process, or corresponding fragment
@@ -623,16 +1887,29 @@ def _slow_get_conditioned_filenames(caller, filename1, argchunksize, outdir, inf
     if filename2 != None:
         chunkname2 = os.path.basename(uncompressedName2)
 
+    # chunks are optionally gzipped (at the fastest level)
+    chunksuffix = ""
+    open_chunk = lambda chunkfilename: open(chunkfilename, "w")
+    if caller.options.get("compress_chunks", False):
+        chunksuffix = ".gz"
+        open_chunk = lambda chunkfilename: gzip.open(chunkfilename, "wb", 1)
+
     #print "DEBUG %s %s"%(uncompressedName1, chunkname1)
         
-    # set up iterators over structured input records
+    # set up iterators over structured input records. Full biopython SeqRecords are only
+    # needed if there is a record filter (which is written in terms of SeqRecords) - otherwise
+    # we use the light-weight raw record tokeniser 
     iter1 = None
     iter2 = None
-    if informat in ("fastq", "fasta"):
+    if informat in ("fastq", "fasta") and record_filter_func is not None:
         from Bio import SeqIO
         iter1 = SeqIO.parse(infile1, informat)
         if infile2 != None:
             iter2 = SeqIO.parse(infile2, informat)
+    elif informat in ("fastq", "fasta"):
+        iter1 = getRawSequenceRecords(infile1, informat)
+        if infile2 != None:
+            iter2 = getRawSequenceRecords(infile2, informat)
     elif informat == "text":
         iter1 = infile1
         if infile2 != None:
@@ -661,6 +1938,13 @@ def _slow_get_conditioned_filenames(caller, filename1, argchunksize, outdir, inf
         piter = itertools.izip(iter1, itertools.repeat(None))
         
                      
+    chunk_by = _get_chunk_by(caller, informat)
+    chunk_weight = 0    # residues or bytes written to the current chunk (if chunk_by is not records)
+
+    # (a pair of records is sampled - or not - together)
+    sampler = tutils.recordSampler(samplerate, _get_sample_seed(caller) if samplerate is not None else None)
+    records_to_skip = sampler.getSkipCount()  # before the next record to sample (always 0 if not sampling)
+
     # output  ! 
     output_count = 0
     input_count = 0
@@ -673,7 +1957,11 @@ def _slow_get_conditioned_filenames(caller, filename1, argchunksize, outdir, inf
             input_count += 1
 
             # will sample the output if needed
-            sampleBool = tutils.getSampleBool(samplerate) # 1 or 0 (always 1 if not sampling)
+            if records_to_skip > 0:
+                records_to_skip -= 1
+                continue
+            records_to_skip = sampler.getSkipCount()
+            sampleBool = 1
 
             # will length-filter the output if needed.
             if length_bounds != (None, None):            
@@ -702,7 +1990,7 @@ def _slow_get_conditioned_filenames(caller, filename1, argchunksize, outdir, inf
 
             output_count += sampleBool 
 
-            if chunksize > 0:
+            if chunksize > 0 and chunk_by == "records":
                 mychunk = 1+int(output_count / (1.0*chunksize))
             else:
                 mychunk = chunk
@@ -713,7 +2001,7 @@ def _slow_get_conditioned_filenames(caller, filename1, argchunksize, outdir, inf
                 #outfilename1 =  os.path.join(outdir, "%s.%05d.%s"%(chunkname1, chunk, outformat))
                 #outfilename1 =  os.path.join(outdir, "%s.%05d"%(chunkname1, chunk))
                 name_parts = os.path.splitext(chunkname1)
-                outfilename1 =  os.path.join(outdir, "%s.%05d%s"%(name_parts[0], chunk, name_parts[1]))
+                outfilename1 =  os.path.join(outdir, "%s.%05d%s%s"%(name_parts[0], chunk, name_parts[1], chunksuffix))
                 
                 #print "DEBUG : %s %s"%(outdir, outfilename1)
                 if os.path.exists(outfilename1):
@@ -722,7 +2010,7 @@ def _slow_get_conditioned_filenames(caller, filename1, argchunksize, outdir, inf
                     caller.logWriter.info("the last sequences encountered before the error were : %s, %s"%(record1, record2))
                     raise StopIteration
 
-                outfile1 = open(outfilename1, "w")
+                outfile1 = open_chunk(outfilename1)
                 chunknames1.append(outfilename1)
                 
                 
@@ -730,17 +2018,23 @@ def _slow_get_conditioned_filenames(caller, filename1, argchunksize, outdir, inf
                     #outfilename2 =  os.path.join(outdir, "%s.%05d.%s"%(chunkname2, chunk, outformat))
                     #outfilename2 =  os.path.join(outdir, "%s.%05d"%(chunkname2, chunk))
                     name_parts = os.path.splitext(chunkname2)
-                    outfilename2 =  os.path.join(outdir, "%s.%05d%s"%(name_parts[0], chunk, name_parts[1]))
+                    outfilename2 =  os.path.join(outdir, "%s.%05d%s%s"%(name_parts[0], chunk, name_parts[1], chunksuffix))
                     if os.path.exists(outfilename2):
                         #raise tardisException("getConditionedFilenames : error - %s already exists"% outfilename2)
                         caller.error("getConditionedFilenames : error - %s already exists"% outfilename2)
                         caller.logWriter.info("the last sequences encountered before the error were : %s, %s"%(record1, record2))
                         raise StopIteration
 
-                    outfile2 = open(outfilename2, "w")
+                    outfile2 = open_chunk(outfilename2)
                     chunknames2.append(outfilename2)
         
 
+            # (each record is formatted once - the text written is also what is counted when chunking by bytes)
+            if outformat in ("fasta","fastq"):
+                (text1, text2) = [record.format(outformat) if record is not None else None for record in (record1, record2)]
+            else:
+                (text1, text2) = (record1, record2)
+
             # if two files, check pair-bonding and if OK output both records
             if outfile1 != None and outfile2 != None and pairBond != None:
                 if not pairBond(record1 , record2):
@@ -749,20 +2043,21 @@ def _slow_get_conditioned_filenames(caller, filename1, argchunksize, outdir, inf
                     caller.logWriter.info("the last sequences encountered before the error were : %s, %s"%(record1, record2))
                     raise StopIteration
 
-                
-                if outformat in ("fasta","fastq"):
-                    outfile1.write(record1.format(outformat))
-                    outfile2.write(record2.format(outformat))
-                else:
-                    outfile1.write(record1)
-                    outfile2.write(record2)
+                outfile1.write(text1)
+                outfile2.write(text2)
            
             elif outfile1 != None:                    
-                if outformat in ("fasta","fastq"):
-                    outfile1.write(record1.format(outformat))
-                else:
-                    outfile1.write(record1)
+                outfile1.write(text1)
+
 
+            # if chunking by residues or bytes, the chunk is full once it has reached chunksize
+            if chunksize > 0 and chunk_by != "records":
+                for (check_record, check_text) in ((record1, text1), (record2, text2)):
+                    if check_record is not None:
+                        chunk_weight += len(check_record) if chunk_by == "residues" else len(check_text)
+                if chunk_weight >= chunksize:
+                    mychunk = chunk + 1
+                    chunk_weight = 0
 
             # if need a new chunk, close and yield the old one (if there is one)
             if mychunk > chunk:
@@ -806,7 +2101,16 @@ def _slow_get_conditioned_filenames(caller, filename1, argchunksize, outdir, inf
         #raise e
         raise StopIteration
 
-                
+    # close the inputs - (for compressed inputs, this also checks the decompression completed OK)
+    try:
+        infile1.close()
+        if infile2 is not None:
+            infile2.close()
+    except IOError, e:
+        caller.error("getConditionedFilenames : error reading input - %s"%str(e))
+        caller.logWriter.info("the last sequences encountered before the error were : %s, %s"%(record1, record2))
+        raise StopIteration
+
     chunkInfo = [None, None]
     if outfile1 != None:
         outfile1.close()
@@ -42,16 +42,18 @@ class condorhpcJob(hpc.hpcJob):
         if sensitivity == 0:
             manifest = ["(not listing files for output manifest)"]
         else:
-            manifest = os.listdir(self.workingRoot)
-            if manifestFilter is not None:
-                if not isExcludeFilter:
-                    manifest = [item for item in manifest if re.search(manifestFilter, item)]
-                else:
-                    manifest = [item for item in manifest if re.search(manifestFilter, item) is None]
+            manifest = self.controller.getWorkingFolderSnapshot().getFileNames(manifestFilter, isExcludeFilter)
         #self.logWriter.info("DEBUG: condorhpcJob.getManifest returning listing : %s"%str(manifest))
         return manifest
     
 
+    def setJobFileNames(self):
+        self.scriptfilename = os.path.join(self.workingRoot, "run%d.sh"%self.jobNumber)
+        self.logname=re.sub("\.sh$",".log",self.scriptfilename)
+        self.stderrnamepattern = "%s\.err\.\S+$"%re.escape(os.path.basename(self.scriptfilename))
+        self.stdoutnamepattern = "%s\.out\.\S+$"%re.escape(os.path.basename(self.scriptfilename))
+        self.jobfilename=re.sub("\.sh$",".job",self.scriptfilename)
+
     def runCommand(self, argCommand=None):
         command = argCommand
         if argCommand is None:
@@ -68,7 +70,7 @@ class condorhpcJob(hpc.hpcJob):
                                                                        startdir=self.controller.options["startdir"],
                                                                        input_conditioning=str(self.controller.options["input_conditioning"]))
                 
-                self.scriptfilename = os.path.join(self.workingRoot, "run%d.sh"%self.jobNumber)
+                self.setJobFileNames()
                 if os.path.isfile(self.scriptfilename):
                     raise tutils.tardisException("error %s already exists"%self.scriptfilename)
                 f=open(self.scriptfilename,"w")
@@ -80,10 +82,6 @@ class condorhpcJob(hpc.hpcJob):
 
             # set up the condor jobfile  (one per chunk) (unless already done)
             if self.submitCount == 0:
-                self.logname=re.sub("\.sh$",".log",self.scriptfilename)
-                self.stderrnamepattern = "%s\.err\.\S+$"%re.escape(os.path.basename(self.scriptfilename))
-                self.stdoutnamepattern = "%s\.out\.\S+$"%re.escape(os.path.basename(self.scriptfilename))
-                self.jobfilename=re.sub("\.sh$",".job",self.scriptfilename)
                 jobcode = self.job_template.safe_substitute(script=self.scriptfilename,log=self.logname,rundir=self.workingRoot)
                 self.logWriter.info("condorhpcJob : condor job file is %s"%self.jobfilename)
                 f=open(self.jobfilename,"w")
@@ -108,6 +106,14 @@ class condorhpcJob(hpc.hpcJob):
 	    self.logWriter.info("condorhpcJob : nothing to do")
 
 
+    def setExitFootprint(self, returncode):
+        with open(self.logname,"w") as l:
+            print >> l, "005 Job terminated (job not run)."
+            print >> l, "    (1) Normal termination (return value %d)"%returncode
+
+    def getRestoredStreamFileNames(self):
+        return ("%s.out.0"%self.scriptfilename, "%s.err.0"%self.scriptfilename)
+
     def getExitFootprint(self):
         """
         get the exit footprint of a job - i.e. at least the
@@ -158,14 +164,7 @@ class condorhpcJob(hpc.hpcJob):
             return
 
         self.pollCount += 1
-        if not os.path.isfile(self.logname):   # job might not have started yet - wait , then try again
-            time.sleep(self.POLL_INTERVAL)
-            if not os.path.isfile(self.logname):
-                self.logWriter.info("sendAvailableOutput : so far failed to find log file %s"%self.logname)
-                return
-
-        #self.logWriter.info("DEBUG1 job %s opening %s pollCount %d to check for finished"%(self.jobNumber, self.logname, self.pollCount))
-        self.getExitFootprint()
+        # (whether we are done was found out earlier in the poll cycle - see pollExitFootprint)
 
         if not self.returncode is None:
             #manifest = os.listdir(self.workingRoot)
@@ -178,15 +177,15 @@ class condorhpcJob(hpc.hpcJob):
             productCollector.send(product_manifest)
 
             # get standard output and error filenames from the job
-            stdoutlist = [item for item in os.listdir(self.workingRoot) if re.search(self.stdoutnamepattern, item) != None]
+            stdoutlist = self.getJobFileNames(self.stdoutnamepattern)
             if len(stdoutlist) != 1:
-                self.logWriter.info("condorhpcJob : warning could not find unique match for stdout file using %s, in the manifest ( %s )"%(self.stdoutnamepattern, str(os.listdir(self.workingRoot))))
+                self.logWriter.info("condorhpcJob : warning could not find unique match for stdout file using %s, in the files of this job ( %s )"%(self.stdoutnamepattern, str(self.getJobFileNames())))
             else:
                 self.stdoutfilename =  os.path.join(self.workingRoot,stdoutlist[0])
 
-            stderrlist = [item for item in os.listdir(self.workingRoot) if re.search(self.stderrnamepattern, item) != None]
+            stderrlist = self.getJobFileNames(self.stderrnamepattern)
             if len(stderrlist) != 1:
-                self.logWriter.info("condorhpcJob : warning could not find unique match for stderr file using %s, in the manifest ( %s )"%(self.stderrnamepattern, str(os.listdir(self.workingRoot))))
+                self.logWriter.info("condorhpcJob : warning could not find unique match for stderr file using %s, in the files of this job ( %s )"%(self.stderrnamepattern, str(self.getJobFileNames())))
             else:
                 self.stderrfilename =  os.path.join(self.workingRoot,stderrlist[0])
                 
@@ -1,6 +1,53 @@
 import string
 import tardis.tutils.tutils as tutils
-import os
+import os, re
+
+class workingFolderSnapshot(object):
+    """
+    a listing of the working folder, with the files of each job (run1.sh, run1.sh.log, run-1234_1.stdout etc) indexed by
+    job number. While polling for results, the controller takes one of these at the start of each poll cycle, and
+    another once the logs of the jobs have been read if that found some of them finished, and shares them between all
+    of the jobs, rather than each job listing the folder itself (see run.pollJobs)
+    """
+    JOB_FILE_PATTERN = re.compile("^run(\d+)\.|^run-\d+_(\d+)\.")
+
+    def __init__(self, workingRoot):
+        self.workingRoot = workingRoot
+        self.fileNames = os.listdir(workingRoot)
+        self.fileNameSet = set(self.fileNames)
+        self.filteredFileNames = {}
+        self.jobFileNames = {}
+        for fileName in self.fileNames:
+            match = workingFolderSnapshot.JOB_FILE_PATTERN.search(fileName)
+            if match is not None:
+                self.jobFileNames.setdefault(int(match.group(1) or match.group(2)), []).append(fileName)
+
+    def exists(self, path):
+        # (path is a file in the working folder)
+        return os.path.basename(path) in self.fileNameSet
+
+    def getFileNames(self, pattern = None, isExcludeFilter = False):
+        """
+        return the names of the files in the working folder (optionally, just those matching - or not matching - pattern).
+        Each filtered list is kept, so that all of the jobs polled in a cycle are given the same list
+        """
+        if (pattern, isExcludeFilter) not in self.filteredFileNames:
+            if pattern is None:
+                fileNames = self.fileNames
+            else:
+                regexp = re.compile(pattern)
+                fileNames = [fileName for fileName in self.fileNames if (regexp.search(fileName) is None) == isExcludeFilter]
+            self.filteredFileNames[(pattern, isExcludeFilter)] = fileNames
+        return self.filteredFileNames[(pattern, isExcludeFilter)]
+
+    def getJobFileNames(self, jobNumber, pattern = None):
+        """
+        return the names of the files of job jobNumber (optionally, just those matching pattern)
+        """
+        fileNames = self.jobFileNames.get(jobNumber, [])
+        if pattern is not None:
+            fileNames = [fileName for fileName in fileNames if re.search(pattern, fileName) is not None]
+        return fileNames
 
 class hpcJob(object):
     """
@@ -59,6 +106,10 @@ class hpcJob(object):
         self.workingRoot = controller.workingRoot
         self.jobHeld = False
         self.shell_script_template = None
+        self.conditionedInputs = []   # (input conditioner, conditioned input filename) of each chunk this job processes
+        self.conditionedOutputs = []  # conditioned output filenames of this job (if its results are to be cached)
+        self.pipelinedOutputs = []    # (unconditioner, conditioned output filename) pairs merged as soon as this job is done
+        self.resultCacheKey = None    # key under which the results of this job are to be cached, once it finishes OK
 
     def get_templates(self,default_job_template_name, default_shell_template_name, default_runtime_config_template_name):
         """
@@ -183,9 +234,75 @@ class hpcJob(object):
 
     def waitOnChildren(self):
         return 
+
+    def setJobFileNames(self):
+        """
+        set the names of the script, log and other files for this job (these only depend on the job number)
+        """
+        return
+
+    def resumeJob(self, previousFileNames):
+        """
+        when resuming a previous session (--resume), see whether this job finished cleanly last time, from the exit
+        footprint in its log. If so, the job is marked as done so that its output is collected without running it
+        again, and True is returned. Otherwise the files left by the previous attempt (previousFileNames) are removed,
+        so that the job can be run again as usual
+        """
+        self.setJobFileNames()
+        if self.logname is not None and os.path.isfile(self.logname):
+            self.submitCount = 1
+            self.getExitFootprint()
+            if self.returncode == 0:
+                self.logWriter.info("hpcJob : job %d finished OK in the previous session - not running it again"%self.jobNumber)
+                return True
+
+        self.logWriter.info("hpcJob : job %d did not finish OK in the previous session - it will be run again"%self.jobNumber)
+        self.submitCount = 0
+        self.returncode = None
+        self.state = hpcJob.OK
+        self.stateDescription = ""
+        for fileName in previousFileNames:
+            self.logWriter.info("hpcJob : removing %s"%fileName)
+            os.remove(os.path.join(self.workingRoot, fileName))
+        return False
     
     def getExitFootprint(self):
         return []
+
+    def pollExitFootprint(self):
+        """
+        if we don't yet know this job has finished, and its log is there (according to the current working folder snapshot),
+        read its exit footprint - returns True if this finds that the job has finished. (The log might not be there yet,
+        if the job has not quite got going - in which case we look again next poll cycle.) The output of a job found
+        finished should only be collected using a snapshot taken after this
+        """
+        if self.returncode is not None or self.logname is None:
+            return False
+        if not self.controller.getWorkingFolderSnapshot().exists(self.logname):
+            return False
+        self.getExitFootprint()
+        return self.returncode is not None
+
+    def getJobFileNames(self, pattern = None):
+        """
+        return the names of this job's files in the working folder (optionally, just those matching pattern)
+        according to the current working folder snapshot
+        """
+        return self.controller.getWorkingFolderSnapshot().getJobFileNames(self.jobNumber, pattern)
+
+    def setExitFootprint(self, returncode):
+        """
+        write an exit footprint to the log of a job that was not actually run (e.g. its results were restored
+        from the result cache), so it reads like a job that finished with returncode
+        """
+        return
+
+    def getRestoredStreamFileNames(self):
+        """
+        return the names to give the stdout and stderr of a job that was not actually run (so that they are
+        found as the job's streams)
+        """
+        return (self.stdoutfilename, self.stderrfilename)
     
     def runCommand(self, argCommand=None):
         self.logWriter.info("hpcJob : runCommand is not implemented in the hpcJob base class")
@@ -1,4 +1,4 @@
-import string, os, stat, subprocess, sys, re, time
+import string, os, stat, subprocess, sys, re, time, errno
 
 import tardis.tutils.tutils as tutils
 import tardis.job.hpc as hpc
@@ -9,7 +9,12 @@ class localhpcJob(hpc.hpcJob):
     def __init__(self, controller, command = []):
         super(localhpcJob, self).__init__(controller, command)
             
-        self.workerList  = {} # this will be overwritten by a shared worker list when the new object is inducted
+        self.workerList  = {} # (pid -> job, of the jobs still running) this will be overwritten by a shared worker list when the new object is inducted
+        self.proc = None
+        self.exitStatus = None  # (exit status and resource usage of the job, once it has been waited on)
+        self.rusage = None
+        self.taskCores = tutils.getTaskCores(controller.options, command, logWriter=self.logWriter)   # how much of the host this job is expected to use
+        self.taskMemory = tutils.getTaskMemory(controller.options)
 
         (junk, self.shell_script_template, self.runtime_config_template) = self.get_templates("default_local_job", "local_shell", "basic_local_runtime_environment")
 
@@ -29,22 +34,47 @@ class localhpcJob(hpc.hpcJob):
     def waitOnChildren(self):
         """
         the tardis process has long running children when using this HPC class. We need to wait on this
-        at various points to ensure we track the status of these jobs
+        at various points to ensure we track the status of these jobs.
+        (Each job is a child of this process - when one has finished, it is dropped from the (shared) worker list, and
+        its exit status and resource usage are recorded with the job, and its exit footprint written to its log.
+        The worker list is shared by all the jobs, so this is called once each poll cycle by the controller - see
+        hpcConditioner.waitOnJobs - rather than by each job)
         """
-        for (workerpid, workerResult) in self.workerList.items():
-            if workerResult == (0,0):
-                self.logWriter.info("waiting on %d"%workerpid)
-                try:
-                    self.workerList[workerpid] = os.waitpid(workerpid, os.WNOHANG)
-                    self.logWriter.info("wait returned %s"%str(self.workerList[workerpid]))
-                except OSError as inst:
-                    if inst.errno == errno.ECHILD :
-                        self.logWriter.info("(no child processes)")
-                    else:
-                        self.logWriter.info("(unhandled OSError - re-raising)")
-                        raise inst
+        for (workerpid, job) in self.workerList.items():
+            try:
+                (pid, status, rusage) = os.wait4(workerpid, os.WNOHANG)
+            except OSError as inst:
+                if inst.errno == errno.ECHILD :
+                    self.logWriter.info("(no child process %d - its exit status is lost)"%workerpid)
+                    (pid, status, rusage) = (workerpid, None, None)
+                else:
+                    self.logWriter.info("(unhandled OSError - re-raising)")
+                    raise inst
+            if pid == 0:
+                continue
+            del self.workerList[workerpid]
+            self.logWriter.info("wait on %d returned %s"%(workerpid, str((pid, status))))
+            job.setWorkerExit(status, rusage)
         
         return 
+
+    def setWorkerExit(self, status, rusage):
+        """
+        record the exit status and resource usage of this job, which has just finished , and write its exit footprint
+        """
+        if status is None:
+            self.exitStatus = 255
+        elif os.WIFSIGNALED(status):
+            self.exitStatus = 128 + os.WTERMSIG(status)    # (as a shell would report it)
+        else:
+            self.exitStatus = os.WEXITSTATUS(status)
+        self.rusage = rusage
+        if self.proc is not None:
+            self.proc.returncode = self.exitStatus    # (we have waited on it, so it must not be waited on again)
+        with open(self.logname,"a") as l:
+            if rusage is not None:
+                print >> l, "pid %d resources used user %.2fs system %.2fs maxrss %dkB"%(self.proc.pid, rusage.ru_utime, rusage.ru_stime, rusage.ru_maxrss)
+            print >> l, "pid %d job terminated return value %d"%(self.proc.pid, self.exitStatus)
     
 
     def getManifest(self, manifestFilter = None, isExcludeFilter = False, sensitivity = 0):
@@ -58,12 +88,7 @@ class localhpcJob(hpc.hpcJob):
         if sensitivity == 0:
             manifest = ["(not listing files for output manifest)"]
         else:
-            manifest = os.listdir(self.workingRoot)
-            if manifestFilter is not None:
-                if not isExcludeFilter:
-                    manifest = [item for item in manifest if re.search(manifestFilter, item)]
-                else:
-                    manifest = [item for item in manifest if re.search(manifestFilter, item) is None]
+            manifest = self.controller.getWorkingFolderSnapshot().getFileNames(manifestFilter, isExcludeFilter)
 
         return manifest
 
@@ -92,9 +117,17 @@ class localhpcJob(hpc.hpcJob):
         #return pidList
 
 
-        return [item[0] for item in self.workerList.items() if item[1] == (0,0)]
+        return self.workerList.keys()
         
 
+    def setJobFileNames(self):
+        self.scriptfilename = os.path.join(self.workingRoot, "run%d.sh"%self.jobNumber)
+        self.stdoutfilename = "%s.stdout"%self.scriptfilename
+        self.stderrfilename = "%s.stderr"%self.scriptfilename
+        self.stdoutnamepattern = os.path.basename(self.stdoutfilename)
+        self.stderrnamepattern = os.path.basename(self.stderrfilename)
+        self.logname = "%s.log"%self.scriptfilename
+
     def runCommand(self, argCommand=None):
         command = argCommand
         if argCommand is None:
@@ -112,7 +145,7 @@ class localhpcJob(hpc.hpcJob):
                                                                        startdir=self.controller.options["startdir"],\
                                                                        input_conditioning=str(self.controller.options["input_conditioning"]))
                 
-                self.scriptfilename = os.path.join(self.workingRoot, "run%d.sh"%self.jobNumber)
+                self.setJobFileNames()
                 if os.path.isfile(self.scriptfilename):
                     raise tutils.tardisException("error %s already exists"%self.scriptfilename)
                 f=open(self.scriptfilename,"w")
@@ -121,27 +154,22 @@ class localhpcJob(hpc.hpcJob):
                 f.close()
                 os.chmod(self.scriptfilename, stat.S_IRWXU | stat.S_IRGRP |  stat.S_IXGRP | stat.S_IROTH | stat.S_IXOTH )
 
-                self.stdoutfilename = "%s.stdout"%self.scriptfilename
-                self.stderrfilename = "%s.stderr"%self.scriptfilename
-                self.stdoutnamepattern = os.path.basename(self.stdoutfilename)
-                self.stderrnamepattern = os.path.basename(self.stderrfilename)
-
-                self.logname = "%s.log"%self.scriptfilename
                 self.submitCount += 1
 
             # launch the job if we can.
             # we can launch the job if jobs running < max_processes
-            # first update process statuses
-            self.waitOnChildren()
-            
+            # (the process statuses are updated once each poll cycle - see hpcConditioner.waitOnJobs)
             running_processes = self.getRunningProcesses()
             #self.logWriter.info("running jobs : %s"%str(running_processes))
             #jobs_running = hpcConditioner.getJobSubmittedCount() - hpcConditioner.getResultsSentCount()
-            if len(running_processes)  < self.controller.options["max_processes"]:
+            # (as well as the number of processes, the cores and memory the running jobs are expected to use are limited)
+            if len(running_processes)  < self.controller.options["max_processes"] and \
+                   tutils.isWithinHostBudget(self.controller.options, self.workerList.values(), self):
                 self.logWriter.info("localhpcJob : launching %s"%self.scriptfilename)
                 self.jobHeld = False
             else:
-                self.logWriter.info("localhpcJob : not launching %s (jobs_running = %s)"%(self.scriptfilename, str(running_processes)))
+                self.logWriter.info("localhpcJob : not launching %s (jobs_running = %s , using %d cores and %dMB)"%(self.scriptfilename, str(running_processes), \
+                                    sum([j.taskCores for j in self.workerList.values()]), sum([j.taskMemory for j in self.workerList.values()])))
                 #self.logWriter.info("DEBUGx : job list is %s"%str(hpcConditioner.jobList))
                 #self.logWriter.info("DEBUGx : job submit counts are  %s"%str([j.submitCount for j in hpcConditioner.jobList]))
                 #self.logWriter.info("DEBUGx : jobs sent are  %d"%hpcConditioner.getResultsSentCount())
@@ -152,62 +180,33 @@ class localhpcJob(hpc.hpcJob):
             if self.controller.options["dry_run"] :
                 self.logWriter.info("localhpcJob : this is a dry run - not launching the job")
             else:
-                self.logWriter.info("localhpcJob : forking to execute %s"%str(local_submit))
+                self.logWriter.info("localhpcJob : launching %s"%str(local_submit))
                 self.jobHeld = False
 
-                # now fork - if we are the parent, return, if we are the child execute the job and the exit
-                # before forking, however, do an asynchronous waitpid to clean up defunct processes
-                # (currently we don't do anything with these results - we just want to
-                # do a wait so that the child processes can be removed from the process table
-                #self.logWriter.info("localhpcJob : checking waits")
-                #try:
-                #    pidresults = os.waitpid(0, os.WNOHANG)
-                #    self.logWriter.info("wait returned : %s"%str(pidresults))  # returns [(pid, status), (pid,status),...]
-                #    pidresultsDict = dict([(pidresult[0], pidresult) for pidresult in [pidresults]])
-                #    self.workerList.update(pidresultsDict)
-                #except OSError as inst:
-                #    if inst.errno == 10:
-                #        self.logWriter.info("(no child processes)")
-                #    else:
-                #        self.logWriter.info("(unknown OSError - re-raising)")
-                #        raise inst
-
+                # the job runs as a child of this process - it is waited on (see waitOnChildren), rather than
+                # communicated with, so carries on after we return
                 try:
-                    me = os.fork()
-                    if me == 0:
-                        mypid = os.getpid()
-                        with open(self.logname,"w") as l:
-                            print >> l, "job starting pid %d"%mypid 
-
-                        fstdout=open(self.stdoutfilename,"w")
-                        fstderr=open(self.stderrfilename,"w")
-
+                    with open(self.stdoutfilename,"w") as fstdout, open(self.stderrfilename,"w") as fstderr:
                         self.proc = subprocess.Popen(local_submit,stdout=fstdout, stderr=fstderr)
-                        self.proc.communicate()
-                        fstdout.close()
-                        fstderr.close()                    
-                        self.submitreturncode = self.proc.returncode                
-                        self.logWriter.info("localhpcJob : %s (pid %d) has returned (status %s)"%(str(local_submit), os.getpid(), self.submitreturncode))
-                        self.logWriter.info("localhpcJob : stdout was written to %s"%self.stdoutfilename)
-                        self.logWriter.info("localhpcJob : stderr was written to %s"%self.stderrfilename)
-                        self.logWriter.info("localhpcJob : child %d exiting"%os.getpid())
-                        with open(self.logname,"a") as l:
-                            print >> l, "pid %d job terminated return value %d"%(os.getpid(), self.submitreturncode)
-                        sys.exit(0)
-                    else:
-                        self.workerList[me] = (0,0)
-                        self.submitCount += 1
-                        self.submitreturncode = 0
-                        self.logWriter.info("localhpcJob : parent returning")
-                        return
+                    with open(self.logname,"w") as l:
+                        print >> l, "job starting pid %d"%self.proc.pid
+                    self.workerList[self.proc.pid] = self
+                    self.submitCount += 1
+                    self.submitreturncode = 0
+                    self.logWriter.info("localhpcJob : %s is running (pid %d)"%(str(local_submit), self.proc.pid))
+                    return
                 except OSError,e:
-                    self.logWriter.info("localhpcJob : warning - fork of %s failed with OSError : %s"%(self.scriptfilename, e))
+                    self.logWriter.info("localhpcJob : warning - launch of %s failed with OSError : %s"%(self.scriptfilename, e))
                     self.logWriter.info("localhpcJob : job %s held "%self.scriptfilename)
                     self.jobHeld = True
 
         else:
 	    self.logWriter.info("localhpcJob : nothing to do")
 
+    def setExitFootprint(self, returncode):
+        with open(self.logname,"w") as l:
+            print >> l, "job not run - job terminated return value %d"%returncode
+
     def getExitFootprint(self):
         """
         get the exit footprint of a job - i.e. at least the
@@ -221,8 +220,18 @@ class localhpcJob(hpc.hpcJob):
         
         """
 
-        # no point looking if we haven't started
-        if self.jobHeld :
+        # no point looking if we haven't started - or again, once we have found it
+        if self.jobHeld or self.returncode is not None:
+            return
+
+        # if we launched the job, we know whether it has finished without reading the log (its exit status is
+        # recorded when it is waited on)
+        if self.proc is not None:
+            if self.exitStatus is not None:
+                self.logWriter.info("localhpcJob : this job (%d) looks finished"%self.jobNumber)
+                self.returncode = self.exitStatus
+                if self.returncode != 0:
+                    self.error("job number %d returned %d - setting error"%(self.jobNumber, self.returncode))
             return
 
         r=open(self.logname)
@@ -261,11 +270,9 @@ class localhpcJob(hpc.hpcJob):
         if self.sent:
             return
 
-        # don't look any further if we haven't started - instead, update the job status information
-        # (potentially allowing held jobs to be started, when the outer loop that calls this , goes on
-        # to call retry
+        # don't look any further if we haven't started (held jobs may be started when the outer loop that calls
+        # this, goes on to call retry)
         if self.jobHeld:
-            self.waitOnChildren()
             return
 
         self.pollCount += 1
@@ -276,16 +283,7 @@ class localhpcJob(hpc.hpcJob):
             time.sleep(self.POLL_INTERVAL)
             return
 
-        # protect against race condition , accessing log file before ready
-        if not os.path.isfile(self.logname):   # job might not have quite got going yet - wait , then try again
-            time.sleep(self.POLL_INTERVAL)
-            if not os.path.isfile(self.logname):
-                self.logWriter.info("sendAvailableOutput : so far failed to find log file %s"%self.logname)
-                return
-
-
-        #self.logWriter.info("DEBUG1 job %s opening %s pollCount %d to check for finished"%(self.jobNumber, self.logname, self.pollCount))
-        self.getExitFootprint()
+        # (whether we are done was found out earlier in the poll cycle - see pollExitFootprint)
         
 
         if not self.returncode is None:
@@ -298,13 +296,13 @@ class localhpcJob(hpc.hpcJob):
             
 
             # get standard output and error filenames from the job
-            stdoutlist = [item for item in os.listdir(self.workingRoot) if re.search(self.stdoutnamepattern, item) != None]
+            stdoutlist = self.getJobFileNames(self.stdoutnamepattern)
             if len(stdoutlist) != 1:
-                self.logWriter.info("localhpcJob : warning could not find unique match for stdout file using %s, in the manifest ( %s )"%(self.stdoutnamepattern, str(os.listdir(self.workingRoot))))
+                self.logWriter.info("localhpcJob : warning could not find unique match for stdout file using %s, in the files of this job ( %s )"%(self.stdoutnamepattern, str(self.getJobFileNames())))
 
-            stderrlist = [item for item in os.listdir(self.workingRoot) if re.search(self.stderrnamepattern, item) != None]
+            stderrlist = self.getJobFileNames(self.stderrnamepattern)
             if len(stderrlist) != 1:
-                self.logWriter.info("localhpcJob: warning could not find unique match for stderr file using %s, in the manifest ( %s )"%(self.stderrnamepattern, str(os.listdir(self.workingRoot))))
+                self.logWriter.info("localhpcJob: warning could not find unique match for stderr file using %s, in the files of this job ( %s )"%(self.stderrnamepattern, str(self.getJobFileNames())))
                 
             self.sent = True
         
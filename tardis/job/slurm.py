@@ -66,16 +66,17 @@ class slurmhpcJob(hpc.hpcJob):
         if sensitivity == 0:
             manifest = ["(not listing files for output manifest)"]
         else:
-            manifest = os.listdir(self.workingRoot)
-            if manifestFilter is not None:
-                if not isExcludeFilter:
-                    manifest = [item for item in manifest if re.search(manifestFilter, item)]
-                else:
-                    manifest = [item for item in manifest if re.search(manifestFilter, item) is None]
+            manifest = self.controller.getWorkingFolderSnapshot().getFileNames(manifestFilter, isExcludeFilter)
         #self.logWriter.info("DEBUG: slurmhpcJob.getManifest returning listing : %s"%str(manifest))
         return manifest
     
 
+    def setJobFileNames(self):
+        self.scriptfilename = os.path.join(self.workingRoot, "run%d.sh"%self.jobNumber)
+        self.logname=re.sub("\.sh$",".tlog",self.scriptfilename)
+        self.stderrnamepattern = "^run-\d+_%s.stderr$"%self.jobNumber
+        self.stdoutnamepattern = "^run-\d+_%s.stdout$"%self.jobNumber
+
     def runCommand(self, argCommand=None):
         command = argCommand
         if argCommand is None:
@@ -86,12 +87,11 @@ class slurmhpcJob(hpc.hpcJob):
 
             # set up the shell scriptfile(s) (one per chunk) (unless this is a rerun in which case its already been done)
             if self.submitCount == 0:
-                self.scriptfilename = os.path.join(self.workingRoot, "run%d.sh"%self.jobNumber)
+                self.setJobFileNames()
                 if os.path.isfile(self.scriptfilename):
                     raise tardis.tardisException("error %s already exists"%self.scriptfilename)
                 
                 runtime_environmentcode = self.runtime_config_template.safe_substitute() # currently no templating actually done here
-                self.logname=re.sub("\.sh$",".tlog",self.scriptfilename)
                 shellcode = self.shell_script_template.safe_substitute(configure_runtime_environment=runtime_environmentcode, \
                                                                        hpcdir=self.workingRoot,\
                                                                        command=string.join(self.command," "),\
@@ -103,15 +103,19 @@ class slurmhpcJob(hpc.hpcJob):
                 f.writelines(shellcode)
                 f.close()
                 os.chmod(self.scriptfilename, stat.S_IRWXU | stat.S_IRGRP |  stat.S_IXGRP | stat.S_IROTH | stat.S_IXOTH )
-
-
-                self.stderrnamepattern = "^run-\d+_%s.stderr$"%self.jobNumber
-                self.stdoutnamepattern = "^run-\d+_%s.stdout$"%self.jobNumber
                 
         else:
 	    self.logWriter.info("slurmJob : nothing to do")
 
 
+    def setExitFootprint(self, returncode):
+        with open(self.logname,"w") as l:
+            print >> l, "job_ended=%s"%time.strftime("%Y-%m-%d %H:%M:%S")
+            print >> l, "job_exit_code=%d"%returncode
+
+    def getRestoredStreamFileNames(self):
+        return (os.path.join(self.workingRoot, "run-0_%d.stdout"%self.jobNumber), os.path.join(self.workingRoot, "run-0_%d.stderr"%self.jobNumber))
+
     def getExitFootprint(self):
         """
         get the exit footprint of a job - i.e. at least the
@@ -139,14 +143,7 @@ class slurmhpcJob(hpc.hpcJob):
             return
 
         self.pollCount += 1
-        if not os.path.isfile(self.logname):   # job might not have started yet - wait , then try again
-            time.sleep(self.POLL_INTERVAL)
-            if not os.path.isfile(self.logname):
-                self.logWriter.info("sendAvailableOutput : so far failed to find log file %s"%self.logname)
-                return
-
-        #self.logWriter.info("DEBUG1 job %s opening %s pollCount %d to check for finished"%(self.jobNumber, self.logname, self.pollCount))
-        self.getExitFootprint()
+        # (whether we are done was found out earlier in the poll cycle - see pollExitFootprint)
 
         if not self.returncode is None:
             #manifest = os.listdir(self.workingRoot)
@@ -159,15 +156,15 @@ class slurmhpcJob(hpc.hpcJob):
             productCollector.send(product_manifest)
 
             # get standard output and error filenames from the job
-            stdoutlist = [item for item in os.listdir(self.workingRoot) if re.search(self.stdoutnamepattern, item) != None]
+            stdoutlist = self.getJobFileNames(self.stdoutnamepattern)
             if len(stdoutlist) != 1:
-                self.logWriter.info("slurmhpcJob : warning could not find unique match for stdout file using %s, in the manifest ( %s )"%(self.stdoutnamepattern, str(os.listdir(self.workingRoot))))
+                self.logWriter.info("slurmhpcJob : warning could not find unique match for stdout file using %s, in the files of this job ( %s )"%(self.stdoutnamepattern, str(self.getJobFileNames())))
             else:
                 self.stdoutfilename =  os.path.join(self.workingRoot,stdoutlist[0])
 
-            stderrlist = [item for item in os.listdir(self.workingRoot) if re.search(self.stderrnamepattern, item) != None]
+            stderrlist = self.getJobFileNames(self.stderrnamepattern)
             if len(stderrlist) != 1:
-                self.logWriter.info("slurmhpcJob : warning could not find unique match for stderr file using %s, in the manifest ( %s )"%(self.stderrnamepattern, str(os.listdir(self.workingRoot))))
+                self.logWriter.info("slurmhpcJob : warning could not find unique match for stderr file using %s, in the files of this job ( %s )"%(self.stderrnamepattern, str(self.getJobFileNames())))
             else:
                 self.stderrfilename =  os.path.join(self.workingRoot,stderrlist[0])
                 
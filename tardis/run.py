@@ -1,5 +1,5 @@
 #!/usr/bin/env python
-import argparse, re, sys, time, string
+import argparse, re, sys, time, string, threading
 
 import tardis.tutils.tutils as tutils
 import tardis.conditioner.factory as factory
@@ -8,6 +8,8 @@ import tardis.job.local as local
 import tardis.job.hpc as hpc
 from tardis.tutils.tutils import tardisException
 
+JOB_POLLER_INTERVAL = 1 # seconds between polls of the jobs submitted so far, while more are being submitted (engine = "threaded")
+
 def run(toolargs, options, stdout = sys.stdout, stderr=sys.stderr, checkCommandIsValid = True):
     # some merging / prioritisation of options is needed in some cases.
     msg_for_log=None # we don't have a logger yet - will log this later when we do
@@ -62,65 +64,96 @@ def run(toolargs, options, stdout = sys.stdout, stderr=sys.stderr, checkCommandI
     #hpcConditioner.logWriter.info("main : requesting conditioned commands")
     conditionedCommandIter = c.getConditionedCommandGenerator(dcPrototype)
     conditionedInputGenerators = dcPrototype.getConditionedInputGenerators()    
-    for conditionedInputs in conditionedInputGenerators:
-        dcPrototype.distributeAvailableInputs(conditionedInputs)
-        cmd = conditionedCommandIter.next()
-
-        c.logWriter.info("setting up job for conditioned command : %s"%str(cmd)) 
-        job = c.gethpcJob(cmd)
-        job.runCommand()
-
 
-        # check for partially submitted jobs here in case we are rate limited - otherwise we will have to wait until all chunks
-        # have been written. This will also do a wait on the jobs that are running
-        if c.hpcClass == local.localhpcJob:
-            c.logWriter.info("(running jobs locally and there are %d partially submitted jobs)"%len(c.getUnsubmittedJobs()))
-            if len(c.getUnsubmittedJobs()) > 0:
-                c.retryJobSubmission(maxRetries = 1, retryPause = 1)
+    # with the threaded engine, the jobs submitted so far are polled in the background (see jobPoller), while the
+    # input is split. Each job is set up under lock - the lock is only released while the next chunk is split
+    lock = c.lock
+    poller = None
+    for conditionedInputs in conditionedInputGenerators:
+        with lock:
+            dcPrototype.distributeAvailableInputs(conditionedInputs)
+            cmd = conditionedCommandIter.next()
+
+            c.logWriter.info("setting up job for conditioned command : %s"%str(cmd)) 
+            job = c.gethpcJob(cmd)
+            job.pipelinedOutputs = [(dc, dc.conditionedOutputFileNames[-1]) for dc in dcPrototype.outputUnconditioners \
+                                    if dc.isOutputPipelined() and len(dc.conditionedOutputFileNames) > 0 and dc.conditionedOutputFileNames[-1] is not None]
+
+            # (the threaded engine starts polling the jobs as soon as there are any - the output unconditioners are
+            # known once the first command has been conditioned)
+            if (options.get("engine", None) or "sequential") == "threaded" and poller is None and isPolling(options, dcPrototype):
+                poller = jobPoller(c, lock, dcPrototype.getOutputUnconditionerCollectors())
+                poller.start()
+
+            if options.get("resume", None) is not None and c.resumeJob(job, dcPrototype):
+                continue    # (this job finished OK in the session being resumed)
+            if c.restoreJobResults(job, dcPrototype):
+                continue    # (the results of this command on this chunk were cached by an earlier session)
+
+            # note which chunks this job uses - so that any virtual chunk it does not read can be released when it is
+            # done, and (if the conditioned input on disk is limited) its chunks removed
+            job.conditionedInputs = [(dc, dc.conditionedInputFileNames[-1]) for dc in dcPrototype.getDistinctInputConditioners() \
+                                     if len(dc.conditionedInputFileNames) > 0]
+            # (update the status of the running jobs first, so that the job can use any process that has been freed up)
+            c.waitOnJobs()
+            job.runCommand()
+
+            # if the conditioned input on disk is limited, wait for room before splitting any more
+            if tutils.isConditionedInputThrottled(options):
+                c.waitForConditionedInputSpace(dcPrototype, poller)
+
+
+            # check for partially submitted jobs here in case we are rate limited - otherwise we will have to wait until all chunks
+            # have been written. This will also do a wait on the jobs that are running. (With the threaded engine, the poller
+            # is already keeping track of the jobs that are running, so there is no need to pause)
+            if c.hpcClass == local.localhpcJob:
+                c.logWriter.info("(running jobs locally and there are %d partially submitted jobs)"%len(c.getUnsubmittedJobs()))
+                if len(c.getUnsubmittedJobs()) > 0:
+                    c.retryJobSubmission(maxRetries = 1, retryPause = 1 if poller is None else 0)
 
     # for some hpc types (e.g. slurm array jobs) , runCommand does not actually run the command, it
     # just sets up the comamnd. Thse are then all batch submitted here : 
-    c.launchArrayJobs()
+    with lock:
+        c.launchArrayJobs()
+
+    # (the threaded engine carries on polling until all of the jobs are done)
+    if poller is not None:
+        poller.finish()
     
                     
 
     # if in a workflow, or conditioning output, and not a dry run , poll for results
-    if (options["in_workflow"] or len(dcPrototype.outputUnconditioners) > 0) and not options["dry_run"] :
+    if isPolling(options, dcPrototype):
         c.logWriter.info("tardis.py : done setting up jobs - polling for results (and submitting any queued jobs)")
-        for dc in dcPrototype.outputUnconditioners:    # (if in a workflow and no unconditioners were specified, then a default one
-                                                           # will have been created)
-
-            # results are sent to each output unconditioner
-            # clear sent flag
-            for job in c.jobList:
-                job.sent = False
+        # (if in a workflow and no unconditioners were specified, then a default one will have been created.) The jobs are
+        # polled once, and the results of each finished job are sent to all of the output unconditioners
+        if poller is not None:
+            (outputCollector, productCollector) = poller.collectors
+        else:
+            (outputCollector, productCollector) = dcPrototype.getOutputUnconditionerCollectors()
 
-            poll_count = 0
-            while True:
-                poll_count +=1
-                if poll_count * hpc.hpcJob.POLL_INTERVAL > hpc.hpcJob.POLL_DURATION:
-                    raise tardisException("error in tardis.py session - bailing out as we have been hanging around waiting for output for far too long ! ")
-                
-                
-                unsentJobs = [ job for job in c.jobList if not job.sent ]
-                if len(unsentJobs) == 0:
-                    break
+        poll_count = 0
+        while True:
+            poll_count +=1
+            if poll_count * hpc.hpcJob.POLL_INTERVAL > hpc.hpcJob.POLL_DURATION:
+                raise tardisException("error in tardis.py session - bailing out as we have been hanging around waiting for output for far too long ! ")
+            
+            
+            unsentJobs = [ job for job in c.jobList if not job.sent ]
+            if len(unsentJobs) == 0:
+                break
 
-                # retry jobs here in case we are rate limited
-                if len(c.getUnsubmittedJobs()) > 0:
-                    c.logWriter.info("(there are %d partially submitted jobs)"%len(c.getUnsubmittedJobs()))
-                    c.retryJobSubmission(maxRetries = hpc.hpcJob.SUBMIT_RETRIES, retryPause = hpc.hpcJob.SUBMIT_RETRY_PAUSE)
+            # retry jobs here in case we are rate limited
+            if len(c.getUnsubmittedJobs()) > 0:
+                c.logWriter.info("(there are %d partially submitted jobs)"%len(c.getUnsubmittedJobs()))
+                c.retryJobSubmission(maxRetries = hpc.hpcJob.SUBMIT_RETRIES, retryPause = hpc.hpcJob.SUBMIT_RETRY_PAUSE)
 
-                sent_count = 0 # count how many jobs just finished 
-                for unsentJob in unsentJobs:
-                    unsentJob.sendAvailableOutput(dc.outputCollector, dc.productCollector)
-                    if unsentJob.sent:
-                        sent_count += 1
+            sent_count = pollJobs(c, unsentJobs, outputCollector, productCollector) # count how many jobs just finished 
 
-                # if no jobs just finished , wait for awhile , otherwise go back for more output immediately
-                if sent_count == 0:
-                    time.sleep(hpc.hpcJob.POLL_INTERVAL)
-                    
+            # if no jobs just finished , wait for awhile , otherwise go back for more output immediately
+            if sent_count == 0:
+                time.sleep(hpc.hpcJob.POLL_INTERVAL)
+                
 
 
 
@@ -200,6 +233,108 @@ def run(toolargs, options, stdout = sys.stdout, stderr=sys.stderr, checkCommandI
 
 
         
+def isPolling(options, dcPrototype):
+    """
+    if in a workflow, or conditioning output, and not a dry run , we poll for results
+    """
+    return (options["in_workflow"] or len(dcPrototype.outputUnconditioners) > 0) and not options["dry_run"]
+
+def pollJobs(c, unsentJobs, outputCollector, productCollector):
+    """
+    poll each of unsentJobs once , and send the output of those that have finished to the collectors - returns
+    how many have finished
+    """
+    # all the jobs polled this cycle share one listing of the working folder , and are reaped (if they are children
+    # of this process) once
+    c.expireWorkingFolderSnapshot()
+    c.waitOnJobs()
+
+    # first see which jobs have finished - then, if any have, the output of those is collected using a second listing,
+    # taken after their logs were read (so that it is sure to include all of their output). So the folder is listed at
+    # most twice each cycle, however many jobs finish
+    finished_count = len([unsentJob for unsentJob in unsentJobs if not unsentJob.sent and unsentJob.pollExitFootprint()])
+    if finished_count > 0:
+        c.expireWorkingFolderSnapshot()
+
+    sent_count = 0
+    for unsentJob in unsentJobs:
+        unsentJob.sendAvailableOutput(outputCollector, productCollector)
+        if unsentJob.sent:
+            sent_count += 1
+            c.cacheJobResults(unsentJob)
+            for (dc, fileName) in unsentJob.conditionedInputs:
+                dc.releaseConditionedInput(fileName)
+            # (merge its output now, if it is next in line - otherwise it is held back until it is)
+            for (dc, fileName) in unsentJob.pipelinedOutputs:
+                dc.mergeAvailableOutput(fileName)
+    return sent_count
+
+class jobPoller(threading.Thread):
+    """
+    (engine = "threaded") this polls the jobs submitted so far, in the background while the input is still being
+    split and more jobs submitted - so that held jobs are launched, and the output of finished jobs collected and
+    merged, while splitting is still going on. Once all the jobs have been submitted (see
+    finish), it carries on until they are all done.
+    The jobs and conditioners are only used under lock , by either thread
+    """
+    def __init__(self, controller, lock, collectors):
+        super(jobPoller, self).__init__()
+        self.daemon = True
+        self.controller = controller
+        self.lock = lock
+        self.collectors = collectors
+        self.allSubmitted = threading.Event()
+        self.pollRequested = threading.Event()
+        self.exc_info = None
+
+    def run(self):
+        try:
+            (started, lastRetry) = (time.time(), 0)
+            while True:
+                if time.time() - started > hpc.hpcJob.POLL_DURATION:
+                    raise tardisException("error in tardis.py session - bailing out as we have been hanging around waiting for output for far too long ! ")
+
+                with self.lock:
+                    # (jobs which are only set up, not submitted - e.g. slurm array jobs - are left until they are)
+                    allSubmitted = self.allSubmitted.is_set()
+                    unsentJobs = [ job for job in self.controller.jobList if not job.sent and (allSubmitted or job.submitCount > 0) ]
+                    if allSubmitted and len(unsentJobs) == 0:
+                        break
+
+                    sent_count = pollJobs(self.controller, unsentJobs, self.collectors[0], self.collectors[1])
+
+                    # (local jobs are held until there is a free process, so retry these every time - any freed up
+                    # by the jobs that have just finished are used straight away)
+                    if len(self.controller.getUnsubmittedJobs()) > 0 and (self.controller.hpcClass == local.localhpcJob or \
+                                                                          time.time() - lastRetry >= hpc.hpcJob.SUBMIT_RETRY_PAUSE):
+                        self.controller.retryJobSubmission(maxRetries = 1, retryPause = 0)
+                        lastRetry = time.time()
+
+                    # (wake up the splitting thread, if it is waiting for jobs to finish and free up conditioned input)
+                    self.controller.jobsPolled.notify_all()
+
+                if sent_count == 0:
+                    self.pollRequested.wait(JOB_POLLER_INTERVAL)
+                self.pollRequested.clear()
+        except Exception:
+            self.exc_info = sys.exc_info()
+
+    def requestPoll(self):
+        """
+        poll the jobs again straight away, rather than at the end of the current interval
+        """
+        self.pollRequested.set()
+
+    def finish(self):
+        """
+        all of the jobs have been submitted - wait until they are done , and raise any exception the poller ran into
+        """
+        self.allSubmitted.set()
+        while self.isAlive():
+            self.join(JOB_POLLER_INTERVAL)  # (a timeout , so that we can still be interrupted)
+        if self.exc_info is not None:
+            raise self.exc_info[0], self.exc_info[1], self.exc_info[2]
+
 def tardis_main():
     parser = argparse.ArgumentParser(description='Condition a command for execution on a cluster.')
     parser.add_argument('-w', '--in-workflow', dest='in_workflow', action='store_const', const=True, help='Run the command as part of a workflow. After launching all of the jobs, tardis waits for all outputs, which are then collated and merged into a single output file, as specified by the output file path in the original command; all of the temporary input files (for example chunks of uncompressed fastq) are deleted provided all prior steps completed without error (if there was an error they are left there to assist with debugging). Without this option, the program exits immediately after launching all of the jobs, and output is left un-collated in the scratch folder created by this script, and no cleanup is done.')
@@ -207,6 +342,22 @@ def tardis_main():
     parser.add_argument('--from', '--from-record', dest='from_record', type=int, metavar='N', help='When conditioning the input file(s), only use records from the input file after or including N (where that is logical record number . e.g. in a fastq file, start from record number N means start from sequence N). By combining this option with -to, you can process slices of a file. Note that this option has no affect when processing a list-file.')
     parser.add_argument('--to', '--to-record', dest='to_record', type=int, metavar='N', help='When conditioning the input file(s), only use records up to and including the record N (where that is logical record number . e.g. in a fastq file, process up to record number N means process up to and including sequence N). By combining this option with    -from, you can process slices of a file. Note that this option has no affect when processing a list-file.')
     parser.add_argument('-s', dest='samplerate', type=float, metavar='RATE', help='Rather than process the entire input file(s), a random sample of the records is processed. RATE is the probability that a given record will be sampled. For example -s .001 will result in roughly 1 in every 1000 logical records being sampled.  When the -s option is specified, tardis does not clean up the conditioned input and output . e.g. all of the uncompressed fastq sample fragments would be retained. These are retained to assist with the Q/C work that is normally associated with a sampled run. Paired fastq input files are sampled in lock-step, provided the paired fastq conditioning directive is used for both files.')
+    parser.add_argument('--virtual-chunks', dest='virtual_chunks', action='store_const', const=True, help='When conditioning uncompressed input file(s), do not write copies of each chunk to the tardis working folder - instead just index the record-aligned byte offsets of each chunk, and serve each job its chunk of the original file through a named pipe. This roughly halves the I/O needed to split large inputs, and needs almost no scratch space, but the command must read its input once, sequentially. Compressed inputs, and runs using sampling, length bounds, a record filter or format conversion, are chunked as usual.')
+    parser.add_argument('--max-split-processes', dest='max_split_processes', type=int, metavar='N', help='when processing a list file, split up to N of the listed files at once (the chunks of the first file are passed on for job submission as they are written, while the following files are split ahead in parallel). Chunks are still submitted in list order. The default is to split the listed files one after another. Also, a single BGZF (e.g. bgzip) compressed input is split as N block ranges in parallel.')
+    parser.add_argument('--sample-seed', dest='sample_seed', type=int, metavar='N', help='when sampling (-s), use N to seed the random sample, so that the same records are sampled if the run is repeated. (If no seed is given, one is chosen at random and logged). Both files of a pair are always sampled using the same seed, so that the same records are selected from each - and a given seed selects the same records whether or not fast_sequence_input_conditioning is used.')
+    parser.add_argument('--adaptive-chunksize', dest='adaptive_chunksize', action='store_const', const=True, help='when calculating the chunk size (chunksize -1), estimate the number of records in the input from the first few MB of the file and its size, rather than reading the whole file to count them. When splitting a single fasta or fastq file with fast sequence input conditioning, the chunk size is then corrected as the split proceeds, so that close to max_tasks chunks are written. (Paired and listed inputs are split using the estimated chunk size, as the files of a pair must be split identically)')
+    parser.add_argument('--compress-chunks', dest='compress_chunks', action='store_const', const=True, help='gzip (at the fastest compression level) the chunks that input files are split into. The chunk names keep a .gz suffix, so this is only useful if the command can read gzipped input directly - e.g. bwa, bowtie. This greatly reduces the scratch space and I/O needed to split large inputs.')
+    parser.add_argument('--chunk-by', dest='chunk_by', type=str, choices=['records', 'residues', 'bytes'], help='how fasta and fastq chunks are sized. records (the default) means each chunk holds chunksize sequences. residues means each chunk is closed once it holds at least chunksize residues (bases or amino acids), and bytes once it holds at least chunksize bytes - so that e.g. BLAST jobs over a mixture of short and long sequences each get a similar amount of work. With chunksize -1, the chunksize is calculated from the (estimated) total residues or bytes of the input, to yield about max_tasks chunks. (Paired inputs are sized by the residues or bytes of both files together, using the standard conditioner)')
+    parser.add_argument('--max-conditioned-chunks', dest='max_conditioned_chunks', type=int, metavar='N', help='(local jobs only) cap the scratch space used by the conditioned input, by pausing the split whenever N chunks are on disk, and resuming as jobs finish and their chunks are removed. (The chunks of jobs that fail are kept, and this limit is not applied if conditioned data is being kept, e.g. when sampling)')
+    parser.add_argument('--max-conditioned-bytes', dest='max_conditioned_bytes', type=int, metavar='N', help='(local jobs only) as --max-conditioned-chunks, but pause the split whenever the chunks on disk add up to N bytes or more')
+    parser.add_argument('--chunk-cache-size', dest='chunk_cache_size', type=int, metavar='MB', help='keep the chunks that inputs are split into in a cache under the root folder, of up to MB megabytes (least recently used chunks are evicted first). A later session that conditions the same input file(s) (same path, size and modification time) in the same way - e.g. with the same chunksize - links the cached chunks into its working folder rather than splitting the input again. The default (0) is not to cache chunks. (Virtual chunks, and runs that sample without a --sample-seed or limit the conditioned input on disk, are not cached)')
+    parser.add_argument('--result-cache-size', dest='result_cache_size', type=int, metavar='MB', help='keep the results (output files, stdout and stderr) of each job that finishes OK in a cache under the root folder, of up to MB megabytes (least recently used results are evicted first). A later session that would run the same command (same tool binary, options and output names) on the same chunk of the same input (same path, size and modification time, split in the same way) links in the cached results, rather than running the job again. The default (0) is not to cache results. (Commands which write products, or outputs named by a basename, and runs that sample without a --sample-seed or use a record filter, are not cached)')
+    parser.add_argument('--resume', dest='resume', type=str, metavar='DIR', help='resume the tardis session whose working folder is DIR (e.g. after some jobs failed), rather than starting a new one. The chunks of input written by that session are re-used rather than conditioning the input again, and only the jobs which did not finish OK (according to their logs) are run again, before the output is unconditioned as usual. The command and options must be the same as for the original session.')
+    parser.add_argument('--max-cores', dest='max_cores', type=int, metavar='N', help='(local jobs only) only start a job if the cores the running jobs are expected to use (see --cores-per-task) would not add up to more than N. (By default only the number of jobs running at once is limited, by max_processes)')
+    parser.add_argument('--max-memory', dest='max_memory', type=int, metavar='MB', help='(local jobs only) only start a job if the memory the running jobs are expected to use (see --memory-per-task) would not add up to more than MB megabytes')
+    parser.add_argument('--cores-per-task', dest='cores_per_task', type=int, metavar='N', help='(with --max-cores) the number of cores each job is expected to use. If this is not given, it is taken from the thread count given to the tool (e.g. blastn -num_threads 10 , samtools sort -@ 4 , or --threads / --cpus / --cores N), or else 1. (Short flags such as bwa -t or bowtie -p are not used, as they mean other things to other tools - set --cores-per-task for these)')
+    parser.add_argument('--memory-per-task', dest='memory_per_task', type=int, metavar='MB', help='(with --max-memory) the memory , in megabytes , each job is expected to use')
+    parser.add_argument('--engine', dest='engine', type=str, choices=['sequential', 'threaded'], help='how the session is run. sequential (the default) splits the input and submits each job in turn, and only polls for finished jobs once all of them have been submitted. threaded polls the jobs submitted so far in the background while the input is still being split - so that finished jobs are detected and their output merged while splitting is still going on, and held (local) jobs are launched as soon as there is room')
     parser.add_argument('-d', '--rootdir', dest='rootdir', type=str, metavar='DIR', help='create the tardis working folder under DIR. If no working root is specified, a default location is used.')
     parser.add_argument('--dry-run', dest='dry_run', action='store_const', const=True, help='validate the run by doing a dry run. This means that the chunks, job scripts and job files etc. are all generated but the jobs are not launched. The user can start then kill (CTRL-C) the run, inspect the script and job files that were generated to check that their command has been conditioned as envisaged.')
     parser.add_argument('-k', '--keep-conditioned-data', dest='keep_conditioned_data', action='store_const', const=True, help='keep the conditioned input and output - i.e. the input and output fragments. Normally in workflow mode these are deleted after the output is successfully "unconditioned" - i.e. joined back together')
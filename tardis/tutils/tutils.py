@@ -1,4 +1,4 @@
-import sys, errno, exceptions, os, os.path, re, ConfigParser, logging, string, tempfile, random 
+import sys, errno, exceptions, os, os.path, re, ConfigParser, logging, string, tempfile, random, time, struct, shutil, hashlib, math
 import pytoml as toml
 
 class tardisException(exceptions.Exception):
@@ -45,6 +45,52 @@ def getSampleBool(samplerate):
       else:
          return 0
 
+SPLITMIX64_GAMMA = 0x9E3779B97F4A7C15
+UINT64_MASK = 0xFFFFFFFFFFFFFFFF
+
+class recordSampler(object):
+    """
+    Decides which records of a stream to sample, at rate samplerate. Rather than a draw for each record, getSkipCount draws the
+    number of records to skip before the next one to sample, from the geometric distribution - so the caller passes over these
+    without calling the sampler, and it is only called about once per record sampled. Each draw depends only on the seed and the
+    ordinal number of the last record sampled - a splitmix64 hash of these is used as the uniform variate. This is the generator
+    used by kseq_split -r , so for the same seed the standard and fast conditioners sample the same records (and the two files of
+    a pair are sampled alike).
+
+    If no seed is given, one is drawn at random. 
+    """
+    def __init__(self, samplerate, seed = None):
+        super(recordSampler, self).__init__()
+        self.samplerate = samplerate
+        self.sampling = samplerate is not None and 0 < samplerate < 1.0
+        if seed is None:
+            seed = random.SystemRandom().randint(1, 2**31 - 1)
+        self.seed = seed & UINT64_MASK
+        self.ordinal = 0    # the ordinal number of the last record sampled
+        if self.sampling:
+            # (kseq_split holds the rate as a C float)
+            self.logSkipRate = math.log(1.0 - struct.unpack("f", struct.pack("f", samplerate))[0])
+
+    def getVariate(self, ordinal):
+        """
+        return the uniform variate (in (0,1]) for ordinal - a splitmix64 hash of the seed and ordinal
+        """
+        z = (self.seed + ordinal * SPLITMIX64_GAMMA) & UINT64_MASK
+        z = ((z ^ (z >> 30)) * 0xBF58476D1CE4E5B9) & UINT64_MASK
+        z = ((z ^ (z >> 27)) * 0x94D049BB133111EB) & UINT64_MASK
+        z = z ^ (z >> 31)
+        return ((z >> 11) + 1) * (1.0 / 9007199254740992.0)
+
+    def getSkipCount(self):
+        """
+        return the number of records to skip before the next record to sample (always 0 if not sampling)
+        """
+        if not self.sampling:
+            return 0
+        skip = int(math.floor(math.log(self.getVariate(self.ordinal)) / self.logSkipRate))
+        self.ordinal += skip + 1
+        return skip
+
 def SAMHeadersEqual(h1, h2, linesep = "\n"):
     """
     return True if they are the "same", False if they are "different".
@@ -67,19 +113,17 @@ def fastqPairedNamesEqual(name1, name2):
     read number ends up part of the name - e.g.
     M02810:22:000000000-A856J:1:1101:13622:1113/1
     M02810:22:000000000-A856J:1:1101:13622:1113/2
+    (This is called for every pair of records, so uses plain string comparisons rather than regular 
+    expressions. Names are sequence ids, so do not contain whitespace)
     """
     if name1 == name2 :
         return True
     else:
-        # try to match the above example
-        match1 = re.search("(\S+)\/\d+$", name1)
-        match2 = re.search("(\S+)\/\d+$", name2)
-        if match1 is not None and match2 is not None:
-            if len(match1.groups()) == 1 and len(match2.groups()) == 1:
-                if match1.groups()[0] == match2.groups()[0]:
-                    return True
-
-        return False
+        # try to match the above example - i.e. the same up to the last /, followed by digits
+        slash = name1.rfind("/")
+        if slash < 1 or name2.rfind("/") != slash or not name2.startswith(name1[0:slash]):
+            return False
+        return name1[slash+1:].isdigit() and name2[slash+1:].isdigit()
 
 
 def readConfigFiles(client_options):
@@ -197,6 +241,15 @@ def validatePythonCode(options, name, required=False):
         # a function object , which can be inserted to filter input records
         options[name] = value
 
+CHUNK_BY_CHOICES = ("records", "residues", "bytes")
+ENGINE_CHOICES = ("sequential", "threaded")
+
+def validateChoice(options, name, choices, required=False):
+    value = validateString(options, name, required)
+    if value is not None and value not in choices:
+        raise tardisException("config item %s must be one of %s, not %s" % (name, str(choices), value))
+    return value
+
 def validateOptions(options):
     validatePath(options, "rootdir", required=True, makeAbsolute=True, checkIsDir=True)
     validatePath(options, "startdir", required=True, makeAbsolute=True, checkIsDir=True)
@@ -205,6 +258,7 @@ def validateOptions(options):
     validateBool(options, "in_workflow", required=True)
     validateInt(options, "chunksize", required=True)
     validateFloat(options, "samplerate")
+    validateInt(options, "sample_seed")
     validateInt(options, "from_record")
     validateInt(options, "to_record")
     validateInt(options, "seqlength_min")
@@ -227,14 +281,254 @@ def validateOptions(options):
     validateString(options, "runtime_config_name")
     validateBool(options, "use_session_conda_config", required=True)
     validateBool(options, "fast_sequence_input_conditioning", required=True)
+    validateBool(options, "virtual_chunks")
+    validateInt(options, "max_split_processes")
+    validateInt(options, "record_count_cache_size")
+    validateInt(options, "chunk_cache_size")
+    validateInt(options, "result_cache_size")
+    validateBool(options, "adaptive_chunksize")
+    validateBool(options, "compress_chunks")
+    validateChoice(options, "chunk_by", CHUNK_BY_CHOICES)
+    validateChoice(options, "engine", ENGINE_CHOICES)
+    validateInt(options, "max_conditioned_chunks")
+    validateInt(options, "max_conditioned_bytes")
+    validateInt(options, "max_cores")
+    validateInt(options, "max_memory")
+    validateInt(options, "cores_per_task")
+    validateInt(options, "memory_per_task")
     validatePythonCode(options, "record_filter_func")
 
+def isConditionedInputThrottled(options):
+    """
+    return True if splitting the input should be held back so that no more than max_conditioned_chunks chunks (or
+    max_conditioned_bytes bytes) of conditioned input are on disk at once. This relies on jobs starting when they are
+    submitted, and on the conditioned input of each job being removed as soon as the job is done - so only applies to
+    local jobs, and not if the conditioned data is being kept (e.g. when sampling)
+    """
+    return (options.get("max_conditioned_chunks", None) is not None or options.get("max_conditioned_bytes", None) is not None) and \
+           options.get("hpctype") == "local" and not options.get("keep_conditioned_data", False) and options.get("samplerate", None) is None
+
+# flags which give a thread count for most tools that have them. (Short flags such as -t and -p are not included,
+# as they mean other things to many tools - e.g. sort -t - so cores_per_task should be set for tools like bwa and bowtie)
+THREAD_FLAGS = ("-@", "-threads", "-num_threads", "--threads", "--num-threads", "--num_threads", "--cpus", "--cores")
+
+def getTaskCores(options, command, logWriter=None):
+    """
+    return how many cores a (local) job running command is expected to use - cores_per_task if that is set, otherwise
+    the number given to the first thread-count flag of the tool (e.g. blastn -num_threads 10 , samtools sort -@ 4 ,
+    --threads 8), otherwise 1. (A count taken from the command is logged, as it is only a guess)
+    """
+    if options.get("cores_per_task", None) is not None:
+        return max(1, options["cores_per_task"])
+    for (i, word) in enumerate(command[1:], 1):
+        (flag, value) = (word, command[i+1] if i+1 < len(command) else "")
+        if re.match("^--[\w-]+=", word) is not None:
+            (flag, value) = word.split("=", 1)
+        if flag in THREAD_FLAGS and re.match("^\d+$", value) is not None:
+            if logWriter is not None:
+                logWriter.info("(cores_per_task not set - taking the job to use %d cores, from %s %s in its command)"%(max(1, int(value)), flag, value))
+            return max(1, int(value))
+    return 1
+
+def getTaskMemory(options):
+    """
+    return how much memory (MB) a (local) job is expected to use - memory_per_task, or 0 if that is not set
+    """
+    return options.get("memory_per_task", None) or 0
+
+def isWithinHostBudget(options, runningJobs, job):
+    """
+    return True if job can be started alongside runningJobs (local jobs), without the cores (max_cores) or memory
+    (max_memory) they are expected to use exceeding the budget for the host. (A job is always allowed to start if
+    nothing else is running - even if it is expected to need more than the whole budget)
+    """
+    if len(runningJobs) == 0:
+        return True
+    if options.get("max_cores", None) is not None and sum([j.taskCores for j in runningJobs]) + job.taskCores > options["max_cores"]:
+        return False
+    if options.get("max_memory", None) is not None and sum([j.taskMemory for j in runningJobs]) + job.taskMemory > options["max_memory"]:
+        return False
+    return True
+
 def getWorkDir(options):
-    if not options['workdir_is_rootdir']:
+    if options.get("resume", None) is not None:
+        # carry on in the working folder of a previous session
+        if not os.path.isfile(os.path.join(options["resume"], "tardis.log")):
+            raise tardisException("error can't resume session in %s - it does not look like a tardis working folder"%options["resume"])
+        return os.path.abspath(options["resume"])
+    elif not options['workdir_is_rootdir']:
         return tempfile.mkdtemp(prefix="tardis_", dir=options["rootdir"])
     else:
         return options["rootdir"]
 
+RECORD_COUNT_CACHE_NAME = ".tardis_record_count_cache"
+DEFAULT_RECORD_COUNT_CACHE_SIZE = 1000
+_recordCountCacheHits = {}   # key -> when it was last used - not yet saved to the cache file (see getCachedRecordCount)
+
+def _getFileIdentity(filename):
+    # cached results are only valid for the exact same file - i.e. same path, size, mtime and inode
+    stats = os.stat(filename)
+    return (os.path.realpath(filename), str(stats.st_size), repr(stats.st_mtime), str(stats.st_ino))
+
+def _getRecordCountCacheKey(filename, kind):
+    return _getFileIdentity(filename) + (kind,)
+
+def _readRecordCountCache(cachefile):
+    cache = {}
+    try:
+        with open(cachefile, "r") as f:
+            for record in f:
+                fields = record.rstrip("\n").split("\t")
+                if len(fields) == 7:
+                    cache[tuple(fields[0:5])] = (int(fields[5]), float(fields[6]))
+    except (IOError, ValueError):
+        pass
+    return cache
+
+def _writeRecordCountCache(cachefile, cache, max_entries):
+    # keep the most recently used entries, and replace the cache file atomically, as other sessions may be reading it
+    entries = sorted(cache.items(), key = lambda item:item[1][1], reverse = True)[0:max_entries]
+    tempname = "%s.%d"%(cachefile, os.getpid())
+    with open(tempname, "w") as f:
+        for (key, (count, last_used)) in entries:
+            print >> f, "\t".join(key + (str(count), repr(last_used)))
+    os.rename(tempname, cachefile)
+
+def getCachedRecordCount(options, filename, kind):
+    """
+    return the record count of filename cached (under rootdir) by an earlier session, or None
+    if there isn't one. kind names the counting method - e.g. "kseq" for sequence counts.
+    (The cache is just an optimisation, so any problem using it is treated as a miss. A hit does not rewrite
+    the cache file - the entry is marked as used the next time a count is saved, by setCachedRecordCount)
+    """
+    max_entries = options.get("record_count_cache_size", None)
+    if max_entries is None:
+        max_entries = DEFAULT_RECORD_COUNT_CACHE_SIZE
+    if max_entries <= 0:
+        return None
+
+    try:
+        cachefile = os.path.join(options["rootdir"], RECORD_COUNT_CACHE_NAME)
+        key = _getRecordCountCacheKey(filename, kind)
+        cache = _readRecordCountCache(cachefile)
+        if key not in cache:
+            return None
+        _recordCountCacheHits[key] = time.time()
+        return cache[key][0]
+    except (IOError, OSError):
+        return None
+
+def setCachedRecordCount(options, filename, kind, count):
+    """
+    cache the record count of filename under rootdir, evicting the least recently used counts if the cache
+    is full - this also saves when the counts hit since the cache was last written were used. (Any problem
+    updating the cache is ignored)
+    """
+    max_entries = options.get("record_count_cache_size", None)
+    if max_entries is None:
+        max_entries = DEFAULT_RECORD_COUNT_CACHE_SIZE
+    if max_entries <= 0:
+        return
+
+    try:
+        cachefile = os.path.join(options["rootdir"], RECORD_COUNT_CACHE_NAME)
+        key = _getRecordCountCacheKey(filename, kind)
+        cache = _readRecordCountCache(cachefile)
+        for (hit, last_used) in _recordCountCacheHits.items():
+            if hit in cache:
+                cache[hit] = (cache[hit][0], max(last_used, cache[hit][1]))
+        cache[key] = (count, time.time())
+        _writeRecordCountCache(cachefile, cache, max_entries)
+        _recordCountCacheHits.clear()
+    except (IOError, OSError):
+        pass
+
+# file caches under rootdir - (folder name, option giving the size limit in MB)
+CHUNK_CACHE = (".tardis_chunk_cache", "chunk_cache_size")     # input chunks, re-used by sessions that split the same input the same way
+RESULT_CACHE = (".tardis_result_cache", "result_cache_size")  # job results, re-used by sessions that run the same command on the same chunk
+CACHE_MANIFEST = "manifest"  # lists the contents of a cache entry (the entry is only complete once this is there)
+
+def getFileIdentityKey(filenames, parameters):
+    """
+    return a key (digest) for the identity of each of filenames (path, size, mtime, inode) together with parameters - e.g.
+    to cache the chunks of the files conditioned using parameters (formats, chunksize etc)
+    """
+    identity = [_getFileIdentity(filename) for filename in filenames] + [parameters]
+    return hashlib.md5(repr(identity)).hexdigest()
+
+def isCacheEnabled(options, cache):
+    return (options.get(cache[1], None) or 0) > 0
+
+def getCacheEntry(options, cache, key):
+    """
+    return the folder (under rootdir) holding the cache entry for key, or None if there isn't one (or the
+    cache is disabled). A hit marks the entry as most recently used.
+    """
+    if not isCacheEnabled(options, cache):
+        return None
+
+    entrydir = os.path.join(options["rootdir"], cache[0], key)
+    try:
+        os.utime(os.path.join(entrydir, CACHE_MANIFEST), None)
+        return entrydir
+    except OSError:
+        return None
+
+def getCacheStagingDir(options, cache, key):
+    """
+    return a new folder (under rootdir) in which the files for key can be gathered, before being added to the
+    cache by addCacheEntry. (Returns None if this fails - the cache is just an optimisation)
+    """
+    try:
+        cachedir = os.path.join(options["rootdir"], cache[0])
+        if not os.path.isdir(cachedir):
+            os.makedirs(cachedir)
+        return tempfile.mkdtemp(prefix="%s.staging."%key, dir=cachedir)
+    except OSError:
+        return None
+
+def linkOrCopy(source, target):
+    """
+    hard-link source to target (e.g. to add a file to a cache entry, or to take one from it), copying it if it
+    can't be linked (e.g. it is on another filesystem). Hard links are preferred, as the files can be large, and
+    the link still works after the cache entry is evicted
+    """
+    try:
+        os.link(source, target)
+    except OSError:
+        shutil.copyfile(source, target)
+
+def addCacheEntry(options, cache, key, stagingdir):
+    """
+    make the files gathered in stagingdir (including the manifest) the cache entry for key, then evict the least
+    recently used entries until the cache is within its size limit. (If another session has added the same
+    entry meanwhile, the staged copy is just discarded)
+    """
+    cachedir = os.path.join(options["rootdir"], cache[0])
+    try:
+        os.rename(stagingdir, os.path.join(cachedir, key))
+    except OSError:
+        shutil.rmtree(stagingdir, ignore_errors = True)
+
+    try:
+        entries = []
+        for entry in os.listdir(cachedir):
+            manifest = os.path.join(cachedir, entry, CACHE_MANIFEST)
+            if os.path.isfile(manifest):
+                entrysize = reduce(lambda x,y:x+os.path.getsize(os.path.join(cachedir, entry, y)), os.listdir(os.path.join(cachedir, entry)), 0)
+                entries.append((os.path.getmtime(manifest), entry, entrysize))
+        entries.sort()
+        cachesize = reduce(lambda x,y:x+y[2], entries, 0)
+        max_bytes = options[cache[1]] * 1024 * 1024
+        while cachesize > max_bytes and len(entries) > 0:
+            (last_used, entry, entrysize) = entries.pop(0)
+            # (remove the manifest first, so that no other session takes it as a hit)
+            os.remove(os.path.join(cachedir, entry, CACHE_MANIFEST))
+            shutil.rmtree(os.path.join(cachedir, entry), ignore_errors = True)
+            cachesize -= entrysize
+    except OSError:
+        pass
+
 def getTemplateContent(options, template_name, logWriter=None):
     """Resolve template name as a file relative to the option templatedir, and return content as a string, or empty if no such template."""
     try:
@@ -0,0 +1,91 @@
+"""
+fixtures shared by the tests - see README.rst for how to run them
+"""
+import os, sys, subprocess, threading, logging
+import pytest
+
+import tardis.conditioner.data as data
+
+TARDIS_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# the options of a session run by the run_tardis fixture (a config file passed with --userconfig)
+SESSION_OPTIONS = {
+    "workdir_is_rootdir" : False,
+    "input_conditioning" : False,
+    "in_workflow" : True,
+    "chunksize" : -1,
+    "dry_run" : False,
+    "keep_conditioned_data" : False,
+    "quiet" : True,
+    "max_processes" : 4,
+    "max_tasks" : 5,
+    "min_sample_size" : 0,
+    "hpctype" : "local",
+    "valid_command_patterns" : ["cat", "true", "false"],
+    "templatedir" : os.path.join(TARDIS_ROOT, "examples", "templates"),
+    "use_session_conda_config" : False,
+    "fast_sequence_input_conditioning" : True,
+}
+
+
+class stubConditioner(data.dataConditioner):
+    """
+    the caller the module level split functions of tardis.conditioner.text are given - a bare dataConditioner,
+    with just the options and logger they use, which also keeps a list of the errors it is given
+    """
+    targetChunkCount = None   # (as textDataConditioner - read by the fast conditioner)
+
+    def __init__(self, options):
+        super(stubConditioner, self).__init__()
+        self.options = options
+        self.logWriter = logging.getLogger("test")
+        self.errors = []
+
+    def error(self, errorMessage):
+        super(stubConditioner, self).error(errorMessage)
+        self.errors.append(errorMessage)
+
+
+@pytest.fixture
+def caller(tmpdir):
+    """
+    a stubConditioner with rootdir tmpdir (tests add any other options they need)
+    """
+    return stubConditioner({"rootdir" : str(tmpdir)})
+
+
+def toml_value(value):
+    if isinstance(value, bool):
+        return "true" if value else "false"
+    elif isinstance(value, (list, tuple)):
+        return "[%s]"%", ".join(toml_value(item) for item in value)
+    elif isinstance(value, basestring):
+        return '"%s"'%value
+    return str(value)
+
+
+@pytest.fixture
+def run_tardis(tmpdir):
+    """
+    returns a function that runs a local tardis session in tmpdir (as the tardis command would), with the
+    options in SESSION_OPTIONS updated by any keyword arguments - and returns (exit code, stdout + stderr).
+    A session still running after timeout seconds is killed (and returns the negated signal number)
+    """
+    def run(args, timeout = 120, **options):
+        session_options = dict(SESSION_OPTIONS, rootdir = str(tmpdir.join("root")), startdir = str(tmpdir), **options)
+        tmpdir.join("root").ensure(dir = True)
+        tmpdir.join("tardis.toml").write("".join("%s = %s\n"%(key, toml_value(value)) for (key, value) in sorted(session_options.items())))
+        env = dict(os.environ, PYTHONPATH = os.pathsep.join([TARDIS_ROOT] + [path for path in [os.environ.get("PYTHONPATH")] if path]))
+        # (the output goes to a file rather than a pipe, so that anything the session leaves running can't hang the test)
+        with open(str(tmpdir.join("tardis.out")), "w") as output:
+            proc = subprocess.Popen([sys.executable, "-c", "import sys; from tardis.run import tardis_main; sys.exit(tardis_main())", \
+                                     "--userconfig", str(tmpdir.join("tardis.toml")), "--no-sysconfig"] + args, cwd = str(tmpdir), env = env, \
+                                    stdout = output, stderr = subprocess.STDOUT)
+            timer = threading.Timer(timeout, proc.kill)
+            timer.start()
+            try:
+                proc.wait()
+            finally:
+                timer.cancel()
+        return (proc.returncode, tmpdir.join("tardis.out").read())
+    return run
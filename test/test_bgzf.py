@@ -0,0 +1,100 @@
+"""
+A BGZF input is split as ranges of its blocks by parallel split workers (see text._bgzf_get_conditioned_filenames) -
+each range must start at a record, and the chunks must come back together as the original file
+"""
+import os, struct, zlib, gzip
+
+import tardis.conditioner.data as data
+import tardis.conditioner.text as text
+
+BLOCK_DATA_SIZE = 1000     # (small blocks, so that there are many of them, and records straddle them)
+
+def write_bgzf(filename, uncompressed):
+    """
+    write uncompressed as a BGZF file, as bgzip would (but with small blocks)
+    """
+    with open(filename, "wb") as f:
+        for start in range(0, len(uncompressed), BLOCK_DATA_SIZE) + [len(uncompressed)]:    # (ending with an empty block)
+            block = uncompressed[start:start + BLOCK_DATA_SIZE]
+            compressor = zlib.compressobj(6, zlib.DEFLATED, -zlib.MAX_WBITS)
+            cdata = compressor.compress(block) + compressor.flush()
+            f.write("\x1f\x8b\x08\x04\x00\x00\x00\x00\x00\xff\x06\x00BC\x02\x00" + struct.pack("<H", 18 + len(cdata) + 8 - 1))
+            f.write(cdata + struct.pack("<II", zlib.crc32(block) & 0xffffffff, len(block)))
+
+
+def make_fastq(record_count):
+    return "".join("@r%d\n%s\n+\n%s\n"%(n, "ACGT"[n % 4] * (20 + n % 37), "I" * (20 + n % 37)) for n in range(1, record_count + 1))
+
+
+def record_starts(fastq):
+    offsets = [0]
+    for line in fastq.splitlines(True):
+        offsets.append(offsets[-1] + len(line))
+    return set(offsets[0:-1:4])
+
+
+def test_blocks(tmpdir):
+    fastq = make_fastq(500)
+    write_bgzf(str(tmpdir.join("in.fastq.gz")), fastq)
+    with gzip.open(str(tmpdir.join("plain.fastq.gz")), "wb") as f:
+        f.write(fastq)
+
+    assert text._is_bgzf(str(tmpdir.join("in.fastq.gz")))
+    assert not text._is_bgzf(str(tmpdir.join("plain.fastq.gz")))
+    blocks = text._get_bgzf_blocks(str(tmpdir.join("in.fastq.gz")))
+    assert len(blocks) == (len(fastq) + BLOCK_DATA_SIZE - 1) / BLOCK_DATA_SIZE + 1
+    assert blocks[-1][0] + blocks[-1][1] == os.path.getsize(str(tmpdir.join("in.fastq.gz")))
+
+
+def test_record_aligned_ranges(tmpdir):
+    fastq = make_fastq(500)
+    filename = str(tmpdir.join("in.fastq.gz"))
+    write_bgzf(filename, fastq)
+    blocks = text._get_bgzf_blocks(filename)
+    starts = record_starts(fastq)
+
+    # the range starting at each block starts at the first record start in it (or the block after)
+    ranges = [(0, 0)]
+    with open(filename, "rb") as f:
+        for block_index in range(1, len(blocks) - 2):
+            (start_block, offset) = text._find_bgzf_record_start(f, blocks, block_index, "fastq")
+            position = start_block * BLOCK_DATA_SIZE + offset
+            assert position in starts
+            assert position == min(start for start in starts if start >= block_index * BLOCK_DATA_SIZE)
+            ranges.append((blocks[start_block][0], offset))
+
+    # and the ranges read back as the whole file
+    ranges = sorted(set(ranges))
+    pieces = ["".join(text._read_bgzf_range(filename, start, end)) for (start, end) in zip(ranges, ranges[1:] + [None])]
+    assert "".join(pieces) == fastq
+    assert all(piece[0] == "@" for piece in pieces)
+
+
+def test_split_worker_range(tmpdir, capsys):
+    fastq = make_fastq(500)
+    filename = str(tmpdir.join("in.fastq.gz"))
+    write_bgzf(filename, fastq)
+    blocks = text._get_bgzf_blocks(filename)
+    with open(filename, "rb") as f:
+        (start_block, offset) = text._find_bgzf_record_start(f, blocks, 10, "fastq")
+
+    assert text._split_worker(["-R", "0", "0", str(blocks[start_block][0]), str(offset), "fastq", filename, "30", str(tmpdir.join("in.%05d.fastq"))]) == 0
+    chunknames = [record.split("=", 1)[1] for record in capsys.readouterr()[0].splitlines()]
+    chunks = [open(chunkname).read() for chunkname in chunknames]
+    assert "".join(chunks) == fastq[0:start_block * BLOCK_DATA_SIZE + offset]
+    assert [chunk.count("\n") for chunk in chunks[:-1]] == [120] * (len(chunks) - 1)
+
+
+def test_parallel_split(tmpdir, caller):
+    fastq = make_fastq(2000)
+    filename = str(tmpdir.join("in.fastq.gz"))
+    write_bgzf(filename, fastq)
+    outdir = tmpdir.mkdir("out")
+
+    chunks = list(text._start_split(text._bgzf_get_conditioned_filenames(caller, filename, 100, str(outdir), "fastq", max_processes = 4), False))
+    assert caller.state == data.dataConditioner.OK, caller.errors
+    chunknames = [chunkname for (inputNames, (chunkname, chunkname2)) in chunks]
+    assert chunknames == [str(outdir.join("in.%05d.fastq"%n)) for n in range(1, len(chunks) + 1)]
+    assert "".join(open(chunkname).read() for chunkname in chunknames) == fastq
+    # (each of the 4 ranges ends with a partial chunk)
+    assert 20 <= len(chunks) <= 24
@@ -0,0 +1,82 @@
+"""
+Chunks and job results are cached by keys made from the identity of the input files, how they were split, and (for
+results) the command - none of these read the chunks (see tutils.getFileIdentityKey, getConditionedInputKey and
+hpcConditioner.getJobResultKey)
+"""
+import os, logging
+
+import tardis.tutils.tutils as tutils
+import tardis.conditioner.data as data
+import tardis.conditioner.text as text
+import tardis.conditioner.factory as factory
+
+
+def test_file_identity_key(tmpdir):
+    (input1, input2) = (tmpdir.join("R1.fastq"), tmpdir.join("R2.fastq"))
+    input1.write("@r1\nACGT\n+\nIIII\n")
+    input2.write("@r1\nACGT\n+\nIIII\n")
+    key = tutils.getFileIdentityKey([str(input1)], ("fastq", 1000))
+    assert tutils.getFileIdentityKey([str(input1)], ("fastq", 1000)) == key
+    assert tutils.getFileIdentityKey([str(input1)], ("fastq", 2000)) != key
+    assert tutils.getFileIdentityKey([str(input2)], ("fastq", 1000)) != key
+    assert tutils.getFileIdentityKey([str(input1), str(input2)], ("fastq", 1000)) != key
+
+    input1.write("@r1\nACGTA\n+\nIIIII\n")
+    assert tutils.getFileIdentityKey([str(input1)], ("fastq", 1000)) != key
+
+
+def test_conditioned_input_key(tmpdir):
+    chunk = tmpdir.join("R1.00001.fastq")
+    chunk.write("@r1\nACGT\n+\nIIII\n")
+
+    # a chunk is identified by the input set it was split from, and its name - it is not read
+    dc = text.textDataConditioner(str(tmpdir.join("R1.fastq")))
+    assert dc.getConditionedInputKey(str(chunk)) is None
+    dc.conditionedInputSetKey = "0123456789abcdef"
+    assert dc.getConditionedInputKey(str(chunk)) == "0123456789abcdef:R1.00001.fastq"
+    assert dc.getConditionedInputKey("/elsewhere/R1.00001.fastq") == dc.getConditionedInputKey(str(chunk))
+    assert dc.getConditionedInputKey(str(tmpdir.join("R1.00002.fastq"))) != dc.getConditionedInputKey(str(chunk))
+    assert dc.getConditionedInputKey(None) is None
+
+    # (the base class input is not conditioned, so is identified by the file itself)
+    assert data.dataConditioner().getConditionedInputKey(str(chunk)) == tutils.getFileIdentityKey([str(chunk)], ())
+    assert data.dataConditioner().getConditionedInputKey(str(tmpdir.join("missing"))) is None
+
+
+class stubJob(object):
+    def __init__(self, command):
+        self.command = command
+
+class stubPrototype(object):
+    def __init__(self, inputConditioners):
+        self.outputUnconditioners = []
+        self.inputConditioners = inputConditioners
+    def getDistinctOutputBaseConditioners(self):
+        return []
+    def getDistinctInputConditioners(self):
+        return self.inputConditioners
+
+
+def test_job_result_key(tmpdir):
+    options = {"hpctype" : "local", "startdir" : str(tmpdir)}
+    dc = text.textDataConditioner(str(tmpdir.join("R1.fastq")))
+    dc.conditionedInputSetKey = "0123456789abcdef"
+    prototype = stubPrototype([dc])
+
+    # the same command run on the same chunk in two sessions (working folders) has the same key
+    keys = []
+    for session in ("tardis_a", "tardis_b"):
+        controller = factory.hpcConditioner(logging.getLogger("test"), str(tmpdir.join(session)), options)
+        dc.conditionedInputFileNames = [str(tmpdir.join(session, "R1.00001.fastq"))]
+        keys.append(controller.getJobResultKey(stubJob(["cat", str(tmpdir.join(session, "R1.00001.fastq"))]), prototype))
+    assert keys[0] is not None and keys[0] == keys[1]
+
+    # but not another chunk, or another command
+    dc.conditionedInputFileNames = [str(tmpdir.join("tardis_b", "R1.00002.fastq"))]
+    assert controller.getJobResultKey(stubJob(["cat", str(tmpdir.join("tardis_b", "R1.00002.fastq"))]), prototype) != keys[1]
+    dc.conditionedInputFileNames = [str(tmpdir.join("tardis_b", "R1.00001.fastq"))]
+    assert controller.getJobResultKey(stubJob(["wc", str(tmpdir.join("tardis_b", "R1.00001.fastq"))]), prototype) != keys[1]
+
+    # and a job whose input can't be identified (e.g. an unseeded sample) is not cached
+    dc.conditionedInputSetKey = None
+    assert controller.getJobResultKey(stubJob(["cat", str(tmpdir.join("tardis_b", "R1.00001.fastq"))]), prototype) is None
@@ -0,0 +1,35 @@
+"""
+With chunk_by residues or bytes, a fasta or fastq chunk is closed as soon as it holds at least chunksize residues
+or bytes (of the records as written) - these check where the chunks are cut, by the standard conditioner and by
+kseq_split -b (fast_sequence_input_conditioning)
+"""
+import distutils.spawn
+import pytest
+
+import tardis.conditioner.text as text
+
+# residues 5, 3, 7, 2, 4, 6 - and bytes (as written) 10, 8, 12, 7, 9, 11
+RECORDS = [">r1\nAAAAA\n", ">r2\nCCC\n", ">r3\nGGGGGGG\n", ">r4\nTT\n", ">r5\nACGT\n", ">r6\nACGTAC\n"]
+
+
+def split(caller, tmpdir, chunk_by, chunksize, fast):
+    if fast and distutils.spawn.find_executable("kseq_split") is None:
+        pytest.skip("kseq_split is not installed")
+    caller.options.update({"fast_sequence_input_conditioning" : fast, "chunk_by" : chunk_by})
+    tmpdir.join("in.fasta").write("".join(RECORDS))
+    outdir = tmpdir.mkdir("out")
+    chunks = list(text.getConditionedFilenames(caller, str(tmpdir.join("in.fasta")), chunksize, str(outdir), informat = "fasta", outformat = "fasta"))
+    assert caller.errors == []
+    return [open(chunkname).read() for ((inputName, inputName2), (chunkname, chunkname2)) in chunks]
+
+
+@pytest.mark.parametrize("fast", [False, True])
+@pytest.mark.parametrize(("chunk_by", "chunksize", "chunk_records"), [
+    ("residues", 8, [[0, 1], [2, 3], [4, 5]]),     # (5+3 reaches 8 exactly, 7+2 and 4+6 go over)
+    ("residues", 9, [[0, 1, 2], [3, 4, 5]]),
+    ("bytes", 18, [[0, 1], [2, 3], [4, 5]]),       # (10+8 reaches 18 exactly, 12+7 and 9+11 go over)
+    ("bytes", 31, [[0, 1, 2, 3], [4, 5]]),
+    ("bytes", 1, [[0], [1], [2], [3], [4], [5]]),
+])
+def test_chunk_boundaries(tmpdir, caller, fast, chunk_by, chunksize, chunk_records):
+    assert split(caller, tmpdir, chunk_by, chunksize, fast) == ["".join(RECORDS[n] for n in records) for records in chunk_records]
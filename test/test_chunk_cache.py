@@ -0,0 +1,70 @@
+"""
+The chunk cache under rootdir (chunk_cache_size) keeps the chunks of an input conditioned by one session, for
+re-use by later sessions that condition the same input in the same way - see tardis.tutils.tutils.addCacheEntry
+and tardis.conditioner.text._cache_conditioned_filenames
+"""
+import os, time
+
+import tardis.tutils.tutils as tutils
+import tardis.conditioner.data as data
+import tardis.conditioner.text as text
+
+
+def add_entry(options, key, size, last_used):
+    stagingdir = tutils.getCacheStagingDir(options, tutils.CHUNK_CACHE, key)
+    with open(os.path.join(stagingdir, "R1.00001.fastq"), "w") as chunk:
+        chunk.write("x" * size)
+    with open(os.path.join(stagingdir, tutils.CACHE_MANIFEST), "w") as manifest:
+        manifest.write("R1.00001.fastq\n")
+    os.utime(os.path.join(stagingdir, tutils.CACHE_MANIFEST), (last_used, last_used))
+    tutils.addCacheEntry(options, tutils.CHUNK_CACHE, key, stagingdir)
+
+
+def test_cache_entries(tmpdir):
+    options = {"rootdir" : str(tmpdir), "chunk_cache_size" : 1}
+    assert tutils.getCacheEntry(options, tutils.CHUNK_CACHE, "a") is None
+    add_entry(options, "a", 1000, time.time() - 100)
+    assert tutils.getCacheEntry(options, tutils.CHUNK_CACHE, "a") == os.path.join(str(tmpdir), tutils.CHUNK_CACHE[0], "a")
+    assert tutils.getCacheEntry(options, tutils.CHUNK_CACHE, "b") is None
+
+    # (the cache is disabled unless it has a size)
+    assert tutils.getCacheEntry({"rootdir" : str(tmpdir)}, tutils.CHUNK_CACHE, "a") is None
+
+
+def test_least_recently_used_entry_is_evicted(tmpdir):
+    options = {"rootdir" : str(tmpdir), "chunk_cache_size" : 1}
+    add_entry(options, "a", 400 * 1024, time.time() - 300)
+    add_entry(options, "b", 400 * 1024, time.time() - 200)
+    assert tutils.getCacheEntry(options, tutils.CHUNK_CACHE, "a") is not None   # (this hit makes a the most recently used)
+    add_entry(options, "c", 400 * 1024, time.time() - 100)
+    assert [tutils.getCacheEntry(options, tutils.CHUNK_CACHE, key) is not None for key in ("a", "b", "c")] == [True, False, True]
+    assert not os.path.exists(os.path.join(str(tmpdir), tutils.CHUNK_CACHE[0], "b"))
+
+
+def test_link_or_copy(tmpdir):
+    source = tmpdir.join("source")
+    source.write("some data")
+    tutils.linkOrCopy(str(source), str(tmpdir.join("target")))
+    assert tmpdir.join("target").read() == "some data"
+    assert os.stat(str(source)).st_ino == os.stat(str(tmpdir.join("target"))).st_ino
+
+
+def test_conditioned_chunks_are_cached(tmpdir, caller):
+    caller.options["chunk_cache_size"] = 10
+    chunks = []
+    for n in (1, 2):
+        chunks.append(((str(tmpdir.join("R1.fastq")), None), [str(tmpdir.join("R1.%05d.fastq"%n)), None]))
+        tmpdir.join("R1.%05d.fastq"%n).write("@r%d\nACGT\n+\nIIII\n"%n)
+
+    stagingdir = tutils.getCacheStagingDir(caller.options, tutils.CHUNK_CACHE, "a")
+    assert list(text._cache_conditioned_filenames(caller, iter(chunks), "a", stagingdir)) == chunks
+    entrydir = tutils.getCacheEntry(caller.options, tutils.CHUNK_CACHE, "a")
+    assert sorted(os.listdir(entrydir)) == sorted([tutils.CACHE_MANIFEST, "R1.00001.fastq", "R1.00002.fastq"])
+    assert not os.path.exists(stagingdir)
+
+    # if the split fails, nothing is cached (and the staged chunks are removed)
+    caller.state = data.dataConditioner.ERROR
+    stagingdir = tutils.getCacheStagingDir(caller.options, tutils.CHUNK_CACHE, "b")
+    assert list(text._cache_conditioned_filenames(caller, iter(chunks), "b", stagingdir)) == chunks
+    assert tutils.getCacheEntry(caller.options, tutils.CHUNK_CACHE, "b") is None
+    assert not os.path.exists(stagingdir)
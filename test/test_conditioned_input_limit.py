@@ -0,0 +1,45 @@
+"""
+With max_conditioned_chunks, splitting pauses whenever that many chunks are on disk, until jobs finish and their
+chunks are removed (see hpcConditioner.waitForConditionedInputSpace) - these run local sessions whose jobs list the
+working folder, to check the limit is kept to, and that a session whose jobs all fail (so keep their chunks) ends
+rather than waiting for ever
+"""
+import re, signal
+
+
+def make_input(tmpdir, line_count = 1000):
+    tmpdir.join("in.txt").write("".join("line %d\n"%n for n in range(1, line_count + 1)))
+
+
+def chunks_on_disk(listings):
+    """
+    return the number of chunks on disk when each job listed the working folder - each job lists its own chunk, and
+    then the folder (ls chunk folder - which heads its listing "folder:")
+    """
+    counts = []
+    for line in listings.splitlines():
+        if line.startswith("/") and not line.endswith(":"):
+            counts.append(0)
+        elif re.match("^in\.\d+\.txt$", line) is not None:
+            counts[-1] += 1
+    return counts
+
+
+def test_chunks_on_disk_are_limited(tmpdir, run_tardis):
+    make_input(tmpdir)
+    (exit_code, output) = run_tardis(["-c", "100", "ls", "_condition_text_input_in.txt", "$hpcdir", ">", "_condition_uncompressedtext_output_out.txt"], \
+                                     max_conditioned_chunks = 2, valid_command_patterns = ["ls"])
+    assert exit_code == 0, output
+    counts = chunks_on_disk(tmpdir.join("out.txt").read())
+    assert len(counts) == 10
+    assert 0 < max(counts) <= 2
+
+
+def test_failed_jobs_do_not_hang_the_split(tmpdir, run_tardis):
+    make_input(tmpdir)
+    # (the chunks of the failed jobs are kept - so once there are 2 of them, there is no waiting for them to go)
+    (exit_code, output) = run_tardis(["-c", "100", "false", "_condition_text_input_in.txt", ">", "_condition_uncompressedtext_output_out.txt"], \
+                                     timeout = 60, max_conditioned_chunks = 2)
+    assert exit_code not in (0, -signal.SIGKILL), output
+    assert len(tmpdir.join("root").listdir()) == 1
+    assert len([path for path in tmpdir.join("root").listdir()[0].listdir() if re.match("^in\.\d+\.txt$", path.basename)]) == 10
@@ -0,0 +1,22 @@
+"""
+With the threaded engine (engine = "threaded"), the jobs are polled in the background while the input is still
+being split - these run local sessions to check that it merges the same output as the sequential engine, including
+when splitting has to wait for jobs to finish (max_conditioned_chunks)
+"""
+import pytest
+
+
+def make_input(tmpdir, line_count = 2000):
+    tmpdir.join("in.txt").write("".join("line %d\n"%n for n in range(1, line_count + 1)))
+    return tmpdir.join("in.txt").read()
+
+
+@pytest.mark.parametrize("options", [{}, {"max_processes" : 1}, {"max_conditioned_chunks" : 2}])
+def test_threaded_output_same_as_sequential(tmpdir, run_tardis, options):
+    expected = make_input(tmpdir)
+    for engine in ["sequential", "threaded"]:
+        (exit_code, output) = run_tardis(["-c", "400", "cat", "_condition_text_input_in.txt", ">", "_condition_uncompressedtext_output_%s.txt"%engine], \
+                                         engine = engine, **options)
+        assert exit_code == 0, output
+    assert tmpdir.join("sequential.txt").read() == expected
+    assert tmpdir.join("threaded.txt").read() == expected
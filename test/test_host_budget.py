@@ -0,0 +1,32 @@
+"""
+Local jobs are only started while the cores and memory they are expected to use fit the host budget (max_cores,
+max_memory) - see tutils.getTaskCores and tutils.isWithinHostBudget
+"""
+import tardis.tutils.tutils as tutils
+
+
+def test_task_cores():
+    assert tutils.getTaskCores({}, ["blastn", "-query", "x.fa", "-num_threads", "10"]) == 10
+    assert tutils.getTaskCores({}, ["samtools", "sort", "-@", "4", "x.bam"]) == 4
+    assert tutils.getTaskCores({}, ["tool", "--threads=8"]) == 8
+    assert tutils.getTaskCores({}, ["cat", "x.fastq"]) == 1
+    # (short flags mean other things to many tools)
+    assert tutils.getTaskCores({}, ["sort", "-t", "3", "x.txt"]) == 1
+    assert tutils.getTaskCores({}, ["tool", "--threads", "many"]) == 1
+    assert tutils.getTaskCores({"cores_per_task" : 2}, ["blastn", "-num_threads", "10"]) == 2
+
+
+class stubJob(object):
+    def __init__(self, taskCores, taskMemory = 0):
+        self.taskCores = taskCores
+        self.taskMemory = taskMemory
+
+
+def test_host_budget():
+    options = {"max_cores" : 8, "max_memory" : 1000}
+    assert tutils.isWithinHostBudget(options, [stubJob(4), stubJob(2)], stubJob(2))
+    assert not tutils.isWithinHostBudget(options, [stubJob(4), stubJob(2)], stubJob(3))
+    assert not tutils.isWithinHostBudget(options, [stubJob(1, 600)], stubJob(1, 600))
+    # (a job can always start if nothing else is running)
+    assert tutils.isWithinHostBudget(options, [], stubJob(16, 2000))
+    assert tutils.isWithinHostBudget({}, [stubJob(64)] * 10, stubJob(64))
@@ -0,0 +1,61 @@
+"""
+The files named by a list file are split one after another, or with max_split_processes, the splits of the
+next files are started ahead (see text._parallel_chain) - either way the chunks must come out in list order
+"""
+import functools, itertools, distutils.spawn
+import pytest
+
+import tardis.conditioner.text as text
+
+
+def make_listed_files(tmpdir, suffix, record_format, record_count = 10):
+    contents = []
+    for name in ("s1", "s2", "s3"):
+        contents.append("".join(record_format%(name, n) for n in range(1, record_count + 1)))
+        tmpdir.join(name + suffix).write(contents[-1])
+    tmpdir.join("in.list").write("".join("%s%s\n"%(tmpdir.join(name), suffix) for name in ("s1", "s2", "s3")))
+    return contents
+
+
+def split_list(caller, tmpdir, suffix, informat, chunksize, max_processes):
+    outdir = tmpdir.mkdir("out")
+    starters = [functools.partial(text.getConditionedFilenames, caller, str(tmpdir.join(name + suffix)), chunksize, str(outdir), \
+                                  informat = informat, outformat = informat, listfilename1 = str(tmpdir.join("in.list"))) \
+                for name in ("s1", "s2", "s3")]
+    if max_processes > 1:
+        chunks = list(text._parallel_chain(caller, starters, max_processes))
+    else:
+        chunks = list(itertools.chain(*[start() for start in starters]))
+    assert set(inputNames for (inputNames, chunknames) in chunks) == set([(str(tmpdir.join("in.list")), None)])
+    return (outdir, [chunkname for (inputNames, (chunkname, chunkname2)) in chunks])
+
+
+def check_chunks(outdir, chunknames, contents, suffix, chunks_per_file):
+    # (each listed file is split into its own chunks, named after it)
+    assert chunknames == [str(outdir.join("%s.%05d%s"%(name, n, suffix))) for name in ("s1", "s2", "s3") for n in range(1, chunks_per_file + 1)]
+    for (index, name) in enumerate(("s1", "s2", "s3")):
+        assert "".join(open(chunkname).read() for chunkname in chunknames[index * chunks_per_file:(index + 1) * chunks_per_file]) == contents[index]
+
+
+@pytest.mark.parametrize("max_processes", [1, 2, 4])
+def test_fastq_list(tmpdir, run_tardis, max_processes):
+    # (the fast conditioner forks, so this is run as a session)
+    if distutils.spawn.find_executable("kseq_split") is None:
+        pytest.skip("kseq_split is not installed")
+    contents = make_listed_files(tmpdir, ".fastq", "@%s_%d\nACGT\n+\nIIII\n")
+    (exit_code, output) = run_tardis(["-k", "-c", "4", "--max-split-processes", str(max_processes), "cat", "_condition_fastq_input_in.list", ">", \
+                                      "_condition_uncompressedtext_output_out.fastq"])
+    assert exit_code == 0, output
+    assert tmpdir.join("out.fastq").read() == "".join(contents)
+    [workdir] = tmpdir.join("root").listdir("tardis_*")
+    chunknames = sorted(str(chunk) for chunk in workdir.listdir(lambda path: path.ext == ".fastq" and path.basename[0] == "s"))
+    check_chunks(workdir, chunknames, contents, ".fastq", 3)
+
+
+@pytest.mark.parametrize("max_processes", [1, 2, 4])
+def test_text_list(tmpdir, caller, max_processes):
+    caller.options.update({"fast_sequence_input_conditioning" : True, "max_split_processes" : max_processes})
+    contents = make_listed_files(tmpdir, ".txt", "%s line %d\n")
+    (outdir, chunknames) = split_list(caller, tmpdir, ".txt", "text", 5, max_processes)
+    check_chunks(outdir, chunknames, contents, ".txt", 2)
+    assert caller.errors == []
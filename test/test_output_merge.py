@@ -0,0 +1,80 @@
+"""
+Conditioned output files are merged as their jobs finish (see textDataConditioner.mergeAvailableOutput) - each
+file that finishes before the ones ahead of it is held back until they are. These check that files finishing out
+of order are merged into the same output as the merge at the end of the run (uncompressed, and through gzip -c),
+for text and for blast xml (whose headers are rewritten as each file is appended)
+"""
+import gzip, logging
+import pytest
+
+import tardis.conditioner.text as text
+import tardis.conditioner.blastxml as blastxml
+
+FINISH_ORDER = [3, 1, 2, 6, 4, 5]
+MERGED_COUNTS = [0, 1, 3, 3, 4, 6]     # how many files have been merged, after each one in FINISH_ORDER finishes
+
+BLAST_XML = """<?xml version="1.0"?>
+<!DOCTYPE BlastOutput PUBLIC "-//NCBI//NCBI BlastOutput/EN" "NCBI_BlastOutput.dtd">
+<BlastOutput>
+  <BlastOutput_program>blastn</BlastOutput_program>
+  <BlastOutput_iterations>
+    <Iteration>
+      <Iteration_query-def>query %d</Iteration_query-def>
+    </Iteration>
+  </BlastOutput_iterations>
+</BlastOutput>
+"""
+
+
+def text_output(chunk_number):
+    return "".join("chunk %d line %d\n"%(chunk_number, n) for n in range(1, 101))
+
+
+def blastxml_output(chunk_number):
+    return BLAST_XML%chunk_number
+
+
+def merge(outdir, conditioner_class, make_output, compressed, finish_order):
+    """
+    merge 6 conditioned output files, the ones in finish_order as they finish and the rest at the end - returns the
+    (uncompressed) merged output
+    """
+    dc = conditioner_class(outputFileName = str(outdir.join("out")), compressionConditioning = compressed)
+    dc.workingRoot = str(outdir)
+    dc.logWriter = logging.getLogger("test")
+    dc.options = {}
+    for chunk_number in range(1, 7):
+        outdir.join("out.%05d"%chunk_number).write(make_output(chunk_number))
+        dc.conditionedOutputFileNames.append(str(outdir.join("out.%05d"%chunk_number)))
+
+    if len(finish_order) > 0:
+        assert dc.isOutputPipelined()
+    merged_counts = []
+    for chunk_number in finish_order:
+        dc.mergeAvailableOutput(str(outdir.join("out.%05d"%chunk_number)))
+        merged_counts.append(dc.mergedOutputCount)
+    assert merged_counts == MERGED_COUNTS[0:len(finish_order)]
+
+    dc.unconditionOutput()
+    assert dc.state != dc.ERROR, dc.stateDescription
+    if compressed:
+        assert not outdir.join("out").check()
+        with gzip.open(str(outdir.join("out.gz"))) as merged:
+            return merged.read()
+    return outdir.join("out").read()
+
+
+@pytest.mark.parametrize("compressed", [False, True])
+@pytest.mark.parametrize(("conditioner_class", "make_output"), [(text.textDataConditioner, text_output), \
+                                                                 (blastxml.blastxmlDataConditioner, blastxml_output)])
+def test_out_of_order_merge_same_as_end_of_run(tmpdir, conditioner_class, make_output, compressed):
+    merged_at_end = merge(tmpdir.mkdir("end"), conditioner_class, make_output, compressed, [])
+    assert merge(tmpdir.mkdir("finished"), conditioner_class, make_output, compressed, FINISH_ORDER) == merged_at_end
+    assert merge(tmpdir.mkdir("some_finished"), conditioner_class, make_output, compressed, FINISH_ORDER[0:3]) == merged_at_end
+
+
+def test_blastxml_merge(tmpdir):
+    merged = merge(tmpdir, blastxml.blastxmlDataConditioner, blastxml_output, False, FINISH_ORDER)
+    header = BLAST_XML[0:BLAST_XML.index("    <Iteration>")]
+    iterations = "".join("    <Iteration>\n      <Iteration_query-def>query %d</Iteration_query-def>\n    </Iteration>\n"%n for n in range(1, 7))
+    assert merged == header + iterations + "  </BlastOutput_iterations>\n</BlastOutput>\n"
@@ -0,0 +1,37 @@
+"""
+The fast conditioner checks a pair chunk by chunk, comparing the digests kseq_split -d reports of the read names of
+each chunk (see text._fast_get_conditioned_filenames). These need kseq_split (see kseq_split/) on the PATH
+"""
+import distutils.spawn
+import pytest
+
+import tardis.conditioner.data as data
+import tardis.conditioner.text as text
+
+pytestmark = pytest.mark.skipif(distutils.spawn.find_executable("kseq_split") is None, reason="kseq_split is not installed")
+
+
+def write_fastq(path, names):
+    path.write("".join("@%s\nACGT\n+\nIIII\n"%name for name in names))
+
+
+def split_pair(tmpdir, caller, names1, names2):
+    write_fastq(tmpdir.join("R1.fastq"), names1)
+    write_fastq(tmpdir.join("R2.fastq"), names2)
+    return list(text._start_split(text._fast_get_conditioned_filenames(caller, str(tmpdir.join("R1.fastq")), 10, str(tmpdir.mkdir("out")), "fastq", "fastq", None, \
+                                                                       str(tmpdir.join("R2.fastq"))), False))
+
+
+def test_matching_pairs(tmpdir, caller):
+    chunks = split_pair(tmpdir, caller, ["r%d/1"%n for n in range(25)], ["r%d/2"%n for n in range(25)])
+    assert caller.state == data.dataConditioner.OK, caller.errors
+    assert len(chunks) == 3
+
+
+def test_mismatched_pairs(tmpdir, caller):
+    names2 = ["r%d/2"%n for n in range(25)]
+    names2[13] = "other/2"
+    chunks = split_pair(tmpdir, caller, ["r%d/1"%n for n in range(25)], names2)
+    assert caller.state == data.dataConditioner.ERROR
+    assert len(chunks) == 1       # (the split stops at the chunk that does not match)
+    assert "pair bonding error" in caller.errors[0]
@@ -0,0 +1,75 @@
+"""
+Each poll cycle (run.pollJobs) first reads the logs of the jobs that the working folder listing shows, then collects
+the output of those found finished using a second listing - these check that the folder is listed no more than
+twice a cycle, however many jobs finish, and that output written just before a job's log said it was done is collected
+"""
+import os, logging
+
+import tardis.conditioner.factory as factory
+import tardis.job.hpc as hpc
+import tardis.run as run
+
+
+class stubJob(hpc.hpcJob):
+    """
+    a job whose log says whether it has finished - and which writes its output just before that is read (as a job
+    that finishes between the first listing and the reading of its log would)
+    """
+    def __init__(self, controller, jobNumber):
+        self.controller = controller
+        self.jobNumber = jobNumber
+        self.logname = os.path.join(controller.workingRoot, "run%d.sh.log"%jobNumber)
+        self.returncode = None
+        self.sent = False
+        self.conditionedInputs = []
+        self.pipelinedOutputs = []
+        self.resultCacheKey = None
+        self.collected = None
+
+    def getExitFootprint(self):
+        with open(self.logname) as log:
+            if "job terminated" in log.read():
+                open(os.path.join(self.controller.workingRoot, "run%d.sh.stdout"%self.jobNumber), "w").close()
+                self.returncode = 0
+
+    def sendAvailableOutput(self, outputCollector, productCollector):
+        if self.returncode is not None:
+            self.collected = sorted(self.getJobFileNames())
+            self.sent = True
+
+
+def make_jobs(tmpdir, finished):
+    c = factory.hpcConditioner(logging.getLogger("test"), str(tmpdir), {"hpctype" : "none"})
+    c.jobList = [stubJob(c, jobNumber) for jobNumber in range(1, 6)]
+    for job in c.jobList:
+        tmpdir.join(os.path.basename(job.logname)).write("job terminated return value 0\n" if job.jobNumber in finished else "job starting\n")
+    return c
+
+
+def count_listings(monkeypatch):
+    listings = []
+    listdir = os.listdir
+    def counting_listdir(path):
+        listings.append(path)
+        return listdir(path)
+    monkeypatch.setattr(os, "listdir", counting_listdir)
+    return listings
+
+
+def test_at_most_two_listings_per_cycle(tmpdir, monkeypatch):
+    c = make_jobs(tmpdir, finished = [1, 3, 4])
+    listings = count_listings(monkeypatch)
+    assert run.pollJobs(c, c.jobList, None, None) == 3
+    assert len(listings) == 2
+    for job in c.jobList:
+        if job.jobNumber in [1, 3, 4]:
+            assert job.collected == ["run%d.sh.log"%job.jobNumber, "run%d.sh.stdout"%job.jobNumber]
+        else:
+            assert not job.sent
+
+
+def test_one_listing_when_nothing_finished(tmpdir, monkeypatch):
+    c = make_jobs(tmpdir, finished = [])
+    listings = count_listings(monkeypatch)
+    assert run.pollJobs(c, c.jobList, None, None) == 0
+    assert len(listings) == 1
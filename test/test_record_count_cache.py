@@ -0,0 +1,52 @@
+"""
+Record counts are cached under rootdir, keyed by each file's path and stat (see tutils.getCachedRecordCount), so
+that a later session over the same inputs can skip kseq_count
+"""
+import os
+
+import tardis.tutils.tutils as tutils
+
+
+def make_inputs(tmpdir, names):
+    inputs = []
+    for name in names:
+        inputs.append(tmpdir.join(name))
+        inputs[-1].write("@r1\nACGT\n+\nIIII\n")
+    return [str(path) for path in inputs]
+
+
+def test_cached_count(tmpdir):
+    options = {"rootdir" : str(tmpdir)}
+    [fastq] = make_inputs(tmpdir, ["R1.fastq"])
+    assert tutils.getCachedRecordCount(options, fastq, "kseq") is None
+    tutils.setCachedRecordCount(options, fastq, "kseq", 1234)
+    assert tutils.getCachedRecordCount(options, fastq, "kseq") == 1234
+    assert tutils.getCachedRecordCount(options, fastq, "lines") is None
+
+    # (a count is only good for the file as it was when it was counted)
+    tmpdir.join("R1.fastq").write("@r1\nACGT\n+\nIIII\n@r2\nACGT\n+\nIIII\n")
+    assert tutils.getCachedRecordCount(options, fastq, "kseq") is None
+
+
+def test_cache_disabled(tmpdir):
+    options = {"rootdir" : str(tmpdir), "record_count_cache_size" : 0}
+    [fastq] = make_inputs(tmpdir, ["R1.fastq"])
+    tutils.setCachedRecordCount(options, fastq, "kseq", 1234)
+    assert tutils.getCachedRecordCount(options, fastq, "kseq") is None
+    assert not os.path.exists(os.path.join(str(tmpdir), tutils.RECORD_COUNT_CACHE_NAME))
+
+
+def test_least_recently_used_count_is_evicted(tmpdir):
+    options = {"rootdir" : str(tmpdir), "record_count_cache_size" : 2}
+    (a, b, c) = make_inputs(tmpdir, ["a.fastq", "b.fastq", "c.fastq"])
+    tutils.setCachedRecordCount(options, a, "kseq", 1)
+    tutils.setCachedRecordCount(options, b, "kseq", 2)
+
+    # a hit does not rewrite the cache file - it is marked as used when the next count is saved
+    cachefile = tmpdir.join(tutils.RECORD_COUNT_CACHE_NAME)
+    before = cachefile.read()
+    assert tutils.getCachedRecordCount(options, a, "kseq") == 1
+    assert cachefile.read() == before
+
+    tutils.setCachedRecordCount(options, c, "kseq", 3)
+    assert [tutils.getCachedRecordCount(options, f, "kseq") for f in (a, b, c)] == [1, None, 3]
@@ -0,0 +1,47 @@
+"""
+A session records each chunk of conditioned input it writes in a manifest, so that --resume can re-use them rather
+than condition the input again (see dataConditioner.getRecordedConditionedInputGenerator)
+"""
+import os
+import pytest
+
+import tardis.tutils.tutils as tutils
+import tardis.conditioner.data as data
+
+
+def make_chunks(tmpdir):
+    inputs = []
+    for n in (1, 2, 3):
+        tmpdir.join("R1.%05d.fastq"%n).write("@r%d\nACGT\n+\nIIII\n"%n)
+        inputs.append((((str(tmpdir.join("R1.fastq")), None), [str(tmpdir.join("R1.%05d.fastq"%n)), None]),))
+    return inputs
+
+
+def test_resumed_chunks(tmpdir, caller):
+    inputs = make_chunks(tmpdir)
+    manifestName = str(tmpdir.join(data.dataConditioner.CONDITIONED_INPUT_MANIFEST))
+    assert list(caller.getRecordedConditionedInputGenerator(iter(inputs), manifestName)) == inputs
+    assert list(caller.getResumedConditionedInputGenerator(manifestName)) == inputs
+
+    # (the chunks of jobs that finished OK may have been removed)
+    os.remove(str(tmpdir.join("R1.00001.fastq")))
+    assert list(caller.getResumedConditionedInputGenerator(manifestName)) == inputs
+
+
+def test_incomplete_manifest(tmpdir, caller):
+    inputs = make_chunks(tmpdir)
+    manifestName = str(tmpdir.join(data.dataConditioner.CONDITIONED_INPUT_MANIFEST))
+    recorded = caller.getRecordedConditionedInputGenerator(iter(inputs), manifestName)
+    next(recorded)
+    recorded.close()
+    with pytest.raises(tutils.tardisException):
+        list(caller.getResumedConditionedInputGenerator(manifestName))
+
+
+def test_changed_chunk(tmpdir, caller):
+    inputs = make_chunks(tmpdir)
+    manifestName = str(tmpdir.join(data.dataConditioner.CONDITIONED_INPUT_MANIFEST))
+    list(caller.getRecordedConditionedInputGenerator(iter(inputs), manifestName))
+    tmpdir.join("R1.00002.fastq").write("@r2\nAC\n+\nII\n")
+    with pytest.raises(tutils.tardisException):
+        list(caller.getResumedConditionedInputGenerator(manifestName))
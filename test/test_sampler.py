@@ -0,0 +1,72 @@
+"""
+tutils.recordSampler must pick the same records as kseq_split -r for the same seed and rate, so that a seeded
+sample does not depend on which conditioner ran
+"""
+import os, subprocess, distutils.spawn
+import pytest
+
+import tardis.tutils.tutils as tutils
+
+def sampled(sampler, record_count):
+    # (as the conditioners use it - the records skipped are passed over without calling the sampler)
+    ordinals = []
+    ordinal = sampler.getSkipCount() + 1
+    while ordinal <= record_count:
+        ordinals.append(ordinal)
+        ordinal += sampler.getSkipCount() + 1
+    return ordinals
+
+
+def test_known_sample():
+    # (these are the records kseq_split -s 0.1 -r 12345 samples)
+    assert sampled(tutils.recordSampler(0.1, 12345), 200) == [1, 21, 40, 43, 45, 67, 72, 93, 98, 99, 113, 121, 131, 138, 146, 172, 177, 181, 182, 199]
+    assert sampled(tutils.recordSampler(0.5, 7), 20) == [4, 5, 7, 9, 12, 13, 14, 15, 16, 17, 18, 20]
+
+
+def test_sample_is_reproducible():
+    assert sampled(tutils.recordSampler(0.3, 99), 1000) == sampled(tutils.recordSampler(0.3, 99), 1000)
+    assert sampled(tutils.recordSampler(0.3, 99), 1000) != sampled(tutils.recordSampler(0.3, 100), 1000)
+
+
+def test_sample_rate():
+    assert 900 < len(sampled(tutils.recordSampler(0.1, 1), 10000)) < 1100
+
+
+def test_generator_is_called_per_sampled_record():
+    sampler = tutils.recordSampler(0.01, 5)
+    ordinals = []
+    getVariate = sampler.getVariate
+    sampler.getVariate = lambda ordinal: ordinals.append(ordinal) or getVariate(ordinal)
+    sample = sampled(sampler, 100000)
+    assert 800 < len(ordinals) < 1200
+    assert len(ordinals) == len(sample) + 1
+    assert ordinals == [0] + sample
+
+
+def test_not_sampling():
+    for samplerate in (None, 0, 1.0, 2.0):
+        assert len(sampled(tutils.recordSampler(samplerate), 100)) == 100
+
+
+def test_same_sample_as_kseq_split(tmpdir):
+    if distutils.spawn.find_executable("kseq_split") is None:
+        pytest.skip("kseq_split is not installed")
+    fastq = tmpdir.join("in.fastq")
+    fastq.write("".join("@r%d\nACGT\n+\nIIII\n"%ordinal for ordinal in range(1, 1001)))
+    with open(os.devnull, "w") as devnull:
+        subprocess.check_call(["kseq_split", "-s", "0.2", "-r", "4242", "-o", "fastq", str(fastq), "2000", str(tmpdir.join("out.%05d.fastq"))], stdout=devnull, stderr=devnull)
+    names = [record.strip() for record in tmpdir.join("out.00001.fastq").readlines() if record.startswith("@")]
+    assert names == ["@r%d"%ordinal for ordinal in sampled(tutils.recordSampler(0.2, 4242), 1000)]
+
+
+def test_sampled_chunksize_is_rounded(tmpdir):
+    # (the chunksize is for the unsampled input - so sampling 0.1 with chunksize 15, each chunk holds 2 records)
+    if distutils.spawn.find_executable("kseq_split") is None:
+        pytest.skip("kseq_split is not installed")
+    fastq = tmpdir.join("in.fastq")
+    fastq.write("".join("@r%d\nACGT\n+\nIIII\n"%ordinal for ordinal in range(1, 201)))
+    with open(os.devnull, "w") as devnull:
+        subprocess.check_call(["kseq_split", "-s", "0.1", "-r", "12345", "-o", "fastq", str(fastq), "15", str(tmpdir.join("out.%05d.fastq"))], stdout=devnull, stderr=devnull)
+    chunks = sorted(tmpdir.listdir("out.*.fastq"))
+    assert len(chunks) == 10
+    assert [len(chunk.readlines()) / 4 for chunk in chunks] == [2] * 10
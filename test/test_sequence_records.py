@@ -0,0 +1,61 @@
+"""
+The standard conditioner parses fasta and fastq into raw records (text.getRawSequenceRecords) rather than
+SeqRecords - these check that it writes them back out exactly as SeqIO would have
+"""
+import os, StringIO
+import pytest
+
+import tardis.conditioner.text as text
+
+TEST_DIR = os.path.dirname(os.path.abspath(__file__))
+
+def parse(data, informat):
+    return list(text.getRawSequenceRecords(StringIO.StringIO(data), informat))
+
+
+def test_fastq_records():
+    records = parse("@r1 first read\nACGT\n+\nIIII\n@r2\nAC\n+r2\nII\n", "fastq")
+    assert [record.name for record in records] == ["r1", "r2"]
+    assert [len(record) for record in records] == [4, 2]
+    assert [record.offset for record in records] == [0, 27]
+    # (the first is already laid out as SeqIO would write it, the second has a title on its + line)
+    assert records[0].format("fastq") == "@r1 first read\nACGT\n+\nIIII\n"
+    assert records[1].format("fastq") == "@r2\nAC\n+\nII\n"
+    assert records[0].format("fasta") == ">r1 first read\nACGT\n"
+
+
+def test_multi_line_fastq():
+    records = parse("@r1\nACGT\nAC\n+\nIIII\nII\n", "fastq")
+    assert (records[0].seq, records[0].qual) == ("ACGTAC", "IIIIII")
+    assert records[0].format("fastq") == "@r1\nACGTAC\n+\nIIIIII\n"
+
+
+def test_malformed_fastq():
+    with pytest.raises(ValueError):
+        parse("@r1\nACGT\n+\nII\n", "fastq")
+    with pytest.raises(ValueError):
+        parse("r1\nACGT\n+\nIIII\n", "fastq")
+    with pytest.raises(ValueError):
+        parse("@r1\nACGT\n", "fastq")
+
+
+def test_fasta_is_wrapped_at_60():
+    seq = "ACGT" * 40
+    records = parse("junk before the first record\n>s1 first sequence \n%s\n>s2\nAC\n\nGT\n"%seq, "fasta")
+    assert [record.name for record in records] == ["s1", "s2"]
+    assert records[0].format("fasta") == ">s1 first sequence\n%s\n%s\n%s\n"%(seq[0:60], seq[60:120], seq[120:])
+    assert records[1].format("fasta") == ">s2\nACGT\n"
+    with pytest.raises(ValueError):
+        records[1].format("fastq")
+
+
+@pytest.mark.parametrize("filename,informat,outformat", [("test.fastq", "fastq", "fastq"), ("test.fastq", "fastq", "fasta"),
+                                                         ("R1.fastq", "fastq", "fastq"), ("test.fa", "fasta", "fasta"),
+                                                         ("mRNAs.fa", "fasta", "fasta")])
+def test_same_output_as_seqio(filename, informat, outformat):
+    SeqIO = pytest.importorskip("Bio.SeqIO")
+    with open(os.path.join(TEST_DIR, filename), "r") as infile:
+        written = "".join(record.format(outformat) for record in text.getRawSequenceRecords(infile, informat))
+    with open(os.path.join(TEST_DIR, filename), "r") as infile:
+        expected = "".join(record.format(outformat) for record in SeqIO.parse(infile, informat))
+    assert written == expected
@@ -0,0 +1,60 @@
+"""
+A split process (kseq_split -p, or a split worker) reports each chunk on its stdout as it is completed - these check
+that a split which fails sets the error state (see text._next_split_chunk and _reap_split_processes), whether it
+reports an error, just exits non-zero, or is killed - but not one that is stopped because the split was abandoned
+"""
+import distutils.spawn
+import pytest
+
+import tardis.conditioner.text as text
+
+
+def run_split(caller, tmpdir, split_command, chunk_count = None):
+    """
+    read the chunks reported by split_command (all of them, or just the first chunk_count), then reap it
+    """
+    split_logfile = str(tmpdir.join("split.log"))
+    proc = text._start_split_process(caller, split_command, split_logfile)
+    chunks = []
+    while chunk_count is None or len(chunks) < chunk_count:
+        (chunk, digest) = text._next_split_chunk(caller, proc, split_command, "in.fasta")
+        if chunk is None:
+            break
+        chunks.append(chunk)
+    text._reap_split_processes(caller, [proc], [split_command], split_logfile)
+    return chunks
+
+
+def test_kseq_split_exit_status(tmpdir, caller):
+    if distutils.spawn.find_executable("kseq_split") is None:
+        pytest.skip("kseq_split is not installed")
+    tmpdir.join("in.fasta").write(">r1\nACGT\n>r2\nACGT\n")
+    template = str(tmpdir.join("in.%05d.fasta"))
+    assert run_split(caller, tmpdir, ["kseq_split", "-p", "-o", "fasta", str(tmpdir.join("in.fasta")), "1", template]) == \
+           [str(tmpdir.join("in.00001.fasta")), str(tmpdir.join("in.00002.fasta"))]
+    assert caller.errors == []
+
+    # (the input is not there, the chunksize is not a number, the chunks can't be written)
+    for split_command in [["kseq_split", "-p", "-o", "fasta", str(tmpdir.join("missing.fasta")), "1", template],
+                          ["kseq_split", "-p", "-o", "fasta", str(tmpdir.join("in.fasta")), "one", template],
+                          ["kseq_split", "-p", "-o", "fasta", str(tmpdir.join("in.fasta")), "1", str(tmpdir.join("missing", "in.%05d.fasta"))]]:
+        caller.errors = []
+        assert run_split(caller, tmpdir, split_command) == []
+        assert len(caller.errors) == 1 and "terminated with return value 1" in caller.errors[0]
+
+
+def test_reported_error(tmpdir, caller):
+    assert run_split(caller, tmpdir, ["sh", "-c", "echo chunk=a; echo error=disk full; exit 2"]) == ["a"]
+    assert caller.errors[0] == "error splitting in.fasta : disk full"
+    assert "terminated with return value 2" in caller.errors[1]
+
+
+def test_killed_split(tmpdir, caller):
+    assert run_split(caller, tmpdir, ["sh", "-c", "echo chunk=a; kill -9 $$"]) == ["a"]
+    assert len(caller.errors) == 1 and "terminated with return value -9" in caller.errors[0]
+
+
+def test_abandoned_split(tmpdir, caller):
+    # (a split that is still running when we stop reading its chunks is stopped - which is not an error)
+    assert run_split(caller, tmpdir, ["sh", "-c", "echo chunk=a; exec sleep 60"], chunk_count = 1) == ["a"]
+    assert caller.errors == []
@@ -0,0 +1,70 @@
+"""
+Virtual chunks (--virtual-chunks) are served to each job through a named pipe by a writer that its reader script
+starts in the background - these run local sessions to check that jobs see the same input as with chunk files, and
+that no writer is left waiting on a pipe that a job never read
+"""
+import os, stat, time
+
+
+def make_input(tmpdir, line_count = 1000):
+    tmpdir.join("in.txt").write("".join("line %d\n"%n for n in range(1, line_count + 1)))
+    return tmpdir.join("in.txt").read()
+
+
+def session_processes(tmpdir):
+    """
+    return the command lines of any processes (e.g. virtual chunk writers) still running in the session's
+    working folder, waiting a little for any that are on their way out
+    """
+    for attempt in range(0, 20):
+        processes = []
+        for pid in [name for name in os.listdir("/proc") if name.isdigit()]:
+            try:
+                with open(os.path.join("/proc", pid, "cmdline"), "rb") as cmdline:
+                    command = cmdline.read().replace("\0", " ")
+            except IOError:
+                continue
+            if str(tmpdir.join("root")) in command:
+                processes.append(command)
+        if len(processes) == 0:
+            break
+        time.sleep(0.1)
+    return processes
+
+
+def test_same_output_as_chunk_files(tmpdir, run_tardis):
+    expected = make_input(tmpdir)
+    (exit_code, output) = run_tardis(["--virtual-chunks", "-c", "150", "cat", "_condition_text_input_in.txt", ">", "_condition_uncompressedtext_output_out.txt"])
+    assert exit_code == 0, output
+    assert tmpdir.join("out.txt").read() == expected
+    assert session_processes(tmpdir) == []
+
+
+def test_unread_chunks_are_released(tmpdir, run_tardis):
+    make_input(tmpdir)
+    # (true exits without reading its chunk - so without the release, each chunk's writer would be left blocked
+    # opening its pipe)
+    (exit_code, output) = run_tardis(["--virtual-chunks", "-c", "150", "true", "_condition_text_input_in.txt", ">", "_condition_uncompressedtext_output_out.txt"])
+    assert exit_code == 0, output
+    assert session_processes(tmpdir) == []
+
+    # and the same when the jobs fail (when the chunks are kept for debugging)
+    (exit_code, output) = run_tardis(["--virtual-chunks", "-c", "150", "false", "_condition_text_input_in.txt", ">", "_condition_uncompressedtext_output_out.txt"])
+    assert exit_code != 0
+    assert session_processes(tmpdir) == []
+
+
+def test_unread_chunks_are_released_on_resume(tmpdir, run_tardis):
+    make_input(tmpdir)
+    (exit_code, output) = run_tardis(["--virtual-chunks", "-c", "150", "false", "_condition_text_input_in.txt", ">", "_condition_uncompressedtext_output_out.txt"])
+    assert exit_code != 0
+    [workdir] = tmpdir.join("root").listdir()
+
+    # the failed jobs are run again, with the virtual chunks of the first session - each of which must be released
+    # once its job is done , although it is not read
+    (exit_code, output) = run_tardis(["--virtual-chunks", "--resume", str(workdir), "-c", "150", "true", "_condition_text_input_in.txt", ">", \
+                                      "_condition_uncompressedtext_output_out.txt"])
+    assert exit_code == 0, output
+    assert "resuming with the conditioned input of the previous session" in workdir.join("tardis.log").read()
+    assert session_processes(tmpdir) == []
+    assert [path.basename for path in workdir.listdir() if stat.S_ISFIFO(path.lstat().mode)] == []